@@ -0,0 +1,132 @@
+"""Merge the `destinations.checksums` files of many beetmover tasks into
+release wide, per algorithm, SHA256SUMS-like files, e.g.:
+
+    beetmover-merge-checksums --output-dir release/ */destinations.checksums
+
+They list the artifacts by their paths relative to the `s3_bucket_path` of
+the tasks, which is where the merged files can be checked from. Each input is
+sorted by path, as written by `generate_destinations_checksums_manifest`, so
+they are merged as streams: only one line per input is held in memory,
+however big the release is.
+"""
+import argparse
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import sys
+
+from scriptworker.exceptions import ScriptWorkerTaskException
+
+from beetmoverscript.constants import CHECKSUMS_FILENAMES
+
+log = logging.getLogger(__name__)
+
+
+def read_checksums(path):
+    """Yield the (name, algo, digest, size, path) entries of a checksums
+    file, making sure that they are sorted by name"""
+    previous = None
+    with open(path, 'r') as fh:
+        for number, line in enumerate(fh, start=1):
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            fields = line.split(' ', 3)
+            if len(fields) != 4 or not fields[2].isdigit():
+                raise ScriptWorkerTaskException(
+                    "{}:{}: malformed checksums line {!r}".format(path, number, line)
+                )
+            digest, algo, size, name = fields
+            if previous is not None and name < previous:
+                raise ScriptWorkerTaskException(
+                    "{}:{}: {} is listed after {}, the file is not sorted".format(
+                        path, number, name, previous
+                    )
+                )
+            previous = name
+            yield name, algo, digest, int(size), path
+
+
+def merge_checksums(paths):
+    """Merge the checksums files into a single stream of (name, size,
+    digests) tuples, sorted by name, `digests` being keyed by algorithm.
+    Artifacts listed by several inputs are only yielded once, unless their
+    inputs disagree on them."""
+    with contextlib.ExitStack() as stack:
+        streams = [stack.enter_context(contextlib.closing(read_checksums(path)))
+                   for path in paths]
+        merged = heapq.merge(*streams, key=lambda entry: entry[0])
+        for name, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+            size, size_source = None, None
+            digests, digest_sources = {}, {}
+            for _, algo, digest, entry_size, path in entries:
+                if size is not None and entry_size != size:
+                    raise ScriptWorkerTaskException(
+                        "Conflicting sizes of {}: {} in {} and {} in {}".format(
+                            name, size, size_source, entry_size, path
+                        )
+                    )
+                if algo in digests and digests[algo] != digest:
+                    raise ScriptWorkerTaskException(
+                        "Conflicting {} digests of {} in {} and {}".format(
+                            algo, name, digest_sources[algo], path
+                        )
+                    )
+                size, size_source = entry_size, size_source or path
+                digests[algo] = digest
+                digest_sources.setdefault(algo, path)
+            yield name, size, digests
+
+
+def get_checksums_filename(algo):
+    return CHECKSUMS_FILENAMES.get(algo, '{}SUMS'.format(algo.upper()))
+
+
+def write_merged_checksums(paths, output_dir, algorithms):
+    """Write one `sha256sum`-style file per algorithm to `output_dir`,
+    listing every artifact of the checksums files once. Returns how many
+    artifacts were written. Nothing is left behind if the inputs conflict."""
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = {algo: os.path.join(output_dir, get_checksums_filename(algo))
+                    for algo in algorithms}
+    count = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            outputs = {algo: stack.enter_context(open(path, 'w'))
+                       for algo, path in output_paths.items()}
+            for name, _, digests in merge_checksums(paths):
+                missing = [algo for algo in algorithms if algo not in digests]
+                if missing:
+                    raise ScriptWorkerTaskException(
+                        "No {} digest of {}".format(', '.join(missing), name)
+                    )
+                for algo in algorithms:
+                    outputs[algo].write('{}  {}\n'.format(digests[algo], name))
+                count += 1
+    except BaseException:
+        for path in output_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    log.info("Merged %d artifacts from %d checksums files", count, len(paths))
+    return count
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help='destinations.checksums files')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--algorithms', nargs='+', default=['sha256', 'sha512'])
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        write_merged_checksums(args.paths, args.output_dir, args.algorithms)
+    except ScriptWorkerTaskException as exc:
+        log.error(str(exc))
+        sys.exit(exc.exit_code)
+
+
+if __name__ == '__main__':
+    main()
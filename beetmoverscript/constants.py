@@ -28,6 +28,24 @@ TEMPLATE_KEY_PLATFORMS = defaultdict(lambda: "firefox", {
     "android-x86-old-id": "fennecx86",
 })
 HASH_BLOCK_SIZE = 1024*1024
+# how many digests the on-disk digest cache keeps at most
+DIGEST_CACHE_MAX_ENTRIES = 100000
+# rate limited uploads are streamed in smaller chunks to keep them smooth
+UPLOAD_CHUNK_SIZE = 64*1024
+# processes sharing the host upload rate limit sync their share of it every
+# so many bytes or seconds, and are deemed gone once they didn't for a while
+RATE_LIMIT_BATCH_SIZE = 16*1024*1024
+RATE_LIMIT_SYNC_INTERVAL = 1
+RATE_LIMIT_CONSUMER_TTL = 30
+# upstream artifacts streamed from the artifact store are kept on disk up to
+# this size, to retry failed uploads without downloading them again
+STREAM_SPILL_MAX_SIZE = 256*1024*1024
+# how many chunks of a streamed artifact may be waiting for the slowest upload
+STREAM_QUEUE_SIZE = 16
+# artifact of each upstream task listing the digests of its artifacts, which
+# scriptworker downloads to work_dir/cot/<taskId>/ and verifies. Streamed
+# artifacts are checked against it as they didn't go through scriptworker
+CHAIN_OF_TRUST_ARTIFACT = 'public/chain-of-trust.json'
 INITIAL_RELEASE_PROPS_FILE = "balrog_props.json"
 # release buckets don't require a copy of the following artifacts
 IGNORED_UPSTREAM_ARTIFACTS = ["balrog_props.json"]
@@ -51,6 +69,12 @@ RESTRICTED_BUCKET_PATHS = {
         'pub/mobile/candidates',
         'pub/mobile/releases',
     ],
+    'staging': [
+        'pub/firefox/nightly',
+        'pub/firefox/candidates',
+        'pub/mobile/nightly',
+        'pub/mobile/candidates',
+    ],
     'dep': [
         'pub/firefox/nightly',
         'pub/firefox/candidates',
@@ -67,4 +91,132 @@ RELEASE_ACTIONS = (
     'push-to-candidates',
 )
 
+# actions that promote files already in S3 rather than uploading upstream
+# artifacts, hence validated against a different task schema
+PROMOTION_ACTIONS = (
+    'push-to-releases',
+)
+
+# S3 directory of each product, under which the candidates and releases live
+PRODUCT_TO_PATH = {
+    'firefox': 'pub/firefox/',
+    'fennec': 'pub/mobile/',
+}
+
+# candidates files that are not meant to be shipped to the releases directory
+RELEASE_EXCLUDE = (
+    r"^.*tests.*$",
+    r"^.*crashreporter.*$",
+    r"^.*[^k]\.zip(\.asc)?$",
+    r"^.*\.log$",
+    r"^.*\.txt$",
+    r"^.*/partner-repacks.*$",
+    r"^.*\.checksums(\.asc)?$",
+    r"^.*/logs/.*$",
+    r"^.*json$",
+    r"^.*/host.*$",
+    r"^.*/mar-tools/.*$",
+    r"^.*robocop\.apk$",
+    r"^.*contrib.*",
+    r"^.*/beetmover-checksums/.*$",
+)
+
+# S3 objects bigger than this can't be copied in a single CopyObject call and
+# need to be copied by parts instead
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+# how many boto3 calls, listings, HEADs and copies, a promotion runs at once,
+# in a thread pool of its own, see `copy_max_concurrency` in script configs
+COPY_MAX_CONCURRENCY = 20
+
 CACHE_CONTROL_MAXAGE = 3600 * 4
+
+# artifacts uploaded to several buckets either need to land in all of them,
+# or in most of them, see `replication_policy` in the bucket config
+REPLICATION_ALL = 'all'
+REPLICATION_QUORUM = 'quorum'
+
+# region used to sign requests when the bucket config doesn't tell
+S3_DEFAULT_REGION = 'us-east-1'
+# the native S3 transport uploads files bigger than this by parts
+MULTIPART_THRESHOLD = 64*1024*1024
+# S3 parts need to be at least 5MB, but the last one
+MULTIPART_PART_SIZE = 16*1024*1024
+MULTIPART_MAX_CONCURRENCY = 4
+
+# files are published to local mirrors with the first of these that works,
+# from the cheapest to a plain byte copy, see `link_methods` in the bucket
+# config
+LOCAL_LINK_METHODS = ('hardlink', 'reflink', 'copy_file_range', 'copy')
+# local mirrors keep the headers of their objects, e.g. their digests, in
+# this directory under their root rather than along the files they serve
+LOCAL_METADATA_DIR = '.beetmover-metadata'
+# mode of the files published to local mirrors, readable by their web server
+LOCAL_FILE_MODE = 0o644
+
+# uploads taking longer than this percentile of the ones completed so far
+# are duplicated on another connection, once there are enough of them to
+# tell, see `hedging` in the script configs. Objects smaller than the size
+# floor are mostly latency bound and compared as if they weighed that much
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_MIN_DELAY = 2
+HEDGE_SIZE_FLOOR = 1024*1024
+# extra bytes the duplicate uploads of a task may send at most
+HEDGE_MAX_BYTES = 512*1024*1024
+
+# release wide checksums files merged from the `target.checksums` of the
+# beetmover tasks, per algorithm
+CHECKSUMS_FILENAMES = {
+    'md5': 'MD5SUMS',
+    'sha1': 'SHA1SUMS',
+    'sha256': 'SHA256SUMS',
+    'sha512': 'SHA512SUMS',
+}
+
+# digests are stored along the S3 objects as user-defined metadata
+S3_METADATA_PREFIX = 'x-amz-meta-'
+# uploaded objects up to this size are entirely downloaded back to have their
+# digests verified, bigger ones are only checked via a HEAD request
+VERIFICATION_FULL_GET_MAX_SIZE = 1024*1024
+
+# text artifacts can either be uploaded gzipped with a `Content-Encoding`
+# header or as is, along a precompressed `.gz` sidecar object
+COMPRESSION_CONTENT_ENCODING = 'content-encoding'
+COMPRESSION_SIDECAR = 'sidecar'
+
+# default throughput figures, in bytes per second, used to estimate how long
+# the uploads of a dry-run would take
+UPLOAD_PLAN_CONNECTION_THROUGHPUT = 10*1024*1024
+UPLOAD_PLAN_LINK_THROUGHPUT = 100*1024*1024
+# how many of the sources weighing the most on the uploads to report
+UPLOAD_PLAN_HEAVIEST_SOURCES = 10
+
+# S3 endpoints resolve to a handful of addresses that are safe to cache for
+# the duration of a task
+DNS_CACHE_TTL = 300
+# S3 drops idle connections after about 20 seconds, keep them a bit less
+KEEPALIVE_TIMEOUT = 15
+# connections that couldn't be prewarmed in time are given up on
+PREWARM_TIMEOUT = 10
+
+# the progress of the uploads is logged every interval, at the throughput of
+# the last window. Their deadline is the task maxRunTime minus a margin for
+# the steps before and after them, see `progress` in the script configs
+PROGRESS_INTERVAL = 30
+PROGRESS_WINDOW = 120
+PROGRESS_DEADLINE_MARGIN = 120
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# default verbosity of the chattiest libraries, whatever `verbose` is
+LOG_LEVELS = {
+    'taskcluster': 'WARNING',
+    'botocore': 'WARNING',
+    'boto3': 'WARNING',
+    'urllib3': 'WARNING',
+}
+
+# profiling of a task can be turned on either from the script configs or
+# from the environment, without redeploying
+PROFILE_ENV_VAR = 'BEETMOVER_PROFILE'
+PROFILE_LOOP_LAG_INTERVAL = 0.1
+PROFILE_TOP_FUNCTIONS = 30
@@ -0,0 +1,102 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from beetmoverscript.constants import DIGEST_CACHE_MAX_ENTRIES
+
+log = logging.getLogger(__name__)
+
+
+class DigestCache(object):
+    """On-disk cache of file digests, shared by the tasks running on the same
+    worker. Entries are keyed by the file identity (device, inode, size and
+    mtime) so that a modified or replaced file never matches a stale entry.
+    The least recently used entries are evicted once there are a tenth more
+    than `max_entries`, so that eviction doesn't run on every insert."""
+
+    def __init__(self, path, max_entries=DIGEST_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        # digests are computed in executor threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                "algorithm TEXT, digest TEXT, last_used REAL, "
+                "PRIMARY KEY (device, inode, size, mtime_ns, algorithm))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)"
+            )
+            # other processes may add entries too, this is only an estimate
+            # until the next eviction
+            self.count = self.conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    @staticmethod
+    def get_file_id(filepath):
+        stat = os.stat(filepath)
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, filepath, algorithm):
+        """Return the cached digest of the file, or None"""
+        file_id = self.get_file_id(filepath)
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT digest FROM digests WHERE device=? AND inode=? AND size=? "
+                "AND mtime_ns=? AND algorithm=?", file_id + (algorithm, )
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE digests SET last_used=? WHERE device=? AND inode=? AND size=? "
+                "AND mtime_ns=? AND algorithm=?", (time.time(), ) + file_id + (algorithm, )
+            )
+        log.debug("digest cache hit for %s %s", algorithm, filepath)
+        return row[0]
+
+    def set(self, filepath, algorithm, digest):
+        file_id = self.get_file_id(filepath)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                file_id + (algorithm, digest, time.time())
+            )
+            self.count += 1
+            if self.count > self.max_entries + self.max_entries // 10:
+                self._evict()
+
+    def _evict(self):
+        self.count = self.conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+        excess = self.count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests "
+                "ORDER BY last_used LIMIT ?)", (excess, )
+            )
+            self.count = self.max_entries
+
+    def invalidate(self, filepath):
+        """Drop all the cached digests of a file, e.g. once it's been found
+        not to match what was uploaded"""
+        device, inode = self.get_file_id(filepath)[:2]
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM digests WHERE device=? AND inode=?", (device, inode)
+            )
+        log.warning("invalidated cached digests of %s", filepath)
+
+    def close(self):
+        self.conn.close()
+
+
+def get_digest_cache(context):
+    """Open the digest cache configured in the script configs, if any"""
+    cache_config = context.config.get('digest_cache')
+    if not cache_config:
+        return None
+    return DigestCache(cache_config['path'],
+                       max_entries=cache_config.get('max_entries', DIGEST_CACHE_MAX_ENTRIES))
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from beetmoverscript.constants import (HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY,
+                                       HEDGE_SIZE_FLOOR, HEDGE_MAX_BYTES)
+from beetmoverscript.utils import get_tcp_connector
+
+log = logging.getLogger(__name__)
+
+
+class LatencyTracker(object):
+    """Durations of the transfers completed by this task, per byte so that
+    transfers of different sizes can be compared. Transfers smaller than
+    `size_floor` are mostly latency bound and counted as if they weighed
+    that much."""
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 size_floor=HEDGE_SIZE_FLOOR):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.size_floor = size_floor
+        self.samples = []
+
+    def record(self, size, duration):
+        self.samples.append(duration / max(size, self.size_floor))
+
+    def get_delay(self, size):
+        """How long a transfer of `size` bytes is given before being deemed
+        slow, or None while there are too few samples to tell"""
+        if len(self.samples) < self.min_samples:
+            return None
+        samples = sorted(self.samples)
+        ratio = samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+        return ratio * max(size, self.size_floor)
+
+
+class HedgeBudget(object):
+    """Cap on the bytes the duplicate requests of a task may send"""
+
+    def __init__(self, max_bytes=HEDGE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.spent = 0
+
+    def spend(self, size):
+        if self.spent + size > self.max_bytes:
+            return False
+        self.spent += size
+        return True
+
+
+class Hedger(object):
+    """Start a duplicate of the transfers that take longer than most of the
+    ones completed so far, on a connection of its own rather than the one
+    that may be stalled, and keep whichever finishes first. The other one is
+    cancelled.
+
+    The transfers are only timed once they hold one of the
+    `aiohttp_max_connections` slots, so that the ones queued for a
+    connection of the capped pool don't look slow."""
+
+    def __init__(self, tracker, budget, config, min_delay=HEDGE_MIN_DELAY):
+        self.tracker = tracker
+        self.budget = budget
+        self.config = config
+        self.min_delay = min_delay
+        self.slots = asyncio.Semaphore(config['aiohttp_max_connections'])
+        self.session = None
+        self.hedged = 0
+        self.won = 0
+
+    def get_session(self):
+        # a separate pool, so that the duplicates never queue behind or
+        # reuse the connections of the requests they are hedging, capped
+        # like the pool of the task
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=get_tcp_connector(self.config))
+        return self.session
+
+    async def run(self, size, func, *args, session=None):
+        """Await `func(*args, session=session)`, the transfer of `size`
+        bytes, hedging it if it is too slow. `func` needs to be safe to run
+        twice concurrently, e.g. a PUT opening its own file handle."""
+        async with self.slots:
+            return await self._run(size, func, *args, session=session)
+
+    async def _run(self, size, func, *args, session=None):
+        start = time.time()
+        primary = asyncio.ensure_future(func(*args, session=session))
+        attempts = [primary]
+        try:
+            # the transfers started first are only hedged once enough of
+            # the others completed to tell how long they should take
+            while not primary.done():
+                delay = self.tracker.get_delay(size)
+                timeout = self.min_delay
+                if delay is not None:
+                    timeout = start + max(delay, self.min_delay) - time.time()
+                    if timeout <= 0:
+                        break
+                await asyncio.wait([primary], timeout=timeout)
+            if primary.done() or not self.budget.spend(size):
+                result = await primary
+                self.tracker.record(size, time.time() - start)
+                return result
+
+            log.info("hedging a transfer of %d bytes after %.1fs", size, time.time() - start,
+                     extra={'size': size})
+            self.hedged += 1
+            hedge = asyncio.ensure_future(func(*args, session=self.get_session()))
+            attempts.append(hedge)
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is hedge:
+                            self.won += 1
+                        self.tracker.record(size, time.time() - start)
+                        return attempt.result()
+            # both failed, let the caller retry
+            return primary.result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def close(self):
+        if self.hedged:
+            log.info("hedged {} transfer(s), {} of which won, {} extra bytes".format(
+                self.hedged, self.won, self.budget.spent
+            ))
+        if self.session is not None:
+            await self.session.close()
+
+
+def get_hedger(context):
+    """Build the hedger of the task uploads if `hedging` is set in the
+    script configs, None otherwise"""
+    hedging_config = context.config.get('hedging')
+    if not hedging_config:
+        return None
+    tracker = LatencyTracker(
+        percentile=hedging_config.get('percentile', HEDGE_PERCENTILE),
+        min_samples=hedging_config.get('min_samples', HEDGE_MIN_SAMPLES),
+        size_floor=hedging_config.get('size_floor', HEDGE_SIZE_FLOOR),
+    )
+    budget = HedgeBudget(hedging_config.get('max_bytes', HEDGE_MAX_BYTES))
+    return Hedger(tracker, budget, context.config, min_delay=hedging_config.get('min_delay', HEDGE_MIN_DELAY))
@@ -0,0 +1,62 @@
+import json
+import logging
+import logging.handlers
+import queue
+
+from beetmoverscript.constants import LOG_FORMAT, LOG_LEVELS
+
+# attributes every log record has, anything else comes from `extra`
+RECORD_ATTRIBUTES = frozenset(
+    list(logging.LogRecord('', logging.INFO, '', 0, '', (), None).__dict__) + ['message', 'asctime']
+)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Hand the records over to the listener thread as they are, rather than
+    formatting their message and traceback on the event loop first"""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a JSON object, along with the fields passed
+    through `extra`, e.g. the S3 key and status of an upload"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({
+            key: value for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES
+        })
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(config):
+    """Send all the log records through a queue to a listener thread, which
+    formats and writes them. Verbosity is set by `verbose` and can be tuned
+    per logger with `log_levels` in the script configs; `log_format` can be
+    `text` or `json`. Returns the listener, to be stopped once the task is
+    done so that the records left in the queue get written."""
+    handler = logging.StreamHandler()
+    if config.get('log_format') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(logging.DEBUG if config.get('verbose') else logging.INFO)
+    for name, level in dict(LOG_LEVELS, **config.get('log_levels', {})).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    return listener
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+from beetmoverscript.constants import (PROFILE_ENV_VAR, PROFILE_LOOP_LAG_INTERVAL,
+                                       PROFILE_TOP_FUNCTIONS)
+from beetmoverscript.utils import write_json
+
+log = logging.getLogger(__name__)
+
+
+class TaskProfiler(object):
+    """Record the wall time of every asyncio task created on the loop,
+    aggregated by coroutine name, by installing a task factory"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.timings = {}
+        self.previous_factory = None
+
+    def _task_factory(self, loop, coro, **kwargs):
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        name = getattr(coro, '__qualname__', repr(coro))
+        start = time.time()
+        task.add_done_callback(lambda _: self._record(name, time.time() - start))
+        return task
+
+    def _record(self, name, duration):
+        timing = self.timings.setdefault(name, {'count': 0, 'total': 0, 'max': 0})
+        timing['count'] += 1
+        timing['total'] += duration
+        timing['max'] = max(timing['max'], duration)
+
+    def install(self):
+        self.previous_factory = self.loop.get_task_factory()
+        self.loop.set_task_factory(self._task_factory)
+
+    def uninstall(self):
+        self.loop.set_task_factory(self.previous_factory)
+
+    def stats(self):
+        return collections.OrderedDict(
+            sorted(self.timings.items(), key=lambda item: item[1]['total'], reverse=True)
+        )
+
+
+class LoopLagMonitor(object):
+    """Measure how late the event loop wakes a sleeping coroutine up, which is
+    how long it was blocked by synchronous code, e.g. hashing or JSON I/O"""
+
+    def __init__(self, interval=PROFILE_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0, loop.time() - start - self.interval))
+
+    def stats(self):
+        if not self.samples:
+            return {'samples': 0}
+        samples = sorted(self.samples)
+        return {
+            'samples': len(samples),
+            'interval': self.interval,
+            'mean': sum(samples) / len(samples),
+            'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            'max': samples[-1],
+            'total': sum(samples),
+        }
+
+
+def is_profiling_enabled(context):
+    """Profiling is opt-in, either with `enabled` in the `profile` section of
+    the script configs or from the environment"""
+    profile_config = context.config.get('profile') or {}
+    return bool(os.environ.get(PROFILE_ENV_VAR) or profile_config.get('enabled'))
+
+
+def get_top_functions(profiler, limit):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def write_profile(context, profiler, task_profiler, lag_monitor):
+    """Dump the CPU profile as a pstats file and the asyncio task timings,
+    loop lag and top CPU stacks as a json summary, under the public
+    artifacts so that they can be pulled from real tasks"""
+    profile_config = context.config.get('profile') or {}
+    public_dir = os.path.join(context.config['artifact_dir'], 'public')
+    os.makedirs(public_dir, exist_ok=True)
+
+    profiler.dump_stats(os.path.join(public_dir, 'profile.pstats'))
+    summary = {
+        'tasks': task_profiler.stats(),
+        'loop_lag': lag_monitor.stats(),
+        'top_functions': get_top_functions(
+            profiler, profile_config.get('top_functions', PROFILE_TOP_FUNCTIONS)
+        ).splitlines(),
+    }
+    write_json(os.path.join(public_dir, 'profile.json'), summary)
+    log.info("Event loop lag: {}".format(summary['loop_lag']))
+
+
+async def run_profiled(context, coro):
+    """Await the coroutine under a CPU profiler, an asyncio task profiler and
+    an event loop lag monitor, then write their reports"""
+    profile_config = context.config.get('profile') or {}
+    loop = asyncio.get_event_loop()
+    task_profiler = TaskProfiler(loop)
+    lag_monitor = LoopLagMonitor(profile_config.get('loop_lag_interval', PROFILE_LOOP_LAG_INTERVAL))
+    profiler = cProfile.Profile()
+
+    task_profiler.install()
+    monitor = asyncio.ensure_future(lag_monitor.run())
+    profiler.enable()
+    try:
+        return await coro
+    finally:
+        profiler.disable()
+        monitor.cancel()
+        task_profiler.uninstall()
+        # failing to write the reports must not hide the outcome of the task
+        try:
+            write_profile(context, profiler, task_profiler, lag_monitor)
+        except Exception:
+            log.exception("Failed to write the profile")
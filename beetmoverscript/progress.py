@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+from scriptworker.exceptions import ScriptWorkerRetryException
+
+from beetmoverscript.constants import (PROGRESS_INTERVAL, PROGRESS_WINDOW,
+                                       PROGRESS_DEADLINE_MARGIN)
+from beetmoverscript.streaming import RemoteArtifact
+from beetmoverscript.utils import get_size
+
+log = logging.getLogger(__name__)
+
+
+class ArtifactProgress(object):
+    """Bytes of an upstream artifact counted so far. Each of its `uploads`
+    sending the whole of it counts for its share of `size`. Retries and
+    hedged duplicates may send more, the artifact never counts for more than
+    its size."""
+
+    def __init__(self, tracker, size, uploads):
+        self.tracker = tracker
+        self.size = size or 0
+        self.uploads = max(uploads, 1)
+        self.counted = 0
+        self.paths = []
+
+    def count(self, fraction):
+        """Count `fraction` of one of the uploads as sent"""
+        size = min(int(self.size * fraction / self.uploads), self.size - self.counted)
+        if size > 0:
+            self.counted += size
+            self.tracker.count(size)
+
+
+class FileProgress(object):
+    """Token bucket lookalike, counting the bytes of a `size` long file
+    going through it towards the progress of its artifact. It never throttles
+    them: uploads only read throttled files through it, the others consume
+    it once sent."""
+
+    def __init__(self, artifact, size):
+        self.artifact = artifact
+        self.size = size
+
+    async def consume(self, size):
+        if self.size:
+            self.artifact.count(size / self.size)
+
+
+class ProgressTracker(object):
+    """Bytes of the upstream artifacts beetmoved so far, out of `total`. The
+    bytes of the artifacts being watched are counted as their uploads send
+    them, the others once all their destinations, in all the target buckets,
+    are done. The throughput is averaged over the last `window` seconds so
+    that the ETA follows the uplink as it speeds up or slows down."""
+
+    def __init__(self, total, deadline=None, window=PROGRESS_WINDOW):
+        self.total = total
+        self.done = 0
+        self.deadline = deadline
+        self.window = window
+        self.start = time.time()
+        self.samples = collections.deque()
+        self.artifacts = {}
+        self.files = {}
+
+    def count(self, size):
+        self.done += size
+        self.samples.append((time.time(), size))
+
+    def add(self, size, artifact=None):
+        """Count an artifact of `size` bytes as done, minus what was already
+        counted of it as it was sent"""
+        progress = self.artifacts.pop(artifact, None)
+        if progress is not None:
+            size -= progress.counted
+            for path in progress.paths:
+                self.files.pop(path, None)
+        if size > 0:
+            self.count(size)
+
+    def watch(self, artifact, size, uploads):
+        """Count the bytes of `artifact` as its `uploads` send them"""
+        self.artifacts[artifact] = ArtifactProgress(self, size, uploads)
+
+    def watch_file(self, path, size, artifact):
+        """Count the bytes of the `path` file, `size` long, as the uploads
+        of `artifact` send them. `artifact` may also be another watched file,
+        e.g. the one `path` is the compressed copy of."""
+        progress = self.files[artifact].artifact if artifact in self.files else \
+            self.artifacts.get(artifact)
+        if progress is not None:
+            progress.paths.append(path)
+            self.files[path] = FileProgress(progress, size)
+
+    def get_meters(self, path):
+        """What the uploads of `path` need to go through, along with the rate
+        limiters, for their bytes to be counted as they are sent"""
+        return [self.files[path]] if path in self.files else []
+
+    def throughput(self):
+        now = time.time()
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        span = min(self.window, now - self.start)
+        if not self.samples or span <= 0:
+            return 0
+        return sum(size for _, size in self.samples) / span
+
+    def eta(self):
+        """Seconds left until all the bytes are done, None if nothing was
+        done lately to tell"""
+        remaining = max(0, self.total - self.done)
+        if not remaining:
+            return 0
+        throughput = self.throughput()
+        return remaining / throughput if throughput else None
+
+    def time_left(self):
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def is_doomed(self):
+        """Whether the remaining bytes can't be done before the deadline at
+        the current pace"""
+        time_left = self.time_left()
+        if time_left is None:
+            return False
+        eta = self.eta()
+        return time_left <= 0 or (eta is not None and eta > time_left)
+
+
+def get_deadline(context):
+    """The time by which the uploads need to be done for the task to finish
+    within the `maxRunTime` of its payload, or of the script configs, if
+    any. The margin accounts for the upstream artifacts download, which
+    happens before the script starts, and for the manifests to write
+    afterwards."""
+    progress_config = context.config.get('progress') or {}
+    max_run_time = context.task['payload'].get('maxRunTime') or progress_config.get('max_run_time')
+    if not max_run_time:
+        return None
+    margin = progress_config.get('deadline_margin', PROGRESS_DEADLINE_MARGIN)
+    return context.task_start + max_run_time - margin
+
+
+def get_progress_tracker(context, artifacts_to_beetmove):
+    """Return a tracker of the uploads, or None if neither the script
+    configs nor the task ask for their progress or give them a deadline"""
+    deadline = get_deadline(context)
+    progress_config = context.config.get('progress')
+    if not progress_config and deadline is None:
+        return None
+    total = 0
+    for locale in artifacts_to_beetmove:
+        for source in artifacts_to_beetmove[locale].values():
+            if isinstance(source, RemoteArtifact):
+                total += source.size or 0
+            elif os.path.exists(source):
+                total += get_size(source)
+    return ProgressTracker(total, deadline=deadline,
+                           window=(progress_config or {}).get('window', PROGRESS_WINDOW))
+
+
+def format_seconds(seconds):
+    return 'unknown' if seconds is None else '{:.0f}s'.format(seconds)
+
+
+async def watch_progress(context, tracker):
+    """Periodically log the progress and ETA of the uploads, and raise a
+    ScriptWorkerRetryException as soon as they are bound to run past the
+    deadline, rather than having the task killed midway"""
+    progress_config = context.config.get('progress') or {}
+    interval = progress_config.get('interval', PROGRESS_INTERVAL)
+    fail_early = progress_config.get('fail_early', True)
+    while True:
+        await asyncio.sleep(interval)
+        eta, time_left = tracker.eta(), tracker.time_left()
+        log.info("beetmoved %d of %d bytes (%.0f%%) at %.0f bytes/s, ETA %s, %s left",
+                 tracker.done, tracker.total, 100 * tracker.done / max(tracker.total, 1),
+                 tracker.throughput(), format_seconds(eta), format_seconds(time_left),
+                 extra={'bytes_done': tracker.done, 'bytes_total': tracker.total,
+                        'eta': eta, 'time_left': time_left})
+        if fail_early and tracker.is_doomed():
+            raise ScriptWorkerRetryException(
+                "Giving up, the uploads would need {} but only {} are left before the "
+                "maxRunTime".format(format_seconds(eta), format_seconds(time_left))
+            )
+
+
+async def run_with_progress(context, tracker, coro):
+    """Await the coroutine while watching the progress of its uploads, if
+    given a tracker"""
+    if tracker is None:
+        return await coro
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(watch_progress(context, tracker))
+    try:
+        await asyncio.wait([work, watcher], return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            # the watcher only stops on a doomed run
+            work.cancel()
+            return watcher.result()
+        return work.result()
+    finally:
+        work.cancel()
+        watcher.cancel()
@@ -0,0 +1,153 @@
+import asyncio
+import fcntl
+import json
+import logging
+import time
+import uuid
+
+from beetmoverscript.constants import (UPLOAD_CHUNK_SIZE, RATE_LIMIT_BATCH_SIZE,
+                                       RATE_LIMIT_SYNC_INTERVAL, RATE_LIMIT_CONSUMER_TTL)
+from beetmoverscript.utils import run_in_executor
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Token bucket refilled with `rate` bytes per second, holding at most
+    `burst` bytes. Consumers are allowed to go in debt and then wait until the
+    bucket is refilled, so that a single chunk bigger than the burst size
+    doesn't block forever."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.timestamp = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def take(self, amount):
+        """Consume the tokens for `amount` bytes and return how long to wait
+        before actually sending them"""
+        self._refill(time.time())
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
+
+    async def consume(self, amount):
+        delay = self.take(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket holding this process' share of a host-wide `rate`, so
+    that all the beetmover processes running on the same host share one
+    uplink budget. Each of them registers its `weight` in a state file,
+    locked around each update, and gets `rate * weight / total weight` of
+    the processes that uploaded lately, e.g. a weight of 4 gets 4 times the
+    share of a weight of 1 but never more than `rate` all together.
+
+    The state file is only synced every `batch_size` bytes or `interval`
+    seconds, whichever comes first, in the default executor."""
+
+    def __init__(self, state_file, rate, burst=None, weight=1,
+                 batch_size=RATE_LIMIT_BATCH_SIZE, interval=RATE_LIMIT_SYNC_INTERVAL):
+        super(SharedTokenBucket, self).__init__(rate, burst=burst)
+        self.state_file = state_file
+        self.host_rate = rate
+        self.host_burst = self.burst
+        self.weight = weight
+        self.batch_size = batch_size
+        self.interval = interval
+        self.consumer_id = uuid.uuid4().hex
+        self.unsynced = 0
+        self.synced_at = None
+
+    def sync(self):
+        """Register this process as an active consumer and return its share
+        of the host rate"""
+        with open(self.state_file, "a+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                fh.seek(0)
+                contents = fh.read()
+                now = time.time()
+                consumers = json.loads(contents).get('consumers', {}) if contents else {}
+                # processes that stopped uploading give their share back
+                consumers = {
+                    consumer_id: consumer for consumer_id, consumer in consumers.items()
+                    if now - consumer['timestamp'] < RATE_LIMIT_CONSUMER_TTL
+                }
+                consumers[self.consumer_id] = {'weight': self.weight, 'timestamp': now}
+                fh.seek(0)
+                fh.truncate()
+                json.dump({'consumers': consumers}, fh)
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return self.weight / sum(consumer['weight'] for consumer in consumers.values())
+
+    def set_share(self, share):
+        # the tokens accumulated so far are at the previous rate
+        self._refill(time.time())
+        self.rate = self.host_rate * share
+        self.burst = self.host_burst * share
+        self.tokens = min(self.tokens, self.burst)
+
+    async def consume(self, amount):
+        if self.synced_at is None or self.unsynced >= self.batch_size or \
+                time.time() - self.synced_at >= self.interval:
+            self.set_share(await run_in_executor(self.sync))
+            self.unsynced = 0
+            self.synced_at = time.time()
+        self.unsynced += amount
+        await super(SharedTokenBucket, self).consume(amount)
+
+
+class ThrottledFileReader(object):
+    """Async iterator over the chunks of an open file, consuming tokens from
+    all the given buckets before handing each chunk over"""
+
+    def __init__(self, fh, buckets, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.fh = fh
+        self.buckets = buckets
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await run_in_executor(self.fh.read, self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        for bucket in self.buckets:
+            await bucket.consume(len(chunk))
+        return chunk
+
+
+def get_rate_limiters(context):
+    """Build the token buckets that uploads of this task need to go through.
+    The host-wide limit comes from the script configs and may be shared with
+    the other beetmover processes, weighted by bucket so that release pushes
+    get a larger share than dep or nightly ones. The task-wide limit comes
+    from the task payload."""
+    limiters = []
+
+    host_config = context.config.get('upload_rate_limit')
+    if host_config:
+        state_file = host_config.get('state_file')
+        if state_file:
+            weight = host_config.get('weights', {}).get(context.bucket, 1)
+            limiters.append(SharedTokenBucket(state_file, host_config['rate'],
+                                              burst=host_config.get('burst'), weight=weight))
+        else:
+            limiters.append(TokenBucket(host_config['rate'], burst=host_config.get('burst')))
+
+    task_rate = context.task['payload'].get('upload_rate_limit')
+    if task_rate:
+        limiters.append(TokenBucket(task_rate))
+
+    if limiters:
+        log.info("Uploads are rate limited by {} token bucket(s)".format(len(limiters)))
+    return limiters
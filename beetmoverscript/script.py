@@ -2,29 +2,58 @@
 """Beetmover script
 """
 import asyncio
+import concurrent.futures
+import hashlib
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import time
 import traceback
+import urllib.parse
 import mimetypes
 import aiohttp
 import boto3
+import botocore.config
 
 from scriptworker.client import get_task
 from scriptworker.context import Context
 from scriptworker.exceptions import ScriptWorkerTaskException, ScriptWorkerRetryException
 from scriptworker.utils import retry_async, raise_future_exceptions
 
-from beetmoverscript.constants import MIME_MAP, RELEASE_BRANCHES, CACHE_CONTROL_MAXAGE
+from beetmoverscript.constants import (MIME_MAP, RELEASE_BRANCHES, CACHE_CONTROL_MAXAGE,
+                                       S3_METADATA_PREFIX, VERIFICATION_FULL_GET_MAX_SIZE,
+                                       COMPRESSION_CONTENT_ENCODING, COMPRESSION_SIDECAR,
+                                       PROMOTION_ACTIONS, RELEASE_EXCLUDE, MAX_COPY_OBJECT_SIZE,
+                                       COPY_MAX_CONCURRENCY,
+                                       PREWARM_TIMEOUT,
+                                       STREAM_SPILL_MAX_SIZE, UPLOAD_CHUNK_SIZE,
+                                       REPLICATION_ALL, REPLICATION_QUORUM)
+from beetmoverscript.digest_cache import get_digest_cache
+from beetmoverscript.hedging import get_hedger
+from beetmoverscript.logs import setup_logging
+from beetmoverscript.profiling import is_profiling_enabled, run_profiled
+from beetmoverscript.progress import get_progress_tracker, run_with_progress
+from beetmoverscript.ratelimit import get_rate_limiters, ThrottledFileReader
+from beetmoverscript.streaming import (RemoteArtifact, ChunkQueue, SpillFile,
+                                       stat_remote_artifacts, get_stream_slots,
+                                       download_artifact, get_download_session,
+                                       close_download_session, check_trusted_digest)
+from beetmoverscript.transport import get_s3_transport, RETRY_EXCEPTIONS
 from beetmoverscript.task import (validate_task_schema, add_balrog_manifest_to_artifacts,
                                   get_upstream_artifacts, get_initial_release_props_file,
                                   add_checksums_to_artifacts,
+                                  add_destinations_checksums_to_artifacts,
                                   add_release_props_to_artifacts,
                                   get_task_bucket, get_task_action,
-                                  validate_bucket_paths)
+                                  validate_bucket_paths, add_upload_plan_to_artifacts)
 from beetmoverscript.utils import (load_json, get_hash, get_release_props,
                                    generate_beetmover_manifest, get_size,
-                                   alter_unpretty_contents)
+                                   alter_unpretty_contents, gzip_file,
+                                   run_in_executor, get_candidates_prefix,
+                                   get_releases_prefix, matches_exclude,
+                                   get_tcp_connector, cancelling, run_in_pool)
 
 log = logging.getLogger(__name__)
 
@@ -35,7 +64,11 @@ async def push_to_nightly(context):
 
     # find release properties and make a copy in the artifacts directory
     release_props_file = get_initial_release_props_file(context)
-    context.release_props = get_release_props(release_props_file)
+    context.release_props = await run_in_executor(get_release_props, release_props_file)
+
+    # upstream artifacts that are streamed from the artifact store rather than
+    # read from the work_dir need to exist too
+    await stat_remote_artifacts(context, context.artifacts_to_beetmove)
 
     # generate beetmover mapping manifest
     mapping_manifest = generate_beetmover_manifest(context)
@@ -43,10 +76,16 @@ async def push_to_nightly(context):
     # perform another validation check against the bucket path
     validate_bucket_paths(context.bucket, mapping_manifest['s3_bucket_path'])
 
+    # dry-runs only report what would have been uploaded, without altering
+    # any file or touching S3
+    if context.task['payload'].get('dry_run'):
+        await add_upload_plan_to_artifacts(context, context.artifacts_to_beetmove, mapping_manifest)
+        return
+
     # some files to-be-determined via script configs need to have their
     # contents pretty named, so doing it here before even beetmoving begins
     blobs = context.config.get('blobs_needing_prettynaming_contents', [])
-    alter_unpretty_contents(context, blobs, mapping_manifest)
+    await run_in_executor(alter_unpretty_contents, context, blobs, mapping_manifest)
 
     # balrog_manifest is written and uploaded as an artifact which is used by
     # a subsequent balrogworker task in the release graph. Balrogworker uses
@@ -57,28 +96,109 @@ async def push_to_nightly(context):
     # used by a subsequent signing task and again by another beetmover task to
     # upload it to S3
     context.checksums = dict()
+    # the same digests, keyed by destination, are merged with the ones of the
+    # other tasks of a release into its SHA256SUMS-like files, see
+    # `beetmover-merge-checksums`
+    context.destination_checksums = dict()
+    # digests are computed once per file, and each distinct content is only
+    # uploaded once if `deduplicate_uploads` is set in script configs
+    context.file_checksums = dict()
+    context.uploaded_contents = dict()
+
+    # text artifacts may be compressed before being uploaded, see
+    # `compression` in script configs. Keep track of them to only compress
+    # once per source file
+    context.compressed_artifacts = dict()
+    context.compression_executor = get_compression_executor(context)
+
+    # keep track of how much is left to upload against the task maxRunTime,
+    # giving up early rather than being killed midway
+    context.progress = get_progress_tracker(context, context.artifacts_to_beetmove)
+
+    # streamed artifacts hold a connection per upload for as long as they're
+    # being downloaded
+    context.stream_slots = get_stream_slots(context)
+
+    # artifacts may be replicated to other buckets than the task one, e.g.
+    # in other regions, see `replicas` in the bucket config. Their contexts
+    # are usually made, and their S3 clients created, by the prewarming
+    if getattr(context, 'targets', None) is None:
+        context.targets = get_targets(context)
 
     # for each artifact in manifest
     #   a. map each upstream artifact to pretty name release bucket format
     #   b. upload to corresponding S3 location
-    await move_beets(context, context.artifacts_to_beetmove, mapping_manifest)
+    try:
+        await run_with_progress(context, context.progress,
+                                move_beets(context, context.artifacts_to_beetmove, mapping_manifest))
+    finally:
+        await discard_compressed_artifacts(context)
+
+    # optionally double check that what landed in S3 matches what we hashed
+    # before balrogworker starts publishing update URLs pointing to it
+    if context.config.get('upload_verification'):
+        await verify_beets(context, context.artifacts_to_beetmove, mapping_manifest)
 
     #  write balrog_manifest to a file and add it to list of artifacts
-    add_balrog_manifest_to_artifacts(context)
+    await add_balrog_manifest_to_artifacts(context)
     # determine the correct checksum filename and generate it, adding it to
     # the list of artifacts afterwards
-    add_checksums_to_artifacts(context)
+    await add_checksums_to_artifacts(context)
+    await add_destinations_checksums_to_artifacts(context, mapping_manifest)
     # add release props file to later be used by beetmover jobs than upload
     # the checksums file
-    add_release_props_to_artifacts(context, release_props_file)
+    await add_release_props_to_artifacts(context, release_props_file)
 
 
 async def push_to_releases(context):
-    raise NotImplementedError("Push to releases logic has not been added yet")
+    """Promote a release by copying, server-side, the contents of its
+    candidates directory to its releases directory. Objects already copied by
+    a previous run are skipped, so that the task can be safely rerun."""
+    payload = context.task['payload']
+    product = payload['product'].lower()
+    candidates_prefix = get_candidates_prefix(product, payload['version'], payload['build_number'])
+    releases_prefix = get_releases_prefix(product, payload['version'])
+    validate_bucket_paths(context.bucket, candidates_prefix)
+    validate_bucket_paths(context.bucket, releases_prefix)
 
+    bucket_name = context.config['bucket_config'][context.bucket]['buckets'][product]
+    s3 = get_s3_client(context)
+    # boto3 calls block, they don't compete for the few threads of the
+    # default executor with the hashing of other tasks
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=context.config.get('copy_max_concurrency', COPY_MAX_CONCURRENCY)
+    )
+    try:
+        await promote(s3, bucket_name, candidates_prefix, releases_prefix,
+                      context.config.get('releases_excludes', RELEASE_EXCLUDE), executor)
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def promote(s3, bucket_name, candidates_prefix, releases_prefix, excludes, executor):
+    candidates = await list_s3_objects(s3, bucket_name, candidates_prefix, executor=executor)
+    if not candidates:
+        raise ScriptWorkerTaskException(
+            "No files to copy from {}".format(candidates_prefix)
+        )
+    releases = await list_s3_objects(s3, bucket_name, releases_prefix, executor=executor)
 
-async def push_to_staging(context):
-    raise NotImplementedError("Push to staging logic has not been added yet")
+    copy_plan = get_copy_plan(candidates, releases, candidates_prefix, releases_prefix, excludes)
+    log.info("Copying {} of {} candidates files to {}".format(
+        len(copy_plan), len(candidates), releases_prefix
+    ))
+
+    copies = []
+    for source_key, dest_key, size, compare_digests in copy_plan:
+        copies.append(
+            asyncio.ensure_future(
+                copy_s3_object(s3, bucket_name, source_key, dest_key, size, executor,
+                               compare_digests=compare_digests)
+            )
+        )
+    if copies:
+        with cancelling(copies):
+            await raise_future_exceptions(copies)
 
 
 action_map = {
@@ -86,59 +206,122 @@ action_map = {
     # push to candidates is at this point identical to push_to_nightly
     'push-to-candidates': push_to_nightly,
     'push-to-releases': push_to_releases,
-    'push-to-staging': push_to_staging
+    # staging buckets take the same uploads as nightlies, they are usually
+    # local mirrors though, see the `local` transport
+    'push-to-staging': push_to_nightly,
 }
 
 
 # async_main {{{1
 async def async_main(context):
-    # determine the task and make a quick validation check against its schema
+    context.task_start = time.time()
+    # determine the task, its bucket and action
     context.task = get_task(context.config)  # e.g. $cfg['work_dir']/task.json
-    validate_task_schema(context)
-
-    # determine the task bucket and action
     context.bucket = get_task_bucket(context.task, context.config)
     context.action = get_task_action(context.task, context.config)
 
-    if action_map.get(context.action):
-        await action_map[context.action](context)
+    # open the connections to S3 while the task is being validated and the
+    # manifest rendered, rather than all at once when the uploads start. The
+    # S3 clients are created in an executor, which only overlaps with the
+    # validation once the prewarming is given a chance to start. Dry runs
+    # don't touch S3, and promotions only go through boto3
+    prewarm = None
+    if context.action not in PROMOTION_ACTIONS and not context.task['payload'].get('dry_run'):
+        context.targets = get_targets(context)
+        prewarm = asyncio.ensure_future(prewarm_connections(context))
+        await asyncio.sleep(0)
+
+    # make a quick validation check against its schema. Promotion actions
+    # don't take upstream artifacts, hence their own schema
+    if context.action in PROMOTION_ACTIONS:
+        validate_task_schema(context, schema_key='release_schema_file')
     else:
-        log.critical("Unknown action {}!".format(context.action))
-        sys.exit(3)
+        validate_task_schema(context)
+
+    # uploads may need to share the host uplink with other beetmover tasks
+    context.rate_limiters = get_rate_limiters(context)
+    # digests of the upstream artifacts may have already been computed by a
+    # previous task on this worker
+    context.digest_cache = get_digest_cache(context)
+    # slow uploads may be duplicated on other connections
+    context.hedger = get_hedger(context)
+
+    try:
+        if action_map.get(context.action):
+            await action_map[context.action](context)
+        else:
+            log.critical("Unknown action {}!".format(context.action))
+            sys.exit(3)
+    finally:
+        if prewarm is not None:
+            prewarm.cancel()
+        if context.digest_cache is not None:
+            context.digest_cache.close()
+        if context.hedger is not None:
+            await context.hedger.close()
+        await close_download_session(context)
 
     log.info('Success!')
 
 
 async def move_beets(context, artifacts_to_beetmove, manifest):
-    beets = []
+    artifacts = []
     for locale in artifacts_to_beetmove:
         for artifact in artifacts_to_beetmove[locale]:
-            source = artifacts_to_beetmove[locale][artifact]
-            artifact_pretty_name = manifest['mapping'][locale][artifact]['s3_key']
-            destinations = [os.path.join(manifest["s3_bucket_path"],
-                                         dest) for dest in
-                            manifest['mapping'][locale][artifact]['destinations']]
-
             balrog_manifest = manifest['mapping'][locale][artifact].get('update_balrog_manifest')
-            beets.append(
-                asyncio.ensure_future(
-                    move_beet(context, source, destinations, locale=locale,
-                              update_balrog_manifest=balrog_manifest,
-                              artifact_pretty_name=artifact_pretty_name)
-                )
+            artifacts.append((locale, artifact, balrog_manifest))
+    # the artifacts balrog points to are started first, so that they get the
+    # connections first and are done even if the task runs out of time
+    artifacts.sort(key=lambda item: not item[2])
+
+    beets = []
+    for locale, artifact, balrog_manifest in artifacts:
+        source = artifacts_to_beetmove[locale][artifact]
+        artifact_pretty_name = manifest['mapping'][locale][artifact]['s3_key']
+        destinations = [os.path.join(manifest["s3_bucket_path"],
+                                     dest) for dest in
+                        manifest['mapping'][locale][artifact]['destinations']]
+
+        beets.append(
+            asyncio.ensure_future(
+                move_beet(context, source, destinations, locale=locale,
+                          update_balrog_manifest=balrog_manifest,
+                          artifact_pretty_name=artifact_pretty_name)
             )
-    await raise_future_exceptions(beets)
+        )
+    # e.g. once run_with_progress gives up
+    with cancelling(beets):
+        await raise_future_exceptions(beets)
 
 
 async def move_beet(context, source, destinations, locale,
                     update_balrog_manifest, artifact_pretty_name):
-    await retry_upload(context=context, destinations=destinations, path=source)
+    targets = getattr(context, 'targets', None) or [context]
+    progress = getattr(context, 'progress', None)
+    if isinstance(source, RemoteArtifact) and progress is not None:
+        progress.watch(source, source.size, len(destinations) * len(targets))
+    if isinstance(source, RemoteArtifact) and is_streamable(context, source, destinations, targets):
+        # digests of streamed artifacts are computed on the fly
+        checksums = await stream_beet(context, source, destinations, targets)
+    elif isinstance(source, RemoteArtifact):
+        checksums = await download_beet(context, source, destinations, targets)
+    else:
+        # digests are computed before uploading so that they can be stored
+        # along the S3 object as metadata and checked against later on. They
+        # are computed once, whatever the number of buckets uploaded to
+        checksums = await get_checksums(context, source)
+        if progress is not None:
+            progress.watch(source, checksums['size'], len(destinations) * len(targets))
+            progress.watch_file(source, checksums['size'], source)
+        metadata = {algo: checksums[algo] for algo in context.config['checksums_digests']}
+        await replicate(context, targets, upload_beet, source, destinations, metadata)
 
     if context.checksums.get(artifact_pretty_name) is None:
-        context.checksums[artifact_pretty_name] = {
-            algo: get_hash(source, algo) for algo in context.config['checksums_digests']
-        }
-        context.checksums[artifact_pretty_name]['size'] = get_size(source)
+        context.checksums[artifact_pretty_name] = checksums
+    for dest in destinations:
+        context.destination_checksums[dest] = checksums
+    if progress is not None:
+        progress.add(checksums['size'], source)
 
     if update_balrog_manifest:
         context.balrog_manifest.append(
@@ -146,6 +329,84 @@ async def move_beet(context, source, destinations, locale,
         )
 
 
+async def upload_beet(context, source, destinations, metadata):
+    if context.config.get('deduplicate_uploads'):
+        await dedup_upload(context=context, destinations=destinations, path=source,
+                           metadata=metadata)
+    else:
+        await retry_upload(context=context, destinations=destinations, path=source,
+                           metadata=metadata)
+
+
+async def get_checksums(context, source):
+    """Compute the digests and size of a file. Files are identified by
+    their inode, so that the same file listed several times, or hardlinked
+    under different names, is only read once."""
+    stat = os.stat(source)
+    file_id = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if file_id not in context.file_checksums:
+        context.file_checksums[file_id] = asyncio.ensure_future(compute_checksums(context, source))
+    return await context.file_checksums[file_id]
+
+
+async def compute_checksums(context, source):
+    checksums = {}
+    for algo in context.config['checksums_digests']:
+        checksums[algo] = await run_in_executor(get_hash, source, algo,
+                                                cache=context.digest_cache)
+    checksums['size'] = get_size(source)
+    return checksums
+
+
+async def dedup_upload(context, destinations, path, metadata):
+    """Upload each distinct content only once per task. The first artifact
+    holding a given content is uploaded as usual, the destinations of any
+    other artifact with the same digests are then copied server-side from
+    it. Copies keep the headers of their source, artifacts are only
+    deduplicated if they'd be uploaded with the same ones."""
+    content_id = (tuple(sorted(metadata.items())), mimetypes.guess_type(path)[0],
+                  get_compression(context, path))
+    uploaded = context.uploaded_contents.get(content_id)
+    if uploaded is None:
+        uploaded = asyncio.Future()
+        context.uploaded_contents[content_id] = uploaded
+        try:
+            await retry_upload(context=context, destinations=destinations, path=path,
+                               metadata=metadata)
+        except BaseException:
+            # other artifacts with the same contents fall back to their own
+            # upload if this one failed
+            uploaded.set_result(None)
+            raise
+        uploaded.set_result(destinations[0])
+        return
+
+    copy_source = await uploaded
+    if copy_source is None:
+        await retry_upload(context=context, destinations=destinations, path=path,
+                           metadata=metadata)
+        return
+
+    log.info("%s has the same contents as %s, copying it", path, copy_source)
+    delta_destinations = get_delta_destinations(context, destinations)
+    copies = []
+    for dest in destinations:
+        if dest in delta_destinations:
+            copies.append(
+                asyncio.ensure_future(
+                    update_delta_destination(context=context, s3_key=dest, path=path,
+                                             metadata=metadata, copy_source=copy_source)
+                )
+            )
+        else:
+            copies.append(
+                asyncio.ensure_future(
+                    copy_destination(context, copy_source, dest, path)
+                )
+            )
+    await raise_future_exceptions(copies)
+
+
 def enrich_balrog_manifest(context, artifact_pretty_name, locale, destinations):
     release_props = context.release_props
     checksums = context.checksums
@@ -177,54 +438,940 @@ def enrich_balrog_manifest(context, artifact_pretty_name, locale, destinations):
     }
 
 
-async def retry_upload(context, destinations, path):
+async def retry_upload(context, destinations, path, metadata=None):
     # TODO rather than upload twice, use something like boto's bucket.copy_key
     #   probably via the awscli subproc directly.
     # For now, this will be faster than using copy_key() as boto would block
+    # Delta destinations (e.g. latest-*) are handled once the other
+    # destinations are uploaded, as they can be skipped or copied server-side
+    delta_destinations = get_delta_destinations(context, destinations) if metadata else []
+    copy_sources = [dest for dest in destinations if dest not in delta_destinations]
+
     uploads = []
-    for dest in destinations:
+    for dest in copy_sources:
         uploads.append(
             asyncio.ensure_future(
-                upload_to_s3(context=context, s3_key=dest, path=path)
+                upload_to_s3(context=context, s3_key=dest, path=path,
+                             metadata=metadata)
             )
         )
-    await raise_future_exceptions(uploads)
+    if uploads:
+        with cancelling(uploads):
+            await raise_future_exceptions(uploads)
+
+    updates = []
+    for dest in delta_destinations:
+        updates.append(
+            asyncio.ensure_future(
+                update_delta_destination(context=context, s3_key=dest, path=path,
+                                         metadata=metadata,
+                                         copy_source=copy_sources[0] if copy_sources else None)
+            )
+        )
+    if updates:
+        with cancelling(updates):
+            await raise_future_exceptions(updates)
 
 
 async def put(context, url, headers, abs_filename, session=None):
     session = session or context.session
-    with open(abs_filename, "rb") as fh:
-        async with session.put(url, data=fh, headers=headers, compress=False) as resp:
-            log.info("put {}: {}".format(abs_filename, resp.status))
-            response_text = await resp.text()
-            log.info(response_text)
+    rate_limiters = list(getattr(context, 'rate_limiters', None) or [])
+    meters = []
+    if getattr(context, 'progress', None) is not None:
+        meters = context.progress.get_meters(abs_filename)
+    with await run_in_executor(open, abs_filename, "rb") as fh:
+        data = fh
+        if rate_limiters:
+            # S3 doesn't accept chunked uploads, so the length of the
+            # throttled stream needs to be explicitly given
+            headers = dict(headers, **{'Content-Length': str(get_size(abs_filename))})
+            # the progress is counted along, as the chunks are read anyway
+            data = ThrottledFileReader(fh, rate_limiters + meters)
+        async with session.put(url, data=data, headers=headers, compress=False) as resp:
+            log.info("put %s: %s", abs_filename, resp.status,
+                     extra={'path': abs_filename, 'status': resp.status})
+            # S3 error details are only worth reading on failure
             if resp.status not in (200, 204):
+                log.warning(await resp.text())
                 raise ScriptWorkerRetryException(
                     "Bad status {}".format(resp.status),
                 )
+    # unthrottled files are sent as is, reading them by chunks only to count
+    # them would cost an executor hop each; they're counted once sent
+    if not rate_limiters:
+        await consume_meters(meters, abs_filename)
     return resp
 
 
-async def upload_to_s3(context, s3_key, path):
+async def consume_meters(meters, path):
+    if meters:
+        size = await run_in_executor(get_size, path)
+        for meter in meters:
+            await meter.consume(size)
+
+
+def get_bucket_config(context):
+    replica = getattr(context, 'replica', None)
+    return context.config['bucket_config'][context.bucket] if replica is None else replica
+
+
+def get_bucket_name(context):
     app = context.release_props['appName'].lower()
+    return get_bucket_config(context)['buckets'][app]
+
+
+def get_s3_client(context):
+    # creating a boto3 client is costly, only do it once per task
+    if getattr(context, 's3_client', None) is None:
+        bucket_config = get_bucket_config(context)
+        creds = bucket_config['credentials']
+        kwargs = {}
+        if bucket_config.get('region'):
+            kwargs['region_name'] = bucket_config['region']
+        # S3-compatible endpoints other than AWS, e.g. a local test server,
+        # are addressed by path rather than by virtual host
+        if bucket_config.get('endpoint_url'):
+            kwargs['endpoint_url'] = bucket_config['endpoint_url']
+            kwargs['config'] = botocore.config.Config(s3={'addressing_style': 'path'})
+        context.s3_client = boto3.client('s3', aws_access_key_id=creds['id'],
+                                         aws_secret_access_key=creds['key'], **kwargs)
+    return context.s3_client
+
+
+def get_transport(context):
+    """Return the S3 transport of the target bucket, if its bucket config
+    asks for one, or None to send requests through presigned URLs"""
+    if getattr(context, 'transport', None) is None:
+        context.transport = get_s3_transport(
+            context.session, get_bucket_config(context), get_bucket_name(context),
+            multipart_config=context.config.get('s3_multipart'),
+            rate_limiters=getattr(context, 'rate_limiters', None),
+            hedger=getattr(context, 'hedger', None),
+            progress=getattr(context, 'progress', None),
+        )
+    return context.transport
+
+
+def get_prewarm_urls(context):
+    """Return a presigned HEAD URL per S3 endpoint of the task bucket and of
+    its replicas. Creating their S3 clients is costly, hence done in an
+    executor, the targets keep them for their uploads."""
+    urls = {}
+    for target in context.targets:
+        bucket_config = get_bucket_config(target)
+        # local mirrors aren't reached through the network
+        if bucket_config.get('transport') == 'local':
+            continue
+        s3 = get_s3_client(target)
+        for bucket_name in sorted(set(bucket_config['buckets'].values())):
+            url = s3.generate_presigned_url('head_bucket', {'Bucket': bucket_name},
+                                            ExpiresIn=1800, HttpMethod='HEAD')
+            urls.setdefault(urllib.parse.urlsplit(url).netloc, url)
+    return urls
+
+
+async def prewarm_connections(context):
+    """Open `aiohttp_prewarm_connections` keep-alive connections to each S3
+    endpoint of the task bucket and its replicas, so that the first uploads
+    don't pay for the DNS resolution and TCP+TLS handshakes. This is best
+    effort only: any failure is logged and ignored."""
+    connections = context.config.get('aiohttp_prewarm_connections')
+    if not connections:
+        return
+
+    try:
+        urls = await run_in_executor(get_prewarm_urls, context)
+    except Exception as exc:
+        log.warning("Failed to prewarm connections: {}".format(exc))
+        return
+
+    async def _head(url):
+        async with context.session.head(url) as resp:
+            return resp.status
+
+    requests = [asyncio.ensure_future(_head(url))
+                for url in urls.values() for _ in range(connections)]
+    if not requests:
+        return
+    done, pending = await asyncio.wait(requests, timeout=PREWARM_TIMEOUT)
+    for request in pending:
+        request.cancel()
+    failures = [request for request in done if request.exception()]
+    log.info("Prewarmed {} connection(s) to {}".format(
+        len(done) - len(failures), ', '.join(sorted(urls))
+    ))
+    for request in failures:
+        log.warning("Failed to prewarm connection: {}".format(request.exception()))
+
+
+async def upload_to_s3(context, s3_key, path, metadata=None):
+    content_type = mimetypes.guess_type(path)[0]
+    compression = get_compression(context, path)
+
+    if compression == COMPRESSION_CONTENT_ENCODING:
+        compressed_path = await compress_artifact(context, path)
+        await put_to_s3(context, s3_key, compressed_path, content_type,
+                        metadata=metadata, content_encoding='gzip')
+    else:
+        await put_to_s3(context, s3_key, path, content_type, metadata=metadata)
+        if compression == COMPRESSION_SIDECAR:
+            compressed_path = await compress_artifact(context, path)
+            await put_to_s3(context, '{}.gz'.format(s3_key), compressed_path,
+                            'application/gzip')
+
+
+async def put_to_s3(context, s3_key, path, content_type, metadata=None,
+                    content_encoding=None):
     api_kwargs = {
-        'Bucket': context.config['bucket_config'][context.bucket]['buckets'][app],
+        'Bucket': get_bucket_name(context),
         'Key': s3_key,
-        'ContentType': mimetypes.guess_type(path)[0]
+        'ContentType': content_type
     }
     headers = {
-        'Content-Type': mimetypes.guess_type(path)[0],
+        'Content-Type': content_type,
         'Cache-Control': 'public, max-age=%d' % CACHE_CONTROL_MAXAGE,
     }
-    creds = context.config['bucket_config'][context.bucket]['credentials']
-    s3 = boto3.client('s3', aws_access_key_id=creds['id'], aws_secret_access_key=creds['key'],)
+    if content_encoding:
+        api_kwargs['ContentEncoding'] = content_encoding
+        headers['Content-Encoding'] = content_encoding
+    if metadata:
+        api_kwargs['Metadata'] = metadata
+        headers.update({
+            '{}{}'.format(S3_METADATA_PREFIX, key): value for key, value in metadata.items()
+        })
+    transport = get_transport(context)
+    if transport is not None:
+        await retry_async(transport.put_object, args=(s3_key, path, headers),
+                          retry_exceptions=RETRY_EXCEPTIONS)
+        return
+
+    s3 = get_s3_client(context)
     url = s3.generate_presigned_url('put_object', api_kwargs, ExpiresIn=1800, HttpMethod='PUT')
 
+    hedger = getattr(context, 'hedger', None)
+    if hedger is not None:
+        await retry_async(hedger.run, args=(get_size(path), put, context, url, headers, path),
+                          retry_exceptions=(Exception, ),
+                          kwargs={'session': context.session})
+        return
+
     await retry_async(put, args=(context, url, headers, path),
                       retry_exceptions=(Exception, ),
                       kwargs={'session': context.session})
 
 
+async def copy(context, url, headers, session=None):
+    session = session or context.session
+    async with session.put(url, headers=headers) as resp:
+        log.info("copy %s: %s", headers['x-amz-copy-source'], resp.status,
+                 extra={'copy_source': headers['x-amz-copy-source'], 'status': resp.status})
+        response_text = await resp.text()
+        # S3 may answer a copy request with a 200 and an error in the body
+        if resp.status not in (200, 204) or '<Error>' in response_text:
+            log.warning(response_text)
+            raise ScriptWorkerRetryException(
+                "Bad status {}".format(resp.status),
+            )
+    return resp
+
+
+async def copy_in_s3(context, source_key, s3_key, metadata=None, content_type=None):
+    bucket = get_bucket_name(context)
+    api_kwargs = {
+        'Bucket': bucket,
+        'Key': s3_key,
+        'CopySource': {'Bucket': bucket, 'Key': source_key},
+    }
+    headers = {
+        'x-amz-copy-source': '{}/{}'.format(bucket, urllib.parse.quote(source_key)),
+    }
+    if metadata is not None:
+        # the metadata of the source object is replaced rather than copied,
+        # which also allows to copy an object onto itself
+        api_kwargs.update({
+            'MetadataDirective': 'REPLACE',
+            'Metadata': metadata,
+            'CacheControl': 'public, max-age=%d' % CACHE_CONTROL_MAXAGE,
+        })
+        headers.update({
+            'x-amz-metadata-directive': 'REPLACE',
+            'Cache-Control': 'public, max-age=%d' % CACHE_CONTROL_MAXAGE,
+        })
+        headers.update({
+            '{}{}'.format(S3_METADATA_PREFIX, key): value for key, value in metadata.items()
+        })
+        if content_type:
+            api_kwargs['ContentType'] = content_type
+            headers['Content-Type'] = content_type
+    transport = get_transport(context)
+    if transport is not None:
+        await retry_async(transport.copy_object, args=(s3_key, source_key, headers),
+                          retry_exceptions=RETRY_EXCEPTIONS)
+        return
+
+    s3 = get_s3_client(context)
+    url = s3.generate_presigned_url('copy_object', api_kwargs, ExpiresIn=1800, HttpMethod='PUT')
+
+    await retry_async(copy, args=(context, url, headers),
+                      retry_exceptions=(Exception, ),
+                      kwargs={'session': context.session})
+
+
+async def head_s3_object(context, s3_key):
+    transport = get_transport(context)
+    if transport is not None:
+        return await transport.head_object(s3_key)
+
+    api_kwargs = {
+        'Bucket': get_bucket_name(context),
+        'Key': s3_key,
+    }
+    s3 = get_s3_client(context)
+    url = s3.generate_presigned_url('head_object', api_kwargs, ExpiresIn=1800, HttpMethod='HEAD')
+    async with context.session.head(url) as resp:
+        return resp
+
+
+async def get_s3_object_body(context, s3_key):
+    transport = get_transport(context)
+    if transport is not None:
+        _, body = await transport.get_object(s3_key)
+        return body
+
+    api_kwargs = {
+        'Bucket': get_bucket_name(context),
+        'Key': s3_key,
+    }
+    s3 = get_s3_client(context)
+    url = s3.generate_presigned_url('get_object', api_kwargs, ExpiresIn=1800, HttpMethod='GET')
+    async with context.session.get(url) as resp:
+        if resp.status != 200:
+            raise ScriptWorkerRetryException(
+                "GET {} failed: status {}".format(s3_key, resp.status)
+            )
+        return await resp.read()
+
+
+# replication {{{1
+class ReplicaContext(object):
+    """Context of a replica bucket, pointing to its own bucket config, S3
+    client and transport. Anything else, e.g. the session, checksums and
+    manifests, is looked up on the task context, even if it's set after the
+    replica context was made."""
+
+    def __init__(self, context, replica):
+        self.task_context = context
+        self.replica = replica
+        self.s3_client = None
+        self.transport = None
+        # server-side copies can't cross buckets
+        self.uploaded_contents = dict()
+
+    def __getattr__(self, name):
+        return getattr(self.task_context, name)
+
+
+def get_targets(context):
+    """Return a context per bucket the artifacts are uploaded to, the task
+    bucket first, then a ReplicaContext per replica"""
+    targets = [context]
+    for replica in context.config['bucket_config'][context.bucket].get('replicas', []):
+        targets.append(ReplicaContext(context, replica))
+    return targets
+
+
+def get_target_name(context):
+    replica = getattr(context, 'replica', None)
+    return context.bucket if replica is None else replica['name']
+
+
+async def replicate(context, targets, func, *args):
+    """Run `func(target, *args)` against every target concurrently. All of
+    them need to succeed, unless the `replication_policy` of the bucket
+    config is `quorum`: failures of a minority of the replicas are then only
+    logged. The task bucket, which balrog points to, is always required."""
+    futures = [asyncio.ensure_future(func(target, *args)) for target in targets]
+    with cancelling(futures):
+        await asyncio.wait(futures)
+    check_replication(context, targets, [future.exception() for future in futures])
+
+
+def check_replication(context, targets, exceptions):
+    """Raise the first of the exceptions met by each target, if any, unless
+    the replication policy tolerates them. With a single replica, `quorum`
+    behaves like `all`: its failure is that of half of the targets."""
+    failures = [(target, exc) for target, exc in zip(targets, exceptions) if exc is not None]
+    if not failures:
+        return
+
+    bucket_config = context.config['bucket_config'][context.bucket]
+    policy = bucket_config.get('replication_policy', REPLICATION_ALL)
+    if policy == REPLICATION_QUORUM and exceptions[0] is None and \
+            len(failures) < len(targets) / 2:
+        for target, exc in failures:
+            log.warning("Failed to replicate to {}: {}".format(get_target_name(target), exc))
+        return
+    raise failures[0][1]
+
+
+# server-side promotion {{{1
+def list_objects(s3, bucket_name, prefix, delimiter=None):
+    """Paginate through a ListObjectsV2 listing. Returns the objects found,
+    keyed by S3 key, and the common prefixes if a delimiter is given"""
+    objects = {}
+    common_prefixes = []
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj
+        common_prefixes.extend([p['Prefix'] for p in page.get('CommonPrefixes', [])])
+    return objects, common_prefixes
+
+
+async def list_s3_objects(s3, bucket_name, prefix, executor=None):
+    """List all the objects under a prefix. The first level of directories
+    is listed with a delimiter, then each of them is paginated through
+    concurrently, in the given executor if any."""
+    objects, common_prefixes = await run_in_pool(
+        executor, list_objects, s3, bucket_name, prefix, delimiter='/'
+    )
+    listings = []
+    for common_prefix in common_prefixes:
+        listings.append(
+            asyncio.ensure_future(
+                run_in_pool(executor, list_objects, s3, bucket_name, common_prefix)
+            )
+        )
+    if listings:
+        for sub_objects, _ in await raise_future_exceptions(listings):
+            objects.update(sub_objects)
+    return objects
+
+
+def get_copy_plan(candidates, releases, candidates_prefix, releases_prefix, excludes):
+    """Determine the list of (source key, destination key, size, compare
+    digests) to copy. Excluded files are left aside, as well as the ones
+    that already exist with the same size and ETag in the releases
+    directory. ETags of objects copied by parts differ from their source
+    ones, the digests stored along them need to be compared instead, see
+    `is_same_object`."""
+    copy_plan = []
+    for source_key, obj in sorted(candidates.items()):
+        if matches_exclude(source_key, excludes):
+            continue
+        dest_key = releases_prefix + source_key[len(candidates_prefix):]
+        existing = releases.get(dest_key)
+        if existing and existing['Size'] == obj['Size'] and existing['ETag'] == obj['ETag']:
+            log.debug("%s already exists, skipping", dest_key)
+            continue
+        compare_digests = bool(existing) and existing['Size'] == obj['Size'] and \
+            '-' in existing['ETag'] + obj['ETag']
+        copy_plan.append((source_key, dest_key, obj['Size'], compare_digests))
+    return copy_plan
+
+
+def is_same_object(s3, bucket_name, source_key, dest_key):
+    """Whether both objects hold the same digests as metadata. Objects
+    without any can't be told apart from stale ones."""
+    source = s3.head_object(Bucket=bucket_name, Key=source_key).get('Metadata', {})
+    dest = s3.head_object(Bucket=bucket_name, Key=dest_key).get('Metadata', {})
+    digests = [algo for algo in source if algo in hashlib.algorithms_available]
+    return bool(digests) and all(source[algo] == dest.get(algo) for algo in digests)
+
+
+def copy_object(s3, bucket_name, source_key, dest_key, size, compare_digests=False):
+    """Copy an S3 object server-side, by parts if it's too big for a single
+    CopyObject call. If `compare_digests` is set, the copy is skipped if the
+    destination already holds the same digests as the source."""
+    if compare_digests and is_same_object(s3, bucket_name, source_key, dest_key):
+        log.debug("%s already exists, skipping", dest_key)
+        return
+    log.info("copying %s to %s", source_key, dest_key)
+    copy_source = {'Bucket': bucket_name, 'Key': source_key}
+    if size <= MAX_COPY_OBJECT_SIZE:
+        s3.copy_object(Bucket=bucket_name, Key=dest_key, CopySource=copy_source,
+                       MetadataDirective='COPY')
+        return
+    # multipart copies don't carry over the source headers and metadata
+    head = s3.head_object(Bucket=bucket_name, Key=source_key)
+    extra_args = {
+        'ContentType': head['ContentType'],
+        'Metadata': head.get('Metadata', {}),
+    }
+    if head.get('CacheControl'):
+        extra_args['CacheControl'] = head['CacheControl']
+    s3.copy(copy_source, bucket_name, dest_key, ExtraArgs=extra_args)
+
+
+async def copy_s3_object(s3, bucket_name, source_key, dest_key, size, executor,
+                         compare_digests=False):
+    """Copy an S3 object in the executor of the promotion, which bounds how
+    many copies run at once"""
+    await retry_async(run_in_pool,
+                      args=(executor, copy_object, s3, bucket_name, source_key, dest_key, size),
+                      kwargs={'compare_digests': compare_digests},
+                      retry_exceptions=(Exception, ))
+
+
+# delta uploads {{{1
+def get_delta_destinations(context, destinations):
+    """Return the destinations matching any of the `delta_upload_patterns`
+    from the script configs, e.g. the `latest-*` nightly directories"""
+    patterns = context.config.get('delta_upload_patterns', [])
+    return [dest for dest in destinations
+            if any(pattern in dest for pattern in patterns)]
+
+
+def is_unchanged_object(context, headers, path, metadata):
+    """Compare the digests stored as metadata along an S3 object, as well as
+    its encoding, with the ones of the file that is about to be uploaded"""
+    for algo, digest in metadata.items():
+        if headers.get('{}{}'.format(S3_METADATA_PREFIX, algo)) != digest:
+            return False
+    is_encoded = get_compression(context, path) == COMPRESSION_CONTENT_ENCODING
+    return bool(headers.get('Content-Encoding')) == is_encoded
+
+
+async def update_delta_destination(context, s3_key, path, metadata, copy_source=None):
+    """Skip the upload if the S3 object already holds identical contents.
+    Otherwise copy it server-side from one of the freshly uploaded
+    destinations, only falling back to an actual upload if there's none."""
+    resp = await head_s3_object(context, s3_key)
+    if resp.status == 200 and is_unchanged_object(context, resp.headers, path, metadata):
+        log.info("%s is unchanged, skipping upload", s3_key)
+        return
+
+    if copy_source is None:
+        await upload_to_s3(context=context, s3_key=s3_key, path=path, metadata=metadata)
+        return
+
+    await copy_destination(context, copy_source, s3_key, path)
+
+
+async def copy_destination(context, copy_source, s3_key, path):
+    """Server-side copy of an uploaded artifact, along with its
+    precompressed sidecar if any"""
+    await copy_in_s3(context, copy_source, s3_key)
+    if get_compression(context, path) == COMPRESSION_SIDECAR:
+        await copy_in_s3(context, '{}.gz'.format(copy_source), '{}.gz'.format(s3_key))
+
+
+# streaming {{{1
+def is_streamable(context, source, destinations, targets):
+    """Artifacts are streamed unless they're served with a Content-Encoding,
+    S3 needing their decoded size upfront, or they'd need more uploads at
+    once than the task session has connections"""
+    if source.encoding:
+        return False
+    slots = getattr(context, 'stream_slots', None)
+    return slots is None or len(destinations) * len(targets) <= slots.size
+
+
+async def download_beet(context, source, destinations, targets):
+    """Download an upstream artifact that can't be streamed to the work_dir
+    and upload it from there like the other artifacts. Returns the checksums
+    of the artifact."""
+    download_dir = await run_in_executor(tempfile.mkdtemp, dir=context.config['work_dir'])
+    # the name of the file tells its mime type and whether it's compressed
+    path = os.path.join(download_dir, os.path.basename(source.path))
+    try:
+        await retry_async(download_artifact, args=(context, source, path),
+                          retry_exceptions=(Exception, ))
+        checksums = await get_checksums(context, path)
+        sha256 = checksums.get('sha256') or await run_in_executor(get_hash, path, 'sha256')
+        check_trusted_digest(source, sha256)
+        if getattr(context, 'progress', None) is not None:
+            context.progress.watch_file(path, checksums['size'], source)
+        metadata = {algo: checksums[algo] for algo in context.config['checksums_digests']}
+        await replicate(context, targets, upload_beet, path, destinations, metadata)
+    finally:
+        await run_in_executor(shutil.rmtree, download_dir, ignore_errors=True)
+    return checksums
+
+
+async def stream_beet(context, source, destinations, targets):
+    """Stream an upstream artifact from the artifact store to all its
+    destinations, in all the target buckets at once, without staging it in
+    the work_dir. The digests are only known once the whole artifact went
+    through, they are then stored as metadata by copying each object onto
+    itself. Returns the checksums of the artifact."""
+    streaming_config = context.config['artifact_streaming']
+    fd, spill_path = tempfile.mkstemp(dir=context.config['work_dir'])
+    os.close(fd)
+    spill = SpillFile(spill_path, streaming_config.get('spill_max_size', STREAM_SPILL_MAX_SIZE))
+    uploads = [(target, dest) for target in targets for dest in destinations]
+
+    try:
+        checksums, failed = await retry_async(stream_to_s3, args=(context, source, uploads, spill),
+                                              retry_exceptions=(Exception, ))
+        await replicate(context, targets, complete_streamed_target, source, destinations,
+                        failed, spill, checksums)
+    finally:
+        await spill.discard()
+    return checksums
+
+
+async def complete_streamed_target(context, source, destinations, failed, spill, checksums):
+    """Store the digests along the objects streamed to a target bucket, and
+    upload again to the destinations that failed, from the local copy of the
+    artifact if it could be kept"""
+    content_type = mimetypes.guess_type(source.path)[0]
+    metadata = {algo: checksums[algo] for algo in context.config['checksums_digests']}
+    failed_destinations = [dest for target, dest in failed if target is context]
+
+    updates = []
+    for dest in destinations:
+        if dest not in failed_destinations:
+            updates.append(asyncio.ensure_future(
+                set_streamed_metadata(context, dest, metadata, content_type, checksums['size'])
+            ))
+    if failed_destinations and spill.complete:
+        log.info("Uploading {} to {} from its local copy".format(source, ', '.join(failed_destinations)))
+        for dest in failed_destinations:
+            updates.append(asyncio.ensure_future(
+                put_to_s3(context, dest, spill.path, content_type, metadata=metadata)
+            ))
+    elif failed_destinations:
+        updates.append(asyncio.ensure_future(
+            retry_async(restream_to_s3, args=(context, source, failed_destinations, checksums),
+                        retry_exceptions=RETRY_EXCEPTIONS)
+        ))
+    if updates:
+        with cancelling(updates):
+            await raise_future_exceptions(updates)
+
+
+async def restream_to_s3(context, source, destinations, checksums):
+    """Download the artifact again for the destinations it failed to be
+    streamed to, when it was too big to be kept on disk"""
+    content_type = mimetypes.guess_type(source.path)[0]
+    restreamed, failed = await stream_to_s3(context, source,
+                                            [(context, dest) for dest in destinations], None)
+    if restreamed != checksums:
+        raise ScriptWorkerTaskException("{} changed while being streamed".format(source))
+    if failed:
+        raise ScriptWorkerRetryException(
+            "Failed to stream {} to {}".format(source, ', '.join([dest for _, dest in failed]))
+        )
+    metadata = {algo: checksums[algo] for algo in context.config['checksums_digests']}
+    updates = [
+        asyncio.ensure_future(
+            set_streamed_metadata(context, dest, metadata, content_type, checksums['size'])
+        ) for dest in destinations
+    ]
+    with cancelling(updates):
+        await raise_future_exceptions(updates)
+
+
+async def stream_to_s3(context, source, uploads, spill):
+    """Download the artifact once, teeing its chunks into the digests, the
+    spill file if any, and each of the `uploads`, given as (target context,
+    destination) pairs. The download goes at the pace of the slowest upload.
+    Returns the checksums of the artifact along with the uploads that
+    failed."""
+    slots = getattr(context, 'stream_slots', None)
+    if slots is not None:
+        await slots.acquire(len(uploads))
+    try:
+        return await _stream_to_s3(context, source, uploads, spill)
+    finally:
+        if slots is not None:
+            slots.release(len(uploads))
+
+
+async def _stream_to_s3(context, source, uploads, spill):
+    # the sha256 is needed to check the artifact against its chain of trust
+    algorithms = set(context.config['checksums_digests']) | {'sha256'}
+    digests = {algo: hashlib.new(algo) for algo in algorithms}
+    content_type = mimetypes.guess_type(source.path)[0]
+    rate_limiters = getattr(context, 'rate_limiters', None)
+    if spill is not None:
+        await spill.reset()
+
+    async with get_download_session(context).get(source.url) as resp:
+        if resp.status != 200:
+            raise ScriptWorkerRetryException(
+                "Bad status {} downloading {}".format(resp.status, source)
+            )
+        if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            raise ScriptWorkerRetryException(
+                "{} is now served with a Content-Encoding, it can't be streamed".format(source)
+            )
+        # S3 doesn't accept chunked uploads
+        size = resp.content_length or source.size
+        if size is None:
+            raise ScriptWorkerRetryException("Unknown size of {}".format(source))
+
+        buckets = list(rate_limiters or [])
+        if getattr(context, 'progress', None) is not None:
+            context.progress.watch_file(source.url, size, source)
+            buckets += context.progress.get_meters(source.url)
+        queues = [ChunkQueue(buckets) for _ in uploads]
+        puts = [
+            asyncio.ensure_future(put_stream_to_s3(target, dest, content_type, size, queue))
+            for (target, dest), queue in zip(uploads, queues)
+        ]
+        received = 0
+        # the last chunk is held back until the artifact is known to be the
+        # trusted one, S3 doesn't create the objects before getting all of it
+        pending = None
+        try:
+            async for chunk in resp.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                for digest in digests.values():
+                    digest.update(chunk)
+                if spill is not None:
+                    await spill.write(chunk)
+                if pending is not None:
+                    for queue in queues:
+                        await queue.put(pending)
+                pending = chunk
+            if received != size:
+                raise ScriptWorkerRetryException(
+                    "Truncated download of {}: {} of {} bytes".format(source, received, size)
+                )
+            check_trusted_digest(source, digests['sha256'].hexdigest())
+        except BaseException:
+            for put in puts:
+                put.cancel()
+            if spill is not None:
+                await spill.discard()
+            raise
+        for queue in queues:
+            if pending is not None:
+                await queue.put(pending)
+            await queue.put(None)
+
+    if spill is not None:
+        await spill.close()
+    with cancelling(puts):
+        await asyncio.wait(puts)
+    failed = []
+    for (target, dest), put in zip(uploads, puts):
+        if put.exception() is not None:
+            log.warning("Failed to stream {} to {} in {}: {}".format(
+                source, dest, get_target_name(target), put.exception()
+            ))
+            failed.append((target, dest))
+
+    checksums = {algo: digests[algo].hexdigest() for algo in context.config['checksums_digests']}
+    checksums['size'] = size
+    return checksums, failed
+
+
+async def put_stream_to_s3(context, s3_key, content_type, size, chunks):
+    api_kwargs = {
+        'Bucket': get_bucket_name(context),
+        'Key': s3_key,
+        'ContentType': content_type
+    }
+    headers = {
+        'Content-Type': content_type,
+        'Cache-Control': 'public, max-age=%d' % CACHE_CONTROL_MAXAGE,
+        'Content-Length': str(size),
+    }
+    transport = get_transport(context)
+    if transport is not None:
+        try:
+            resp, _ = await transport.put_object_stream(s3_key, chunks, size, headers)
+        finally:
+            chunks.close()
+        return resp
+
+    s3 = get_s3_client(context)
+    url = s3.generate_presigned_url('put_object', api_kwargs, ExpiresIn=1800, HttpMethod='PUT')
+
+    try:
+        async with context.session.put(url, data=chunks, headers=headers, compress=False) as resp:
+            log.info("put %s: %s", s3_key, resp.status,
+                     extra={'s3_key': s3_key, 'status': resp.status})
+            if resp.status not in (200, 204):
+                log.warning(await resp.text())
+                raise ScriptWorkerRetryException(
+                    "Bad status {}".format(resp.status),
+                )
+    finally:
+        # don't hold the other uploads back if this one stopped early
+        chunks.close()
+    return resp
+
+
+async def set_streamed_metadata(context, s3_key, metadata, content_type, size):
+    if size > MAX_COPY_OBJECT_SIZE:
+        log.warning("{} is too big to be copied onto itself, leaving it without "
+                    "digests metadata".format(s3_key))
+        return
+    await copy_in_s3(context, s3_key, s3_key, metadata=metadata, content_type=content_type)
+
+
+# compression {{{1
+def get_compression(context, path):
+    """Determine from the script configs whether the file needs to be
+    compressed before upload and how. Returns None if it is uploaded as is"""
+    compression_config = context.config.get('compression')
+    if not compression_config:
+        return None
+    # clients don't all decode a Content-Encoding, files are only compressed
+    # if explicitly listed
+    if not matches_exclude(path, compression_config.get('files', [])):
+        return None
+    mime_types = compression_config.get('mime_types')
+    if mime_types is not None and mimetypes.guess_type(path)[0] not in mime_types:
+        return None
+    if get_size(path) < compression_config.get('min_size', 0):
+        return None
+    return compression_config.get('mode', COMPRESSION_CONTENT_ENCODING)
+
+
+async def compress_artifact(context, path):
+    """Gzip the file in a worker pool and return the compressed file path.
+    Each source is compressed only once, no matter how many destinations it
+    is uploaded to."""
+    if path not in context.compressed_artifacts:
+        if getattr(context, 'compression_executor', None) is None:
+            context.compression_executor = get_compression_executor(context)
+        fd, compressed_path = tempfile.mkstemp(suffix='.gz', dir=context.config['work_dir'])
+        os.close(fd)
+        loop = asyncio.get_event_loop()
+        context.compressed_artifacts[path] = (
+            compressed_path,
+            loop.run_in_executor(context.compression_executor, gzip_file, path, compressed_path)
+        )
+
+    compressed_path, compression = context.compressed_artifacts[path]
+    await compression
+    progress = getattr(context, 'progress', None)
+    if progress is not None and path in progress.files and compressed_path not in progress.files:
+        progress.watch_file(compressed_path, await run_in_executor(get_size, compressed_path), path)
+    return compressed_path
+
+
+def get_compression_executor(context):
+    compression_config = context.config.get('compression')
+    if not compression_config:
+        return None
+    return concurrent.futures.ThreadPoolExecutor(max_workers=compression_config.get('workers', 4))
+
+
+async def discard_compressed_artifacts(context):
+    """Wait for the compressions still running, then remove the compressed
+    files from the work_dir"""
+    executor = getattr(context, 'compression_executor', None)
+    if executor is not None:
+        await run_in_executor(executor.shutdown, True)
+        context.compression_executor = None
+    for compressed_path, _ in context.compressed_artifacts.values():
+        if os.path.exists(compressed_path):
+            await run_in_executor(os.remove, compressed_path)
+    context.compressed_artifacts.clear()
+
+
+# verification {{{1
+async def verify_beets(context, artifacts_to_beetmove, manifest):
+    """Concurrently check every uploaded destination against the computed
+    checksums. The whole stage runs under a time budget; objects that could
+    not be checked in time are only logged, while any mismatch fails the task
+    so that it gets rerun before balrog learns about the broken URLs."""
+    verification_config = context.config['upload_verification']
+    semaphore = asyncio.Semaphore(verification_config.get('max_concurrency', 10))
+    targets = getattr(context, 'targets', None) or [context]
+
+    checks = []
+    for target in targets:
+        for locale in artifacts_to_beetmove:
+            for artifact in artifacts_to_beetmove[locale]:
+                source = artifacts_to_beetmove[locale][artifact]
+                artifact_pretty_name = manifest['mapping'][locale][artifact]['s3_key']
+                for dest in manifest['mapping'][locale][artifact]['destinations']:
+                    checks.append((target, asyncio.ensure_future(
+                        verify_beet(target, os.path.join(manifest['s3_bucket_path'], dest),
+                                    source, artifact_pretty_name, semaphore)
+                    )))
+
+    futures = [check for _, check in checks]
+    _, unchecked = await asyncio.wait(futures, timeout=verification_config.get('timeout', 300))
+    if unchecked:
+        for check in unchecked:
+            check.cancel()
+        log.warning("Verification time budget exceeded, {} of {} destinations "
+                    "left unchecked".format(len(unchecked), len(checks)))
+
+    # the replicas are held to the same policy as their uploads
+    exceptions = []
+    for target in targets:
+        target_exceptions = [check.exception() for check_target, check in checks
+                             if check_target is target and check.done() and
+                             not check.cancelled() and check.exception() is not None]
+        exceptions.append(target_exceptions[0] if target_exceptions else None)
+    check_replication(context, targets, exceptions)
+
+
+async def verify_beet(context, s3_key, source, artifact_pretty_name, semaphore):
+    expected = context.checksums[artifact_pretty_name]
+    full_get_max_size = context.config['upload_verification'].get(
+        'full_get_max_size', VERIFICATION_FULL_GET_MAX_SIZE
+    )
+
+    async with semaphore:
+        resp = await head_s3_object(context, s3_key)
+        if resp.status != 200:
+            raise ScriptWorkerRetryException(
+                "Verification of {} failed: HEAD status {}".format(s3_key, resp.status)
+            )
+        mismatches = get_object_mismatches(resp.headers, expected, context.config['checksums_digests'])
+
+        if not mismatches and expected['size'] <= full_get_max_size:
+            body = await get_s3_object_body(context, s3_key)
+            mismatches = get_body_mismatches(body, expected, context.config['checksums_digests'])
+
+    if mismatches:
+        # the digests may come from a stale cache entry, make sure the rerun
+        # computes them again
+        if context.digest_cache is not None and not isinstance(source, RemoteArtifact):
+            await run_in_executor(context.digest_cache.invalidate, source)
+        raise ScriptWorkerRetryException(
+            "Verification of {} failed: {}".format(s3_key, ', '.join(mismatches))
+        )
+    log.info("verified %s", s3_key, extra={'s3_key': s3_key})
+
+
+def get_object_mismatches(headers, expected, algorithms):
+    """Compare the HEAD response headers of an S3 object with the expected
+    size and digests. Returns a list of human readable mismatches."""
+    mismatches = []
+    # objects stored with a Content-Encoding have a different size and MD5
+    # than the contents they decode to
+    if not headers.get('Content-Encoding'):
+        size = headers.get('Content-Length')
+        if size is not None and int(size) != expected['size']:
+            mismatches.append("size {} != {}".format(size, expected['size']))
+
+        # ETags of multipart uploads are not a plain MD5 of the contents
+        etag = headers.get('ETag', '').strip('"')
+        if 'md5' in expected and etag and '-' not in etag and etag != expected['md5']:
+            mismatches.append("etag {} != {}".format(etag, expected['md5']))
+
+    for algo in algorithms:
+        stored = headers.get('{}{}'.format(S3_METADATA_PREFIX, algo))
+        if stored is not None and stored != expected[algo]:
+            mismatches.append("{} metadata {} != {}".format(algo, stored, expected[algo]))
+    return mismatches
+
+
+def get_body_mismatches(body, expected, algorithms):
+    """Compare the digests of a downloaded S3 object with the expected ones.
+    Returns a list of human readable mismatches."""
+    mismatches = []
+    for algo in algorithms:
+        digest = hashlib.new(algo, body).hexdigest()
+        if digest != expected[algo]:
+            mismatches.append("{} {} != {}".format(algo, digest, expected[algo]))
+    return mismatches
+
+
 # main {{{1
 def usage():
     print("Usage: {} CONFIG_FILE".format(sys.argv[0]), file=sys.stderr)
@@ -242,15 +1389,6 @@ def setup_config(config_path):
     return context
 
 
-def setup_logging():
-    log_level = logging.DEBUG
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=log_level
-    )
-    logging.getLogger("taskcluster").setLevel(logging.WARNING)
-
-
 def setup_mimetypes():
     mimetypes.init()
     # in py3 we must exhaust the map so that add_type is actually invoked
@@ -263,19 +1401,26 @@ def main(name=None, config_path=None):
     if name not in (None, '__main__'):
         return
     context = setup_config(config_path)
-    setup_logging()
+    log_listener = setup_logging(context.config)
     setup_mimetypes()
 
     loop = asyncio.get_event_loop()
-    conn = aiohttp.TCPConnector(limit=context.config['aiohttp_max_connections'])
-    with aiohttp.ClientSession(connector=conn) as session:
-        context.session = session
-        try:
-            loop.run_until_complete(async_main(context))
-        except ScriptWorkerTaskException as exc:
-            traceback.print_exc()
-            sys.exit(exc.exit_code)
-    loop.close()
+    conn = get_tcp_connector(context.config)
+    try:
+        with aiohttp.ClientSession(connector=conn) as session:
+            context.session = session
+            try:
+                if is_profiling_enabled(context):
+                    loop.run_until_complete(run_profiled(context, async_main(context)))
+                else:
+                    loop.run_until_complete(async_main(context))
+            except ScriptWorkerTaskException as exc:
+                traceback.print_exc()
+                sys.exit(exc.exit_code)
+        loop.close()
+    finally:
+        # flush the records still in the queue
+        log_listener.stop()
 
 
 main(name=__name__)
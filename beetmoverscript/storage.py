@@ -0,0 +1,264 @@
+import email.utils
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import uuid
+
+from multidict import CIMultiDict
+from scriptworker.exceptions import ScriptWorkerTaskException
+
+from beetmoverscript.constants import (LOCAL_LINK_METHODS, LOCAL_METADATA_DIR,
+                                       LOCAL_FILE_MODE, S3_METADATA_PREFIX)
+from beetmoverscript.utils import run_in_executor, load_json, write_json
+
+log = logging.getLogger(__name__)
+
+# ioctl cloning a whole file on filesystems sharing extents, e.g. btrfs or xfs
+FICLONE = 0x40049409
+# object headers kept by the storage backends, the others only matter to
+# the request they come with
+STORED_HEADERS = ('content-type', 'content-encoding', 'cache-control')
+
+
+class StorageBackend(object):
+    """Interface of where artifacts are published. Keys are relative to the
+    bucket the backend is bound to and headers are the S3 request headers,
+    e.g. Content-Type or x-amz-meta-*. Objects are returned as (response,
+    body) pairs, the response giving access to the status and headers.
+
+    The presigned S3 URLs sent with the task aiohttp session are the
+    fallback when the bucket config doesn't ask for any `transport`."""
+
+    async def put_object(self, key, path, headers):
+        raise NotImplementedError
+
+    async def put_object_stream(self, key, chunks, size, headers):
+        raise NotImplementedError
+
+    async def copy_object(self, key, source_key, headers=None):
+        raise NotImplementedError
+
+    async def head_object(self, key):
+        raise NotImplementedError
+
+    async def get_object(self, key):
+        raise NotImplementedError
+
+
+class LocalObject(object):
+    """Response of a local storage backend, mimicking the parts of an aiohttp
+    response the uploads and their verification look at"""
+
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = CIMultiDict(headers or {})
+
+    @property
+    def content_length(self):
+        length = self.headers.get('Content-Length')
+        return None if length is None else int(length)
+
+
+class LocalFilesystemBackend(StorageBackend):
+    """Publish artifacts to a directory tree, e.g. an on-premise or NFS
+    mirror, laid out as `root`/bucket name/key. Files are hardlinked or
+    reflinked from the work_dir when the filesystem allows it, rather than
+    copied byte by byte, which makes publishing near-instant. The headers of
+    each object are kept as json under the `LOCAL_METADATA_DIR` of the root.
+
+    Objects are replaced atomically, never written in place, so that files
+    sharing their inode with a work_dir file or another object are never
+    altered. They are published with the `file_mode` of the mirror, files of
+    another mode, e.g. the private temporary files of the work_dir, are
+    not hardlinked then."""
+
+    def __init__(self, session, bucket_config, bucket_name, multipart_config=None,
+                 rate_limiters=None, hedger=None, progress=None):
+        self.root = bucket_config['root']
+        self.bucket_name = bucket_name
+        self.link_methods = bucket_config.get('link_methods', LOCAL_LINK_METHODS)
+        self.file_mode = bucket_config.get('file_mode', LOCAL_FILE_MODE)
+
+    def get_path(self, key, metadata=False):
+        if metadata:
+            base = os.path.join(self.root, LOCAL_METADATA_DIR, self.bucket_name)
+            path = os.path.join(base, '{}.json'.format(key))
+        else:
+            base = os.path.join(self.root, self.bucket_name)
+            path = os.path.join(base, key)
+        path = os.path.normpath(path)
+        if not path.startswith(base + os.sep):
+            raise ScriptWorkerTaskException("Forbidden key {}".format(key))
+        return path
+
+    async def put_object(self, key, path, headers):
+        method = await run_in_executor(self._publish, key, path, get_stored_headers(headers))
+        log.info("published %s to %s (%s)", path, key, method,
+                 extra={'s3_key': key, 'link_method': method})
+        return LocalObject(200), b''
+
+    async def put_object_stream(self, key, chunks, size, headers):
+        dest = self.get_path(key)
+        tmp = get_temporary_path(dest)
+        await run_in_executor(os.makedirs, os.path.dirname(dest), exist_ok=True)
+        received = 0
+        try:
+            with await run_in_executor(open, tmp, 'wb') as fh:
+                async for chunk in chunks:
+                    received += len(chunk)
+                    await run_in_executor(fh.write, chunk)
+            if received != size:
+                raise ScriptWorkerTaskException(
+                    "Truncated stream to {}: {} of {} bytes".format(key, received, size)
+                )
+            await run_in_executor(self._commit, key, tmp, dest, get_stored_headers(headers))
+        except BaseException:
+            remove_file(tmp)
+            raise
+        log.info("published stream to %s", key, extra={'s3_key': key})
+        return LocalObject(200), b''
+
+    async def copy_object(self, key, source_key, headers=None):
+        headers = headers or {}
+        source = self.get_path(source_key)
+        if not await run_in_executor(os.path.exists, source):
+            raise ScriptWorkerTaskException("Copy source {} does not exist".format(source_key))
+        if headers.get('x-amz-metadata-directive') == 'REPLACE':
+            stored_headers = get_stored_headers(headers)
+        else:
+            stored_headers = await run_in_executor(self._read_headers, source_key)
+
+        if key == source_key:
+            await run_in_executor(self._write_headers, key, stored_headers)
+        else:
+            await run_in_executor(self._publish, key, source, stored_headers)
+        return LocalObject(200), b''
+
+    async def head_object(self, key):
+        return await run_in_executor(self._head, key)
+
+    async def get_object(self, key):
+        resp = await self.head_object(key)
+        if resp.status != 200:
+            raise ScriptWorkerTaskException("GET {} failed: NoSuchKey".format(key))
+        with await run_in_executor(open, self.get_path(key), 'rb') as fh:
+            body = await run_in_executor(fh.read)
+        return resp, body
+
+    def _publish(self, key, path, headers):
+        dest = self.get_path(key)
+        tmp = get_temporary_path(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        link_methods = self.link_methods
+        if stat.S_IMODE(os.stat(path).st_mode) != self.file_mode:
+            # hardlinks share the mode of their source, which can't be
+            # changed without altering it
+            link_methods = [method for method in link_methods if method != 'hardlink'] or ['copy']
+        try:
+            method = link_file(path, tmp, link_methods)
+            self._commit(key, tmp, dest, headers)
+        except BaseException:
+            remove_file(tmp)
+            raise
+        return method
+
+    def _commit(self, key, tmp, dest, headers):
+        # the headers go first, so that a published file always comes with
+        # its digests
+        self._write_headers(key, headers)
+        os.chmod(tmp, self.file_mode)
+        os.replace(tmp, dest)
+
+    def _head(self, key):
+        path = self.get_path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return LocalObject(404)
+        headers = self._read_headers(key)
+        headers['Content-Length'] = str(stat.st_size)
+        headers['Last-Modified'] = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        return LocalObject(200, headers)
+
+    def _read_headers(self, key):
+        path = self.get_path(key, metadata=True)
+        if not os.path.exists(path):
+            return {}
+        return load_json(path)
+
+    def _write_headers(self, key, headers):
+        path = self.get_path(key, metadata=True)
+        tmp = get_temporary_path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json(tmp, headers)
+        os.replace(tmp, path)
+
+
+def get_stored_headers(headers):
+    return {
+        name: value for name, value in headers.items()
+        if value is not None and (name.lower() in STORED_HEADERS or
+                                  name.lower().startswith(S3_METADATA_PREFIX))
+    }
+
+
+def get_temporary_path(path):
+    return os.path.join(os.path.dirname(path),
+                        '.{}.{}'.format(os.path.basename(path), uuid.uuid4().hex))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def hardlink(source, dest):
+    os.link(source, dest)
+
+
+def reflink(source, dest):
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_file_range(source, dest):
+    """In-kernel copy, which NFS and some other filesystems offload to the
+    server or turn into a clone"""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, "copy_file_range stopped early")
+            remaining -= copied
+
+
+LINK_METHODS = {
+    'hardlink': hardlink,
+    'reflink': reflink,
+    'copy_file_range': copy_file_range,
+    'copy': shutil.copyfile,
+}
+
+
+def link_file(source, dest, methods=LOCAL_LINK_METHODS):
+    """Make `dest` hold the contents of `source` with the first of the
+    methods supported by the filesystems, e.g. hardlinks don't cross
+    filesystems and reflinks need extents to be shareable. Returns the name
+    of the method used."""
+    for method in methods[:-1]:
+        try:
+            LINK_METHODS[method](source, dest)
+            return method
+        except OSError as exc:
+            log.debug("%s of %s failed: %s", method, source, exc)
+            remove_file(dest)
+    LINK_METHODS[methods[-1]](source, dest)
+    return methods[-1]
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import os
+import zlib
+
+import aiohttp
+from scriptworker.exceptions import ScriptWorkerTaskException, ScriptWorkerRetryException
+from scriptworker.utils import raise_future_exceptions
+
+from beetmoverscript.constants import (CHAIN_OF_TRUST_ARTIFACT, STREAM_QUEUE_SIZE,
+                                       UPLOAD_CHUNK_SIZE)
+from beetmoverscript.utils import run_in_executor, get_tcp_connector, load_json
+
+log = logging.getLogger(__name__)
+
+
+class RemoteArtifact(object):
+    """Upstream artifact that hasn't been downloaded to the work_dir, and is
+    streamed from the artifact store to S3 instead. `size` and `encoding`
+    are only known once the artifact store has been asked about them, see
+    `stat_remote_artifacts`. The size is the one on the wire, which differs
+    from the one of the artifact if it's served with a Content-Encoding.
+    `sha256` is the digest the chain of trust of the upstream task lists for
+    the artifact, see `check_trusted_digest`."""
+
+    def __init__(self, url, path, task_id=None):
+        self.url = url
+        self.path = path
+        self.task_id = task_id
+        self.size = None
+        self.encoding = None
+        self.sha256 = None
+
+    def __str__(self):
+        return self.url
+
+    def __repr__(self):
+        return '<RemoteArtifact {}>'.format(self.url)
+
+
+class ChunkQueue(object):
+    """Async iterator over the chunks of a download, to be used as the body of
+    one of the uploads it's teed into. Chunks go through the rate limiters, if
+    any. Once closed, e.g. because its upload failed, the chunks put in the
+    queue are dropped so that the other uploads aren't held back."""
+
+    def __init__(self, buckets=None, maxsize=STREAM_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+        self.buckets = buckets or []
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.queue.get()
+        if chunk is None:
+            raise StopAsyncIteration
+        for bucket in self.buckets:
+            await bucket.consume(len(chunk))
+        return chunk
+
+    async def put(self, chunk):
+        if not self.closed:
+            await self.queue.put(chunk)
+
+    def close(self):
+        self.closed = True
+        # unblock the download if it's waiting for room in the queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class StreamSlots(object):
+    """Connections of the task session the streams may hold at once. All the
+    uploads a download is teed into need to be going for it to progress, so
+    a stream reserves a connection per upload before it starts. Reserving
+    them one stream at a time keeps streams holding part of what they need
+    from blocking each other."""
+
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = asyncio.Semaphore(size)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, count):
+        async with self.lock:
+            for _ in range(count):
+                await self.semaphore.acquire()
+
+    def release(self, count):
+        for _ in range(count):
+            self.semaphore.release()
+
+
+class SpillFile(object):
+    """Local copy of a streamed artifact, kept to retry failed uploads from
+    the disk rather than downloading the artifact again. The copy is given up
+    on as soon as it grows past `max_size`, so that streaming big artifacts
+    doesn't fill the disk up."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.fh = None
+        self.complete = False
+
+    async def reset(self):
+        await self.discard()
+        self.size = 0
+        if self.max_size:
+            self.fh = await run_in_executor(open, self.path, 'wb')
+
+    async def write(self, chunk):
+        if self.fh is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            log.info("{} is bigger than {} bytes, not keeping it on disk".format(
+                self.path, self.max_size
+            ))
+            await self.discard()
+            return
+        await run_in_executor(self.fh.write, chunk)
+
+    async def close(self):
+        if self.fh is not None:
+            await run_in_executor(self.fh.close)
+            self.fh = None
+            self.complete = True
+
+    async def discard(self):
+        if self.fh is not None:
+            await run_in_executor(self.fh.close)
+            self.fh = None
+        self.complete = False
+        if os.path.exists(self.path):
+            await run_in_executor(os.remove, self.path)
+
+
+def get_remote_artifact(context, taskid, path):
+    """Return a RemoteArtifact if the script configs allow to stream upstream
+    artifacts from the artifact store, None otherwise"""
+    streaming_config = context.config.get('artifact_streaming')
+    if not streaming_config:
+        return None
+    url = streaming_config['url_template'].format(taskId=taskid, path=path)
+    return RemoteArtifact(url, path, task_id=taskid)
+
+
+def get_stream_slots(context):
+    """Return the connection slots the streams share if upstream artifacts
+    are streamed, None otherwise"""
+    if not context.config.get('artifact_streaming'):
+        return None
+    return StreamSlots(context.config['aiohttp_max_connections'])
+
+
+def get_download_session(context):
+    """Session the artifacts are downloaded from the artifact store with. It
+    has a pool of its own, so that downloads never wait for connections held
+    by the uploads they feed. Bodies are read as sent, the sizes compared
+    with their Content-Length being the encoded ones."""
+    if getattr(context, 'download_session', None) is None:
+        context.download_session = aiohttp.ClientSession(
+            connector=get_tcp_connector(context.config), auto_decompress=False,
+            headers={'Accept-Encoding': 'identity'},
+        )
+    return context.download_session
+
+
+async def close_download_session(context):
+    if getattr(context, 'download_session', None) is not None:
+        await context.download_session.close()
+        context.download_session = None
+
+
+def get_decoder(encoding):
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    raise ScriptWorkerTaskException("Unsupported Content-Encoding {}".format(encoding))
+
+
+async def download_artifact(context, artifact, path):
+    """Download an upstream artifact to `path`, decoding it if it's served
+    with a Content-Encoding"""
+    async with get_download_session(context).get(artifact.url) as resp:
+        if resp.status != 200:
+            raise ScriptWorkerRetryException(
+                "Bad status {} downloading {}".format(resp.status, artifact)
+            )
+        encoding = resp.headers.get('Content-Encoding', 'identity').lower()
+        decoder = None if encoding == 'identity' else get_decoder(encoding)
+        received = 0
+        with await run_in_executor(open, path, 'wb') as fh:
+            async for chunk in resp.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                await run_in_executor(fh.write, chunk)
+            if decoder is not None:
+                await run_in_executor(fh.write, decoder.flush())
+        if resp.content_length is not None and received != resp.content_length:
+            raise ScriptWorkerRetryException(
+                "Truncated download of {}: {} of {} bytes".format(
+                    artifact, received, resp.content_length
+                )
+            )
+
+
+async def stat_remote_artifact(context, artifact):
+    async with get_download_session(context).head(artifact.url, allow_redirects=True) as resp:
+        if resp.status == 404:
+            raise ScriptWorkerTaskException(
+                "upstream artifact {} does not exist".format(artifact.url)
+            )
+        if resp.status != 200:
+            raise ScriptWorkerRetryException(
+                "could not get upstream artifact {}: status {}".format(artifact.url, resp.status)
+            )
+        artifact.size = resp.content_length
+        encoding = resp.headers.get('Content-Encoding', 'identity').lower()
+        artifact.encoding = None if encoding == 'identity' else encoding
+
+
+async def stat_remote_artifacts(context, artifacts_to_beetmove):
+    """Make sure that the upstream artifacts to be streamed exist, and get
+    their size and trusted digest, before any upload starts"""
+    stats = []
+    chains_of_trust = {}
+    for locale in artifacts_to_beetmove:
+        for source in artifacts_to_beetmove[locale].values():
+            if isinstance(source, RemoteArtifact):
+                if source.task_id not in chains_of_trust:
+                    chains_of_trust[source.task_id] = await run_in_executor(
+                        load_chain_of_trust, context, source.task_id
+                    )
+                source.sha256 = get_trusted_digest(chains_of_trust[source.task_id], source)
+                stats.append(asyncio.ensure_future(stat_remote_artifact(context, source)))
+    if stats:
+        await raise_future_exceptions(stats)
+
+
+def load_chain_of_trust(context, task_id):
+    """Load the chain of trust of an upstream task, as downloaded and
+    verified by scriptworker"""
+    path = os.path.join(context.config['work_dir'], 'cot', task_id or '', CHAIN_OF_TRUST_ARTIFACT)
+    try:
+        return load_json(path)
+    except (OSError, ValueError) as exc:
+        raise ScriptWorkerTaskException(
+            "Can't read the chain of trust of task {}: {}".format(task_id, exc)
+        )
+
+
+def get_trusted_digest(chain_of_trust, artifact):
+    digest = chain_of_trust.get('artifacts', {}).get(artifact.path, {}).get('sha256')
+    if digest is None:
+        raise ScriptWorkerTaskException(
+            "{} isn't listed in the chain of trust of task {}".format(artifact.path, artifact.task_id)
+        )
+    return digest
+
+
+def check_trusted_digest(artifact, sha256):
+    """Make sure that an artifact that didn't go through scriptworker is the
+    one its chain of trust lists, before it is published"""
+    if artifact.sha256 is None or sha256 != artifact.sha256:
+        raise ScriptWorkerTaskException(
+            "{} doesn't match the chain of trust of its task: sha256 {} instead of {}".format(
+                artifact, sha256, artifact.sha256
+            )
+        )
@@ -1,3 +1,4 @@
+import collections
 import json
 import logging
 import os
@@ -6,17 +7,21 @@ import shutil
 import scriptworker.client
 from beetmoverscript.constants import (IGNORED_UPSTREAM_ARTIFACTS,
                                        INITIAL_RELEASE_PROPS_FILE,
-                                       RESTRICTED_BUCKET_PATHS)
+                                       RESTRICTED_BUCKET_PATHS,
+                                       UPLOAD_PLAN_CONNECTION_THROUGHPUT,
+                                       UPLOAD_PLAN_LINK_THROUGHPUT,
+                                       UPLOAD_PLAN_HEAVIEST_SOURCES)
 
-from beetmoverscript.utils import write_json, write_file
+from beetmoverscript.streaming import RemoteArtifact, get_remote_artifact
+from beetmoverscript.utils import write_json, write_file, run_in_executor, get_size
 from scriptworker.exceptions import ScriptWorkerTaskException
 
 log = logging.getLogger(__name__)
 
 
-def validate_task_schema(context):
+def validate_task_schema(context, schema_key='schema_file'):
     """Perform a schema validation check against taks definition"""
-    with open(context.config['schema_file']) as fh:
+    with open(context.config[schema_key]) as fh:
         task_schema = json.load(fh)
     log.debug(task_schema)
     scriptworker.client.validate_json_schema(context.task, task_schema)
@@ -63,7 +68,20 @@ def validate_bucket_paths(bucket, s3_bucket_path):
 
 
 def generate_checksums_manifest(context):
-    checksums_dict = context.checksums
+    return format_checksums_manifest(context, context.checksums)
+
+
+def generate_destinations_checksums_manifest(context, s3_bucket_path):
+    """Same as `generate_checksums_manifest`, listing the artifacts by their
+    destinations, relative to `s3_bucket_path`, rather than by their pretty
+    names, which the tasks of different platforms may share (e.g. `mar`)"""
+    return format_checksums_manifest(context, {
+        os.path.relpath(dest, s3_bucket_path): values
+        for dest, values in context.destination_checksums.items()
+    })
+
+
+def format_checksums_manifest(context, checksums_dict):
     content = list()
     for artifact, values in sorted(checksums_dict.items()):
         for algo in context.config['checksums_digests']:
@@ -77,23 +95,86 @@ def generate_checksums_manifest(context):
     return '\n'.join(content)
 
 
-def add_checksums_to_artifacts(context):
+async def add_checksums_to_artifacts(context):
     abs_file_path = os.path.join(context.config['artifact_dir'],
                                  'public/target.checksums')
     manifest = generate_checksums_manifest(context)
-    write_file(abs_file_path, manifest)
+    await run_in_executor(write_file, abs_file_path, manifest)
 
 
-def add_balrog_manifest_to_artifacts(context):
+async def add_destinations_checksums_to_artifacts(context, mapping_manifest):
+    abs_file_path = os.path.join(context.config['artifact_dir'],
+                                 'public/destinations.checksums')
+    manifest = generate_destinations_checksums_manifest(context, mapping_manifest['s3_bucket_path'])
+    await run_in_executor(write_file, abs_file_path, manifest)
+
+
+async def add_balrog_manifest_to_artifacts(context):
     abs_file_path = os.path.join(context.config['artifact_dir'],
                                  'public/manifest.json')
-    write_json(abs_file_path, context.balrog_manifest)
+    await run_in_executor(write_json, abs_file_path, context.balrog_manifest)
 
 
-def add_release_props_to_artifacts(context, release_props_filepath):
+async def add_release_props_to_artifacts(context, release_props_filepath):
     abs_file_path = os.path.join(context.config['artifact_dir'],
                                  'public/balrog_props.json')
-    shutil.copyfile(release_props_filepath, abs_file_path)
+    await run_in_executor(shutil.copyfile, release_props_filepath, abs_file_path)
+
+
+def generate_upload_plan(context, artifacts_to_beetmove, manifest):
+    """Compute what the task would upload, without uploading anything: every
+    (source, size, destinations) along with the totals and an estimate of the
+    wall time, derived from the throughput figures in the script configs"""
+    plan_config = context.config.get('upload_plan', {})
+    beets = []
+    destinations_count = collections.Counter()
+    for locale in sorted(artifacts_to_beetmove):
+        for artifact in sorted(artifacts_to_beetmove[locale]):
+            source = artifacts_to_beetmove[locale][artifact]
+            destinations = [os.path.join(manifest["s3_bucket_path"], dest)
+                            for dest in manifest['mapping'][locale][artifact]['destinations']]
+            destinations_count.update(destinations)
+            beets.append({
+                'locale': locale,
+                'artifact': artifact,
+                'source': str(source),
+                'size': source.size if isinstance(source, RemoteArtifact) else get_size(source),
+                'destinations': destinations,
+            })
+
+    total_bytes = sum([beet['size'] * len(beet['destinations']) for beet in beets])
+    connections = context.config['aiohttp_max_connections']
+    throughput = min(
+        connections * plan_config.get('connection_throughput', UPLOAD_PLAN_CONNECTION_THROUGHPUT),
+        plan_config.get('link_throughput', UPLOAD_PLAN_LINK_THROUGHPUT),
+    )
+    heaviest_beets = sorted(beets, key=lambda beet: beet['size'] * len(beet['destinations']),
+                            reverse=True)
+
+    return {
+        'beets': beets,
+        'object_count': sum(destinations_count.values()),
+        'unique_sources': len(set([beet['source'] for beet in beets])),
+        'total_bytes': total_bytes,
+        'duplicate_destinations': sorted([dest for dest, count in destinations_count.items() if count > 1]),
+        'heaviest_sources': [
+            {'source': beet['source'], 'bytes': beet['size'] * len(beet['destinations'])}
+            for beet in heaviest_beets[:UPLOAD_PLAN_HEAVIEST_SOURCES]
+        ],
+        'estimated_wall_time': total_bytes / throughput,
+    }
+
+
+async def add_upload_plan_to_artifacts(context, artifacts_to_beetmove, manifest):
+    abs_file_path = os.path.join(context.config['artifact_dir'],
+                                 'public/upload_plan.json')
+    plan = await run_in_executor(generate_upload_plan, context, artifacts_to_beetmove, manifest)
+    log.info("Would upload {} bytes to {} objects in about {:.0f}s".format(
+        plan['total_bytes'], plan['object_count'], plan['estimated_wall_time']
+    ))
+    if plan['duplicate_destinations']:
+        log.warning("Duplicate destinations: {}".format(plan['duplicate_destinations']))
+    await run_in_executor(write_json, abs_file_path, plan)
 
 
 def filter_ignored_artifacts(artifact_paths, ignored_artifacts=IGNORED_UPSTREAM_ARTIFACTS):
@@ -103,23 +184,35 @@ def filter_ignored_artifacts(artifact_paths, ignored_artifacts=IGNORED_UPSTREAM_
     return [p for p in artifact_paths if os.path.basename(p) not in ignored_artifacts]
 
 
-def get_upstream_artifact(context, taskid, path):
+def get_upstream_artifact(context, taskid, path, allow_remote=False):
+    """Return the absolute path of an upstream artifact downloaded in the
+    work_dir. If it's not there and `allow_remote` is set, it may be streamed
+    from the artifact store instead, see `artifact_streaming` in script
+    configs"""
     abs_path = os.path.abspath(os.path.join(context.config['work_dir'], 'cot', taskid, path))
     if not os.path.exists(abs_path):
-        raise ScriptWorkerTaskException(
-            "upstream artifact with path: {}, does not exist".format(abs_path)
-        )
+        remote_artifact = get_remote_artifact(context, taskid, path) if allow_remote else None
+        if remote_artifact is None:
+            raise ScriptWorkerTaskException(
+                "upstream artifact with path: {}, does not exist".format(abs_path)
+            )
+        log.info("{} is not in the work_dir, streaming it from {}".format(path, remote_artifact))
+        return remote_artifact
     return abs_path
 
 
 def get_upstream_artifacts(context):
+    # artifacts whose contents are altered need to be on the local disk
+    blobs = context.config.get('blobs_needing_prettynaming_contents', [])
     artifacts = {}
     for artifact_dict in context.task['payload']['upstreamArtifacts']:
         locale = artifact_dict['locale']
         artifacts[locale] = artifacts.get(locale, {})
         for path in filter_ignored_artifacts(artifact_dict['paths']):
-            abs_path = get_upstream_artifact(context, artifact_dict['taskId'], path)
-            artifacts[locale][os.path.basename(abs_path)] = abs_path
+            artifact = os.path.basename(path)
+            artifacts[locale][artifact] = get_upstream_artifact(
+                context, artifact_dict['taskId'], path, allow_remote=artifact not in blobs
+            )
     return artifacts
 
 
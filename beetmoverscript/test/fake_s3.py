@@ -0,0 +1,327 @@
+"""Local S3-compatible server to exercise the upload path over real HTTP.
+
+It understands enough of the S3 REST API for beetmover: presigned PUT, GET
+and HEAD of objects, server-side copies, multipart uploads and
+ListObjectsV2. Signatures are not checked, but expiration of presigned URLs
+is. Faults can be injected through a `Faults` instance: added latency,
+bandwidth caps, 503 SlowDown throttling, connection resets, stalled requests
+and expired URLs.
+"""
+import asyncio
+import calendar
+import hashlib
+import random
+import time
+import urllib.parse
+import uuid
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+ERROR_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Error><Code>{code}</Code><Message>{message}</Message></Error>'
+)
+
+
+class Faults(object):
+    """Faults to inject in the fake S3 responses. Rates are probabilities
+    between 0 and 1, counts are applied to the first requests received.
+
+    latency: seconds to wait before handling each request
+    bandwidth: bytes per second at which bodies are received and sent
+    slowdown_rate, slowdown_count: requests answered with a 503 SlowDown
+    reset_rate, reset_count: requests whose connection is reset
+    stall, stall_rate, stall_count: requests left hanging for `stall` seconds
+    expire_urls: consider every presigned URL as expired
+    """
+
+    def __init__(self, latency=0, bandwidth=None, slowdown_rate=0, slowdown_count=0,
+                 reset_rate=0, reset_count=0, stall=0, stall_rate=0, stall_count=0,
+                 expire_urls=False, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.slowdown_rate = slowdown_rate
+        self.slowdown_count = slowdown_count
+        self.reset_rate = reset_rate
+        self.reset_count = reset_count
+        self.stall = stall
+        self.stall_rate = stall_rate
+        self.stall_count = stall_count
+        self.expire_urls = expire_urls
+        self.random = random.Random(seed)
+
+
+class FakeS3(object):
+
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.objects = {}
+        self.multipart_uploads = {}
+        # (method, status) of every request, to assert on retries. The status
+        # of requests whose connection was reset is 'reset'
+        self.requests = []
+        self.app = web.Application(client_max_size=1024 ** 4)
+        self.app.router.add_route('*', '/{bucket}', self.handle_bucket)
+        self.app.router.add_route('*', '/{bucket}/{key:.+}', self.handle_object)
+        self.runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.url = 'http://{}:{}'.format(*self.runner.addresses[0][:2])
+        return self.url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    # helpers {{{1
+    def _error(self, status, code, message):
+        return web.Response(status=status, content_type='application/xml',
+                            text=ERROR_TEMPLATE.format(code=code, message=message))
+
+    def _is_expired(self, request):
+        if self.faults.expire_urls:
+            return True
+        query = request.query
+        if 'Expires' in query:
+            return int(query['Expires']) < time.time()
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            signed = calendar.timegm(time.strptime(query['X-Amz-Date'], '%Y%m%dT%H%M%SZ'))
+            return signed + int(query['X-Amz-Expires']) < time.time()
+        return False
+
+    def _should(self, count_attr, rate):
+        count = getattr(self.faults, count_attr)
+        if count > 0:
+            setattr(self.faults, count_attr, count - 1)
+            return True
+        return rate and self.faults.random.random() < rate
+
+    async def _inject_faults(self, request):
+        """Return an error response, or None if the request is to be handled"""
+        if self.faults.latency:
+            await asyncio.sleep(self.faults.latency)
+        if self.faults.stall and self._should('stall_count', self.faults.stall_rate):
+            await asyncio.sleep(self.faults.stall)
+        if self._should('reset_count', self.faults.reset_rate):
+            request.transport.abort()
+            return web.Response(status=500)
+        if self._should('slowdown_count', self.faults.slowdown_rate):
+            return self._error(503, 'SlowDown', 'Please reduce your request rate.')
+        if self._is_expired(request):
+            return self._error(403, 'AccessDenied', 'Request has expired')
+        return None
+
+    async def _read_body(self, request):
+        if not self.faults.bandwidth:
+            return await request.read()
+        chunks = []
+        chunk_size = max(1, int(self.faults.bandwidth / 10))
+        while True:
+            chunk = await request.content.read(chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            await asyncio.sleep(len(chunk) / self.faults.bandwidth)
+        return b''.join(chunks)
+
+    async def _send_body(self, request, headers, body):
+        if not self.faults.bandwidth:
+            return web.Response(body=body, headers=headers)
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+        chunk_size = max(1, int(self.faults.bandwidth / 10))
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            await response.write(chunk)
+            await asyncio.sleep(len(chunk) / self.faults.bandwidth)
+        await response.write_eof()
+        return response
+
+    def _get_amz_headers(self, request):
+        """Headers can also be hoisted into the query string of presigned
+        URLs"""
+        amz_headers = {}
+        for source in (request.query, request.headers):
+            for name, value in source.items():
+                name = name.lower()
+                if name.startswith('x-amz-meta-') or name == 'x-amz-copy-source':
+                    amz_headers[name] = value
+        for name in ('Content-Type', 'Content-Encoding', 'Cache-Control'):
+            value = request.headers.get(name) or request.query.get(name.lower())
+            if value:
+                amz_headers[name] = value
+        return amz_headers
+
+    def _object_headers(self, obj):
+        headers = dict(obj['headers'])
+        headers.pop('x-amz-copy-source', None)
+        headers['ETag'] = obj['etag']
+        headers['Content-Length'] = str(len(obj['body']))
+        return headers
+
+    def _record(self, request, response):
+        transport = request.transport
+        if transport is None or transport.is_closing():
+            self.requests.append((request.method, 'reset'))
+        else:
+            self.requests.append((request.method, response.status))
+        return response
+
+    # handlers {{{1
+    async def handle_bucket(self, request):
+        response = await self._inject_faults(request)
+        if response is None:
+            if request.method == 'HEAD':
+                response = web.Response(status=200)
+            elif request.method == 'GET':
+                response = self.list_objects(request)
+            else:
+                response = self._error(405, 'MethodNotAllowed', request.method)
+        return self._record(request, response)
+
+    async def handle_object(self, request):
+        response = await self._inject_faults(request)
+        if response is None:
+            handler = {
+                'GET': self.get_object,
+                'HEAD': self.get_object,
+                'PUT': self.put_object,
+                'POST': self.post_object,
+                'DELETE': self.delete_object,
+            }.get(request.method)
+            if handler is None:
+                response = self._error(405, 'MethodNotAllowed', request.method)
+            else:
+                response = await handler(request)
+        return self._record(request, response)
+
+    async def get_object(self, request):
+        key = (request.match_info['bucket'], request.match_info['key'])
+        obj = self.objects.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey', 'The specified key does not exist.')
+        headers = self._object_headers(obj)
+        if request.method == 'HEAD':
+            return web.Response(status=200, headers=headers)
+        del headers['Content-Length']
+        return await self._send_body(request, headers, obj['body'])
+
+    async def put_object(self, request):
+        bucket, key = request.match_info['bucket'], request.match_info['key']
+        amz_headers = self._get_amz_headers(request)
+
+        if 'partNumber' in request.query:
+            upload = self.multipart_uploads.get(request.query.get('uploadId'))
+            if upload is None:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            body = await self._read_body(request)
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            upload['parts'][int(request.query['partNumber'])] = (body, etag)
+            return web.Response(status=200, headers={'ETag': etag})
+
+        if 'x-amz-copy-source' in amz_headers:
+            source_bucket, source_key = urllib.parse.unquote(
+                amz_headers['x-amz-copy-source']
+            ).lstrip('/').split('/', 1)
+            source = self.objects.get((source_bucket, source_key))
+            if source is None:
+                return self._error(404, 'NoSuchKey', 'The specified key does not exist.')
+            obj = dict(source)
+            directive = (request.headers.get('x-amz-metadata-directive') or
+                         request.query.get('x-amz-metadata-directive'))
+            if directive == 'REPLACE':
+                obj['headers'] = {name: value for name, value in amz_headers.items()
+                                  if name != 'x-amz-copy-source'}
+            self.objects[(bucket, key)] = obj
+            return web.Response(
+                status=200, content_type='application/xml',
+                text='<CopyObjectResult><ETag>{}</ETag></CopyObjectResult>'.format(source['etag'])
+            )
+
+        body = await self._read_body(request)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self.objects[(bucket, key)] = {'body': body, 'etag': etag, 'headers': amz_headers}
+        return web.Response(status=200, headers={'ETag': etag})
+
+    async def post_object(self, request):
+        bucket, key = request.match_info['bucket'], request.match_info['key']
+        if 'uploads' in request.query:
+            upload_id = uuid.uuid4().hex
+            self.multipart_uploads[upload_id] = {
+                'key': (bucket, key), 'parts': {}, 'headers': self._get_amz_headers(request),
+            }
+            return web.Response(
+                status=200, content_type='application/xml',
+                text=('<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                      '<UploadId>{}</UploadId></InitiateMultipartUploadResult>').format(bucket, key, upload_id)
+            )
+        if 'uploadId' in request.query:
+            upload = self.multipart_uploads.pop(request.query['uploadId'], None)
+            if upload is None:
+                return self._error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            parts = [upload['parts'][number] for number in sorted(upload['parts'])]
+            body = b''.join([part for part, _ in parts])
+            digests = b''.join([bytes.fromhex(etag.strip('"')) for _, etag in parts])
+            etag = '"{}-{}"'.format(hashlib.md5(digests).hexdigest(), len(parts))
+            self.objects[upload['key']] = {'body': body, 'etag': etag, 'headers': upload['headers']}
+            return web.Response(
+                status=200, content_type='application/xml',
+                text='<CompleteMultipartUploadResult><ETag>{}</ETag></CompleteMultipartUploadResult>'.format(etag)
+            )
+        return self._error(400, 'InvalidRequest', 'Unsupported POST')
+
+    async def delete_object(self, request):
+        if 'uploadId' in request.query:
+            self.multipart_uploads.pop(request.query['uploadId'], None)
+        else:
+            self.objects.pop((request.match_info['bucket'], request.match_info['key']), None)
+        return web.Response(status=204)
+
+    def list_objects(self, request):
+        bucket = request.match_info['bucket']
+        prefix = request.query.get('prefix', '')
+        delimiter = request.query.get('delimiter')
+        max_keys = int(request.query.get('max-keys', 1000))
+        start = int(request.query.get('continuation-token', 0))
+
+        entries = []
+        for obj_bucket, key in sorted(self.objects):
+            if obj_bucket != bucket or not key.startswith(prefix):
+                continue
+            remainder = key[len(prefix):]
+            if delimiter and delimiter in remainder:
+                common_prefix = prefix + remainder.split(delimiter)[0] + delimiter
+                if ('prefix', common_prefix) not in entries:
+                    entries.append(('prefix', common_prefix))
+            else:
+                entries.append(('key', key))
+
+        page = entries[start:start + max_keys]
+        truncated = start + max_keys < len(entries)
+        contents = []
+        for kind, name in page:
+            if kind == 'prefix':
+                contents.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(name)))
+            else:
+                obj = self.objects[(bucket, name)]
+                contents.append(
+                    '<Contents><Key>{}</Key><Size>{}</Size><ETag>{}</ETag></Contents>'.format(
+                        escape(name), len(obj['body']), escape(obj['etag'])
+                    )
+                )
+        text = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount><MaxKeys>{}</MaxKeys>'
+            '<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>'
+        ).format(
+            bucket, escape(prefix), len(page), max_keys, 'true' if truncated else 'false',
+            '<NextContinuationToken>{}</NextContinuationToken>'.format(start + max_keys) if truncated else '',
+            ''.join(contents),
+        )
+        return web.Response(status=200, content_type='application/xml', text=text)
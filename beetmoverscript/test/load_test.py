@@ -0,0 +1,155 @@
+"""Load test of the upload path against the local fake S3 server.
+
+Runs `move_beets` over generated artifacts, optionally injecting faults, and
+reports how long it took and how many requests had to be retried, e.g.:
+
+    python -m beetmoverscript.test.load_test --locales 20 --artifacts 10 \
+        --size 1048576 --max-connections 10 --latency 0.05 --slowdown-rate 0.02
+
+Slow uploads can be hedged with `--hedging-percentile`, e.g. against
+`--stall-rate`.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import tempfile
+import time
+
+import aiohttp
+from scriptworker.context import Context
+
+from beetmoverscript.hedging import get_hedger
+from beetmoverscript.script import move_beets
+from beetmoverscript.test.fake_s3 import FakeS3, Faults
+
+BUCKET = 'fake-load-test-bucket'
+
+
+def generate_artifacts(directory, locales, artifacts, size):
+    """Write `artifacts` distinct files of `size` bytes for every locale and
+    return them along the matching beetmover manifest"""
+    artifacts_to_beetmove = {}
+    manifest = {'s3_bucket_path': 'pub/firefox/nightly/', 'mapping': {}}
+    for locale_index in range(locales):
+        locale = 'locale-{}'.format(locale_index)
+        os.makedirs(os.path.join(directory, locale))
+        artifacts_to_beetmove[locale] = {}
+        manifest['mapping'][locale] = {}
+        for artifact_index in range(artifacts):
+            artifact = 'target.{}.bin'.format(artifact_index)
+            path = os.path.join(directory, locale, artifact)
+            with open(path, 'wb') as fh:
+                fh.write(os.urandom(size))
+            pretty_name = 'firefox.{}.{}'.format(locale, artifact)
+            artifacts_to_beetmove[locale][artifact] = path
+            manifest['mapping'][locale][artifact] = {
+                's3_key': pretty_name,
+                'destinations': [
+                    'dated/{}/{}'.format(locale, pretty_name),
+                    'latest/{}/{}'.format(locale, pretty_name),
+                ],
+            }
+    return artifacts_to_beetmove, manifest
+
+
+def get_load_test_context(work_dir, endpoint_url, max_connections):
+    context = Context()
+    context.config = {
+        'work_dir': work_dir,
+        'aiohttp_max_connections': max_connections,
+        'checksums_digests': ['sha512', 'sha256'],
+        'bucket_config': {
+            'nightly': {
+                'endpoint_url': endpoint_url,
+                'credentials': {'id': 'dummy', 'key': 'dummy'},
+                'buckets': {'firefox': BUCKET},
+            },
+        },
+    }
+    context.bucket = 'nightly'
+    context.release_props = {'appName': 'Firefox'}
+    context.balrog_manifest = list()
+    context.checksums = dict()
+    context.destination_checksums = dict()
+    context.file_checksums = dict()
+    context.uploaded_contents = dict()
+    context.compressed_artifacts = dict()
+    context.digest_cache = None
+    return context
+
+
+async def run_load_test(locales=5, artifacts=5, size=1024 * 1024, max_connections=10,
+                        faults=None, hedging=None):
+    """Upload the generated artifacts to a fake S3 server and return a
+    report of the run"""
+    fake_s3 = FakeS3(faults)
+    endpoint_url = await fake_s3.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            artifacts_to_beetmove, manifest = generate_artifacts(tmpdirname, locales, artifacts, size)
+            context = get_load_test_context(tmpdirname, endpoint_url, max_connections)
+            context.config['hedging'] = hedging
+            context.hedger = get_hedger(context)
+            connector = aiohttp.TCPConnector(limit=max_connections)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                context.session = session
+                start = time.time()
+                try:
+                    await move_beets(context, artifacts_to_beetmove, manifest)
+                finally:
+                    if context.hedger is not None:
+                        await context.hedger.close()
+                wall_time = time.time() - start
+    finally:
+        await fake_s3.stop()
+
+    uploaded_bytes = locales * artifacts * size * 2
+    report = {
+        'objects': len(fake_s3.objects),
+        'uploaded_bytes': uploaded_bytes,
+        'wall_time': wall_time,
+        'throughput': uploaded_bytes / wall_time,
+        'requests': {
+            '{} {}'.format(method, status): count
+            for (method, status), count in sorted(collections.Counter(fake_s3.requests).items())
+        },
+    }
+    if context.hedger is not None:
+        report['hedged'] = context.hedger.hedged
+        report['hedges_won'] = context.hedger.won
+        report['hedged_bytes'] = context.hedger.budget.spent
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--locales', type=int, default=5)
+    parser.add_argument('--artifacts', type=int, default=5, help='artifacts per locale')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='bytes per artifact')
+    parser.add_argument('--max-connections', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each request')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per request')
+    parser.add_argument('--slowdown-rate', type=float, default=0)
+    parser.add_argument('--reset-rate', type=float, default=0)
+    parser.add_argument('--stall', type=float, default=30, help='seconds a stalled request hangs')
+    parser.add_argument('--stall-rate', type=float, default=0)
+    parser.add_argument('--hedging-percentile', type=float, default=None,
+                        help='hedge the uploads slower than this percentile')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    faults = Faults(latency=args.latency, bandwidth=args.bandwidth,
+                    slowdown_rate=args.slowdown_rate, reset_rate=args.reset_rate,
+                    stall=args.stall, stall_rate=args.stall_rate, seed=args.seed)
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(
+        run_load_test(args.locales, args.artifacts, args.size, args.max_connections, faults,
+                      hedging={'percentile': args.hedging_percentile} if args.hedging_percentile else None)
+    )
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
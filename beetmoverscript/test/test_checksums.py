@@ -0,0 +1,156 @@
+import os
+import tempfile
+
+import pytest
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerTaskException
+
+from beetmoverscript.checksums import (read_checksums, merge_checksums, write_merged_checksums,
+                                       get_checksums_filename, main)
+from beetmoverscript.task import generate_destinations_checksums_manifest
+from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task, get_fake_balrog_props
+from beetmoverscript.utils import write_file, generate_beetmover_manifest, update_props
+
+ALGORITHMS = ['sha512', 'sha256']
+
+
+def write_checksums(directory, name, checksums):
+    """Write a destinations.checksums the way beetmover tasks do"""
+    context = Context()
+    context.config = {'checksums_digests': ALGORITHMS}
+    context.destination_checksums = {
+        'pub/' + artifact: {'sha512': '512-' + digest, 'sha256': '256-' + digest, 'size': size}
+        for artifact, (digest, size) in checksums.items()
+    }
+    path = os.path.join(directory, name)
+    write_file(path, generate_destinations_checksums_manifest(context, 'pub/'))
+    return path
+
+
+def read_output(directory, algo):
+    with open(os.path.join(directory, get_checksums_filename(algo))) as fh:
+        return fh.read()
+
+
+def test_read_checksums():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = write_checksums(tmpdirname, 'a.checksums', {'b b.zip': ('b', 2), 'a.zip': ('a', 1)})
+        assert list(read_checksums(path)) == [
+            ('a.zip', 'sha512', '512-a', 1, path),
+            ('a.zip', 'sha256', '256-a', 1, path),
+            ('b b.zip', 'sha512', '512-b', 2, path),
+            ('b b.zip', 'sha256', '256-b', 2, path),
+        ]
+
+
+@pytest.mark.parametrize('contents', (
+    '512-a sha512 1 b.zip\n512-a sha512 1 a.zip\n',
+    '512-a sha512 a.zip\n',
+    '512-a sha512 big a.zip\n',
+))
+def test_read_checksums_invalid(contents):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.checksums')
+        write_file(path, contents)
+        with pytest.raises(ScriptWorkerTaskException):
+            list(read_checksums(path))
+
+
+def test_merge_checksums():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        paths = [
+            write_checksums(tmpdirname, 'linux.checksums', {'linux.tar.bz2': ('l', 3), 'c.txt': ('c', 1)}),
+            write_checksums(tmpdirname, 'mac.checksums', {'mac.dmg': ('m', 4), 'c.txt': ('c', 1)}),
+            write_checksums(tmpdirname, 'empty.checksums', {}),
+        ]
+        assert list(merge_checksums(paths)) == [
+            ('c.txt', 1, {'sha512': '512-c', 'sha256': '256-c'}),
+            ('linux.tar.bz2', 3, {'sha512': '512-l', 'sha256': '256-l'}),
+            ('mac.dmg', 4, {'sha512': '512-m', 'sha256': '256-m'}),
+        ]
+
+
+@pytest.mark.parametrize('other', (('d', 1), ('c', 2)))
+def test_merge_checksums_conflict(other):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        paths = [
+            write_checksums(tmpdirname, 'a.checksums', {'c.txt': ('c', 1)}),
+            write_checksums(tmpdirname, 'b.checksums', {'c.txt': other}),
+        ]
+        with pytest.raises(ScriptWorkerTaskException):
+            list(merge_checksums(paths))
+
+
+def test_write_merged_checksums():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        paths = [
+            write_checksums(tmpdirname, '{}.checksums'.format(index),
+                            {'{}.zip'.format(name): (str(name), index) for name in range(index, 200, 7)})
+            for index in range(7)
+        ]
+        output_dir = os.path.join(tmpdirname, 'release')
+        assert write_merged_checksums(paths, output_dir, ['sha256', 'sha512']) == 200
+
+        names = sorted('{}.zip'.format(name) for name in range(200))
+        assert read_output(output_dir, 'sha256') == ''.join(
+            '256-{}  {}\n'.format(name[:-4], name) for name in names
+        )
+        assert read_output(output_dir, 'sha512').splitlines()[0] == '512-0  0.zip'
+
+
+def test_write_merged_checksums_failure():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        paths = [
+            write_checksums(tmpdirname, 'a.checksums', {'a.zip': ('a', 1)}),
+        ]
+        output_dir = os.path.join(tmpdirname, 'release')
+        with pytest.raises(ScriptWorkerTaskException):
+            write_merged_checksums(paths, output_dir, ['sha256', 'md5'])
+        assert os.listdir(output_dir) == []
+
+
+def get_platform_manifest(stage_platform):
+    context = Context()
+    context.task = get_fake_valid_task()
+    context.config = get_fake_valid_config()
+    context.config['actions']['push-to-nightly']['firefox_nightly'] = \
+        'beetmoverscript/templates/firefox_nightly.yml'
+    props = dict(get_fake_balrog_props()['properties'], stage_platform=stage_platform)
+    context.release_props = update_props(props, {'linux64': 'linux-x86_64'})
+    context.bucket = 'nightly'
+    context.action = 'push-to-nightly'
+    return generate_beetmover_manifest(context)
+
+
+def test_write_merged_checksums_platforms():
+    # some pretty names, e.g. `mar`, are shared by the tasks of every
+    # platform, while their contents differ
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        paths = []
+        for stage_platform in ('linux64', 'macosx64'):
+            manifest = get_platform_manifest(stage_platform)
+            mar_tools = ('mar', 'mbsdiff')
+            paths.append(write_checksums(tmpdirname, '{}.checksums'.format(stage_platform), {
+                dest: (stage_platform + '-' + mapping['s3_key'] if mapping['s3_key'] in mar_tools
+                       else mapping['s3_key'], 1)
+                for mapping in manifest['mapping']['en-US'].values()
+                for dest in mapping['destinations']
+            }))
+        output_dir = os.path.join(tmpdirname, 'release')
+        write_merged_checksums(paths, output_dir, ['sha256'])
+
+        sums = read_output(output_dir, 'sha256').splitlines()
+        for stage_platform in ('linux64', 'macosx64'):
+            assert '256-{0}-mar  latest-mozilla-central/mar-tools/{0}/mar'.format(stage_platform) in sums
+
+
+def test_main():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = write_checksums(tmpdirname, 'a.checksums', {'a.zip': ('a', 1)})
+        output_dir = os.path.join(tmpdirname, 'release')
+        main(['--output-dir', output_dir, path])
+        assert sorted(os.listdir(output_dir)) == ['SHA256SUMS', 'SHA512SUMS']
+
+        conflicting = write_checksums(tmpdirname, 'b.checksums', {'a.zip': ('b', 1)})
+        with pytest.raises(SystemExit):
+            main(['--output-dir', output_dir, path, conflicting])
@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+from scriptworker.context import Context
+
+from beetmoverscript.digest_cache import DigestCache, get_digest_cache
+from beetmoverscript.test import get_fake_valid_config
+from beetmoverscript.utils import get_hash
+
+
+def write(path, contents):
+    with open(path, 'wb') as fh:
+        fh.write(contents)
+
+
+def test_digest_cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = DigestCache(os.path.join(tmpdirname, 'cache.sqlite'))
+        path = os.path.join(tmpdirname, 'target.txt')
+        write(path, b'Hello world from beetmoverscript!')
+
+        assert cache.get(path, 'sha512') is None
+        cache.set(path, 'sha512', 'abc')
+        assert cache.get(path, 'sha512') == 'abc'
+        assert cache.get(path, 'sha256') is None
+
+        # a modified file doesn't match its previous entry
+        write(path, b'Hello world from beetmoverscript, again!')
+        assert cache.get(path, 'sha512') is None
+
+        cache.set(path, 'sha512', 'def')
+        cache.invalidate(path)
+        assert cache.get(path, 'sha512') is None
+        cache.close()
+
+
+def test_digest_cache_is_persistent():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_path = os.path.join(tmpdirname, 'cache.sqlite')
+        path = os.path.join(tmpdirname, 'target.txt')
+        write(path, b'Hello world from beetmoverscript!')
+
+        cache = DigestCache(cache_path)
+        cache.set(path, 'sha512', 'abc')
+        cache.close()
+
+        cache = DigestCache(cache_path)
+        assert cache.get(path, 'sha512') == 'abc'
+        cache.close()
+
+
+def test_digest_cache_eviction():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = DigestCache(os.path.join(tmpdirname, 'cache.sqlite'), max_entries=2)
+        paths = [os.path.join(tmpdirname, str(i)) for i in range(3)]
+        for i, path in enumerate(paths):
+            write(path, str(i).encode())
+        cache.set(paths[0], 'sha512', '0')
+        cache.set(paths[1], 'sha512', '1')
+        # the first entry was used more recently than the second one
+        assert cache.get(paths[0], 'sha512') == '0'
+        cache.set(paths[2], 'sha512', '2')
+
+        assert cache.get(paths[0], 'sha512') == '0'
+        assert cache.get(paths[1], 'sha512') is None
+        assert cache.get(paths[2], 'sha512') == '2'
+        cache.close()
+
+
+def test_digest_cache_eviction_batches():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = DigestCache(os.path.join(tmpdirname, 'cache.sqlite'), max_entries=10)
+        path = os.path.join(tmpdirname, 'target.txt')
+        write(path, b'Hello world from beetmoverscript!')
+        algorithms = ['algo{}'.format(i) for i in range(12)]
+        for algo in algorithms[:11]:
+            cache.set(path, algo, algo)
+        # up to a tenth more entries than the maximum are kept
+        assert cache.count == 11
+        cache.set(path, algorithms[11], algorithms[11])
+        assert cache.count == 10
+        assert cache.get(path, algorithms[0]) is None
+        assert cache.get(path, algorithms[11]) == algorithms[11]
+        assert cache.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM digests ORDER BY last_used"
+        ).fetchall()[0][-1].endswith('digests_last_used')
+        cache.close()
+
+
+def test_get_hash_with_cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = DigestCache(os.path.join(tmpdirname, 'cache.sqlite'))
+        path = os.path.join(tmpdirname, 'target.txt')
+        write(path, b'Hello world from beetmoverscript!')
+
+        digest = get_hash(path, 'sha1', cache=cache)
+        assert cache.get(path, 'sha1') == digest
+        cache.set(path, 'sha1', 'cached')
+        assert get_hash(path, 'sha1', cache=cache) == 'cached'
+        cache.close()
+
+
+def test_get_digest_cache():
+    context = Context()
+    context.config = get_fake_valid_config()
+    assert get_digest_cache(context) is None
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['digest_cache'] = {'path': os.path.join(tmpdirname, 'cache.sqlite'),
+                                          'max_entries': 10}
+        cache = get_digest_cache(context)
+        assert cache.max_entries == 10
+        cache.close()
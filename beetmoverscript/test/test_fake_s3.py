@@ -0,0 +1,183 @@
+import aiohttp
+import functools
+import mock
+import os
+import pytest
+import tempfile
+
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerRetryException
+from scriptworker.test import event_loop
+from scriptworker.utils import retry_async
+
+from beetmoverscript.script import (copy_in_s3, put, put_to_s3, get_s3_client,
+                                    get_targets, move_beets)
+from beetmoverscript.test import get_fake_valid_config
+from beetmoverscript.test.fake_s3 import FakeS3, Faults
+from beetmoverscript.test.load_test import BUCKET, run_load_test
+
+assert event_loop  # silence flake8
+
+
+def get_context(endpoint_url, session):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.config['bucket_config'] = {
+        'nightly': {
+            'endpoint_url': endpoint_url,
+            'credentials': {'id': 'dummy', 'key': 'dummy'},
+            'buckets': {'firefox': BUCKET},
+        }
+    }
+    context.bucket = 'nightly'
+    context.release_props = {'appName': 'Firefox'}
+    context.session = session
+    return context
+
+
+def run_with_fake_s3(event_loop, faults, func, transport=None):
+    async def _run():
+        fake_s3 = FakeS3(faults)
+        endpoint_url = await fake_s3.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                context = get_context(endpoint_url, session)
+                if transport:
+                    context.config['bucket_config']['nightly']['transport'] = transport
+                await func(context)
+        finally:
+            await fake_s3.stop()
+        return fake_s3
+
+    return event_loop.run_until_complete(_run())
+
+
+def get_put_url(context, s3_key):
+    return get_s3_client(context).generate_presigned_url(
+        'put_object', {'Bucket': BUCKET, 'Key': s3_key}, ExpiresIn=1800, HttpMethod='PUT'
+    )
+
+
+@pytest.mark.parametrize("transport", [None, 'native'])
+def test_put_to_s3(event_loop, transport):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.txt')
+        with open(path, 'w') as fh:
+            fh.write('foobar')
+
+        async def _upload(context):
+            await put_to_s3(context, 'path/target.txt', path, 'text/plain',
+                            metadata={'sha512': 'deadbeef'})
+            await copy_in_s3(context, 'path/target.txt', 'latest/target.txt')
+
+        fake_s3 = run_with_fake_s3(event_loop, None, _upload, transport=transport)
+
+    for key in ('path/target.txt', 'latest/target.txt'):
+        obj = fake_s3.objects[(BUCKET, key)]
+        assert obj['body'] == b'foobar'
+        assert obj['headers']['x-amz-meta-sha512'] == 'deadbeef'
+        assert obj['headers']['Content-Type'] == 'text/plain'
+    assert fake_s3.requests == [('PUT', 200), ('PUT', 200)]
+
+
+@pytest.mark.parametrize("faults,expected_status", [
+    (Faults(slowdown_count=1), 503),
+    (Faults(expire_urls=True), 403),
+])
+def test_put_error(event_loop, faults, expected_status):
+    with tempfile.NamedTemporaryFile() as fh:
+        async def _upload(context):
+            with pytest.raises(ScriptWorkerRetryException):
+                await put(context, get_put_url(context, 'foo'), {}, fh.name)
+
+        fake_s3 = run_with_fake_s3(event_loop, faults, _upload)
+    assert fake_s3.requests == [('PUT', expected_status)]
+    assert fake_s3.objects == {}
+
+
+@pytest.mark.parametrize("reset_count,raises", [
+    # aiohttp transparently retries an idempotent request once on disconnection
+    (1, False),
+    (2, True),
+])
+def test_put_connection_reset(event_loop, reset_count, raises):
+    with tempfile.NamedTemporaryFile() as fh:
+        async def _upload(context):
+            url = get_put_url(context, 'foo')
+            if raises:
+                with pytest.raises(aiohttp.ClientError):
+                    await put(context, url, {}, fh.name)
+            else:
+                await put(context, url, {}, fh.name)
+
+        fake_s3 = run_with_fake_s3(event_loop, Faults(reset_count=reset_count), _upload)
+    assert fake_s3.requests[:reset_count] == [('PUT', 'reset')] * reset_count
+    assert bool(fake_s3.objects) is not raises
+
+
+def test_run_load_test(event_loop):
+    report = event_loop.run_until_complete(
+        run_load_test(locales=2, artifacts=2, size=1024, max_connections=2)
+    )
+    # 2 destinations per artifact
+    assert report['objects'] == 8
+    assert report['uploaded_bytes'] == 8 * 1024
+    assert report['requests'] == {'PUT 200': 8}
+
+
+@pytest.mark.parametrize("policy,replica_faults,raises", [
+    ('all', [None, None], False),
+    ('all', [None, Faults(expire_urls=True)], True),
+    ('quorum', [None, Faults(expire_urls=True)], False),
+    ('quorum', [Faults(expire_urls=True), Faults(expire_urls=True)], True),
+])
+def test_replication(event_loop, policy, replica_faults, raises):
+    async def _run(path):
+        servers = [FakeS3()] + [FakeS3(faults) for faults in replica_faults]
+        urls = [await server.start() for server in servers]
+        try:
+            async with aiohttp.ClientSession() as session:
+                context = get_context(urls[0], session)
+                context.config['bucket_config']['nightly']['replication_policy'] = policy
+                context.config['bucket_config']['nightly']['replicas'] = [{
+                    'name': 'replica-{}'.format(i),
+                    'endpoint_url': url,
+                    'credentials': {'id': 'dummy', 'key': 'dummy'},
+                    'buckets': {'firefox': 'replica-bucket'},
+                } for i, url in enumerate(urls[1:])]
+                context.targets = get_targets(context)
+                context.checksums = dict()
+                context.destination_checksums = dict()
+                context.balrog_manifest = list()
+                context.file_checksums = dict()
+                context.uploaded_contents = dict()
+                context.compressed_artifacts = dict()
+                context.digest_cache = None
+                manifest = {
+                    's3_bucket_path': 'pub/firefox/nightly/',
+                    'mapping': {'en-US': {'target.txt': {
+                        's3_key': 'firefox.txt', 'destinations': ['firefox.txt'],
+                    }}},
+                }
+                await move_beets(context, {'en-US': {'target.txt': path}}, manifest)
+        finally:
+            for server in servers:
+                await server.stop()
+        return servers
+
+    fast_retry_async = functools.partial(retry_async, attempts=2,
+                                         sleeptime_callback=lambda *args, **kwargs: 0)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.txt')
+        with open(path, 'w') as fh:
+            fh.write('foobar')
+        with mock.patch('beetmoverscript.script.retry_async', fast_retry_async):
+            if raises:
+                with pytest.raises(ScriptWorkerRetryException):
+                    event_loop.run_until_complete(_run(path))
+            else:
+                servers = event_loop.run_until_complete(_run(path))
+                assert servers[0].objects[(BUCKET, 'pub/firefox/nightly/firefox.txt')]['body'] == b'foobar'
+                for server, faults in zip(servers[1:], replica_faults):
+                    key = ('replica-bucket', 'pub/firefox/nightly/firefox.txt')
+                    assert (key in server.objects) is (faults is None)
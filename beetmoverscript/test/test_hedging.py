@@ -0,0 +1,170 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerRetryException
+from scriptworker.test import event_loop
+
+from beetmoverscript.hedging import LatencyTracker, HedgeBudget, Hedger, get_hedger
+from beetmoverscript.script import put_to_s3
+from beetmoverscript.test.fake_s3 import Faults
+from beetmoverscript.test.test_fake_s3 import run_with_fake_s3
+from beetmoverscript.test.load_test import BUCKET
+
+assert event_loop  # silence flake8
+
+PRIMARY_SESSION = 'primary'
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(percentile=0.9, min_samples=3, size_floor=10)
+    tracker.record(100, 1)
+    tracker.record(100, 2)
+    assert tracker.get_delay(100) is None
+
+    tracker.record(5, 1)
+    # small transfers are compared as if they weighed the size floor
+    assert tracker.samples == [0.01, 0.02, 0.1]
+    assert tracker.get_delay(1000) == 100
+    assert tracker.get_delay(1) == 1
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(10)
+    assert budget.spend(6)
+    assert not budget.spend(6)
+    assert budget.spend(4)
+    assert budget.spent == 10
+
+
+def get_hedger_with_samples(max_bytes=100, max_connections=10):
+    tracker = LatencyTracker(min_samples=1, size_floor=1)
+    tracker.record(1, 0.01)
+    return Hedger(tracker, HedgeBudget(max_bytes), {'aiohttp_max_connections': max_connections},
+                  min_delay=0.01)
+
+
+def run_hedged(event_loop, hedger, delays):
+    """Run a transfer whose attempts take the given delays, None meaning the
+    attempt fails. Returns the result and the sessions the attempts used."""
+    sessions = []
+
+    async def transfer(session=None):
+        delay = delays[len(sessions)]
+        sessions.append(session)
+        await asyncio.sleep(0.02 if delay is None else delay)
+        if delay is None:
+            raise ScriptWorkerRetryException('failed')
+        return session
+
+    async def run():
+        try:
+            return await hedger.run(1, transfer, session=PRIMARY_SESSION)
+        finally:
+            await hedger.close()
+
+    return event_loop.run_until_complete(run()), sessions
+
+
+def test_hedger_fast(event_loop):
+    hedger = get_hedger_with_samples()
+    result, sessions = run_hedged(event_loop, hedger, [0])
+    assert result == PRIMARY_SESSION
+    assert sessions == [PRIMARY_SESSION]
+    assert hedger.hedged == 0
+    assert len(hedger.tracker.samples) == 2
+
+
+@pytest.mark.parametrize('delays,hedge_wins', (
+    ([1, 0], True),
+    ([0.05, 1], False),
+    ([None, 0], True),
+))
+def test_hedger_slow(event_loop, delays, hedge_wins):
+    hedger = get_hedger_with_samples()
+    result, sessions = run_hedged(event_loop, hedger, delays)
+    assert len(sessions) == 2
+    assert sessions[0] == PRIMARY_SESSION and sessions[1] is not PRIMARY_SESSION
+    assert (result is sessions[1]) == hedge_wins
+    assert hedger.hedged == 1
+    assert hedger.won == int(hedge_wins)
+    assert hedger.budget.spent == 1
+
+
+def test_hedger_queued(event_loop):
+    # the transfers waiting for a connection aren't deemed slow
+    hedger = get_hedger_with_samples(max_connections=1)
+    sessions = []
+
+    async def transfer(session=None):
+        sessions.append(session)
+        await asyncio.sleep(0.005)
+
+    async def run():
+        try:
+            await asyncio.gather(*[hedger.run(1, transfer, session=PRIMARY_SESSION)
+                                   for _ in range(5)])
+        finally:
+            await hedger.close()
+
+    event_loop.run_until_complete(run())
+    assert sessions == [PRIMARY_SESSION] * 5
+    assert hedger.hedged == 0
+
+
+def test_hedger_both_fail(event_loop):
+    hedger = get_hedger_with_samples()
+    with pytest.raises(ScriptWorkerRetryException):
+        run_hedged(event_loop, hedger, [None, None])
+    assert len(hedger.tracker.samples) == 1
+
+
+@pytest.mark.parametrize('max_bytes,expected_attempts', ((0, 1), (1, 2)))
+def test_hedger_budget(event_loop, max_bytes, expected_attempts):
+    hedger = get_hedger_with_samples(max_bytes)
+    _, sessions = run_hedged(event_loop, hedger, [0.1, 0])
+    assert len(sessions) == expected_attempts
+
+
+@pytest.mark.parametrize('config,expected', (
+    ({}, False),
+    ({'hedging': {'percentile': 0.9, 'max_bytes': 10}}, True),
+))
+def test_get_hedger(config, expected):
+    context = Context()
+    context.config = dict(config, aiohttp_max_connections=2)
+    hedger = get_hedger(context)
+    assert (hedger is not None) == expected
+    if expected:
+        assert hedger.tracker.percentile == 0.9
+        assert hedger.budget.max_bytes == 10
+        assert hedger.slots._value == 2
+
+
+@pytest.mark.parametrize('transport', (None, 'native'))
+def test_hedged_upload_stall(event_loop, transport):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.txt')
+        with open(path, 'w') as fh:
+            fh.write('foobar')
+        faults = Faults(stall=1)
+
+        async def _upload(context):
+            context.config['hedging'] = {'min_samples': 3, 'min_delay': 0.1}
+            context.hedger = get_hedger(context)
+            try:
+                for index in range(3):
+                    await put_to_s3(context, 'path/{}.txt'.format(index), path, 'text/plain')
+                # the next request hangs, its duplicate doesn't
+                faults.stall_count = 1
+                await put_to_s3(context, 'path/stalled.txt', path, 'text/plain')
+            finally:
+                await context.hedger.close()
+            assert context.hedger.hedged == 1
+            assert context.hedger.won == 1
+
+        fake_s3 = run_with_fake_s3(event_loop, faults, _upload, transport=transport)
+
+    assert fake_s3.objects[(BUCKET, 'path/stalled.txt')]['body'] == b'foobar'
@@ -0,0 +1,70 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+from beetmoverscript.logs import JsonFormatter, LazyQueueHandler, setup_logging
+
+
+def make_record(msg, args=(), exc_info=None, **extra):
+    record = logging.LogRecord('beetmoverscript.script', logging.INFO, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter():
+    record = make_record("put %s: %d", ('some/key', 200), s3_key='some/key', status=200)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'put some/key: 200'
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'beetmoverscript.script'
+    assert entry['s3_key'] == 'some/key'
+    assert entry['status'] == 200
+    assert 'args' not in entry and 'exception' not in entry
+
+
+def test_json_formatter_exception():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = make_record("failed", exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(record))
+    assert 'ValueError: boom' in entry['exception']
+
+
+def test_lazy_queue_handler():
+    log_queue = queue.Queue()
+    handler = LazyQueueHandler(log_queue)
+    record = make_record("put %s", ('some/key',))
+    handler.handle(record)
+    queued = log_queue.get_nowait()
+    # the message is only formatted by the listener
+    assert queued is record
+    assert queued.args == ('some/key',)
+    assert not hasattr(queued, 'message')
+
+
+@pytest.mark.parametrize('config,script_level,botocore_level', ((
+    {}, logging.INFO, logging.WARNING,
+), (
+    {'verbose': True}, logging.DEBUG, logging.WARNING,
+), (
+    {'verbose': True, 'log_levels': {'botocore': 'DEBUG'}}, logging.DEBUG, logging.DEBUG,
+)))
+def test_setup_logging(config, script_level, botocore_level):
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    botocore_logger = logging.getLogger('botocore')
+    listener = setup_logging(dict(config, log_format='json'))
+    try:
+        assert logging.getLogger('beetmoverscript.script').getEffectiveLevel() == script_level
+        assert botocore_logger.getEffectiveLevel() == botocore_level
+        assert isinstance(listener.handlers[0].formatter, JsonFormatter)
+        assert any(isinstance(handler, LazyQueueHandler) for handler in root.handlers)
+    finally:
+        listener.stop()
+        root.handlers = handlers
+        root.setLevel(level)
+        botocore_logger.setLevel(logging.NOTSET)
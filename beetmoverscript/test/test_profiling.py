@@ -0,0 +1,107 @@
+import asyncio
+import json
+import mock
+import os
+import pstats
+import pytest
+import tempfile
+import time
+
+from scriptworker.context import Context
+from scriptworker.test import event_loop
+
+from beetmoverscript.profiling import (TaskProfiler, LoopLagMonitor,
+                                       is_profiling_enabled, run_profiled)
+from beetmoverscript.test import get_fake_valid_config
+
+assert event_loop  # silence flake8
+
+
+async def sleeper(delay):
+    await asyncio.sleep(delay)
+
+
+def test_task_profiler(event_loop):
+    profiler = TaskProfiler(event_loop)
+    profiler.install()
+    event_loop.run_until_complete(
+        asyncio.gather(asyncio.ensure_future(sleeper(0.01)), asyncio.ensure_future(sleeper(0.02)))
+    )
+    profiler.uninstall()
+
+    stats = profiler.stats()
+    assert stats['sleeper']['count'] == 2
+    assert stats['sleeper']['max'] >= 0.02
+    assert event_loop.get_task_factory() is None
+
+
+def test_loop_lag_monitor(event_loop):
+    monitor = LoopLagMonitor(interval=0.01)
+    assert monitor.stats() == {'samples': 0}
+
+    async def block():
+        await asyncio.sleep(0.02)
+        # synchronous code blocking the loop
+        time.sleep(0.1)
+        await asyncio.sleep(0.02)
+
+    task = asyncio.ensure_future(monitor.run())
+    event_loop.run_until_complete(block())
+    task.cancel()
+
+    stats = monitor.stats()
+    assert stats['samples'] > 0
+    assert stats['max'] >= 0.05
+
+
+def test_is_profiling_enabled():
+    context = Context()
+    context.config = get_fake_valid_config()
+    with mock.patch.dict(os.environ, clear=True):
+        assert is_profiling_enabled(context) is False
+        context.config['profile'] = {}
+        assert is_profiling_enabled(context) is False
+        # settings alone don't turn profiling on
+        context.config['profile'] = {'top_functions': 10}
+        assert is_profiling_enabled(context) is False
+        context.config['profile'] = {'enabled': True, 'top_functions': 10}
+        assert is_profiling_enabled(context) is True
+    del context.config['profile']
+    with mock.patch.dict(os.environ, {'BEETMOVER_PROFILE': '1'}):
+        assert is_profiling_enabled(context) is True
+
+
+def test_run_profiled(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.config['profile'] = {'loop_lag_interval': 0.01, 'top_functions': 5}
+
+    async def fake_async_main(context):
+        await asyncio.ensure_future(sleeper(0.05))
+        return 42
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['artifact_dir'] = tmpdirname
+        result = event_loop.run_until_complete(run_profiled(context, fake_async_main(context)))
+        assert result == 42
+
+        pstats.Stats(os.path.join(tmpdirname, 'public', 'profile.pstats'))
+        with open(os.path.join(tmpdirname, 'public', 'profile.json')) as fh:
+            summary = json.load(fh)
+
+    assert summary['tasks']['sleeper']['count'] == 1
+    assert summary['loop_lag']['samples'] > 0
+    assert summary['top_functions']
+
+
+def test_run_profiled_write_failure(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+
+    async def failing_async_main(context):
+        raise ValueError("task failure")
+
+    # the failure of the task is reported rather than the one of the profile
+    with mock.patch('beetmoverscript.profiling.write_profile', side_effect=OSError("disk full")):
+        with pytest.raises(ValueError):
+            event_loop.run_until_complete(run_profiled(context, failing_async_main(context)))
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import tempfile
+
+import mock
+import pytest
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerRetryException
+from scriptworker.test import event_loop
+
+from beetmoverscript.progress import (ProgressTracker, get_deadline, get_progress_tracker,
+                                      run_with_progress)
+from beetmoverscript.script import move_beets, put_to_s3
+from beetmoverscript.streaming import RemoteArtifact
+from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task
+from beetmoverscript.test.test_fake_s3 import run_with_fake_s3
+
+assert event_loop  # silence flake8
+
+
+def get_tracker(total, deadline=None, window=10):
+    with mock.patch('time.time', return_value=1000):
+        return ProgressTracker(total, deadline=deadline, window=window)
+
+
+def test_progress_tracker():
+    tracker = get_tracker(100, deadline=1030)
+    with mock.patch('time.time', return_value=1002):
+        assert tracker.eta() is None
+        tracker.add(10)
+    with mock.patch('time.time', return_value=1005):
+        assert tracker.throughput() == 2
+        assert tracker.eta() == 45
+        assert tracker.time_left() == 25
+        assert tracker.is_doomed()
+        tracker.add(40)
+        assert tracker.eta() == 5
+        assert not tracker.is_doomed()
+    # the throughput only accounts for the last window
+    with mock.patch('time.time', return_value=1013):
+        assert tracker.throughput() == 4
+    with mock.patch('time.time', return_value=1020):
+        assert tracker.eta() is None
+        assert not tracker.is_doomed()
+    with mock.patch('time.time', return_value=1031):
+        assert tracker.is_doomed()
+        tracker.add(50)
+        assert tracker.eta() == 0
+
+
+def test_progress_tracker_watched(event_loop):
+    tracker = get_tracker(100)
+    tracker.watch('a', 100, uploads=2)
+    tracker.watch_file('a.txt', 100, 'a')
+    tracker.watch_file('a.txt.gz', 10, 'a.txt')
+    assert tracker.get_meters('b.txt') == []
+
+    meter, = tracker.get_meters('a.txt')
+    event_loop.run_until_complete(meter.consume(50))
+    # half of one of the two uploads
+    assert tracker.done == 25
+    compressed_meter, = tracker.get_meters('a.txt.gz')
+    event_loop.run_until_complete(compressed_meter.consume(10))
+    assert tracker.done == 75
+    # retries never count for more than the artifact
+    event_loop.run_until_complete(meter.consume(100))
+    assert tracker.done == 100
+
+    tracker.add(100, 'a')
+    assert tracker.done == 100
+    assert tracker.files == {}
+
+
+def test_progress_tracker_in_flight(event_loop):
+    # the bytes of a big artifact are counted while it's being uploaded,
+    # rather than only the small one already done
+    tracker = get_tracker(1029 * 1024 * 1024, deadline=4000, window=60)
+    tracker.watch('big', 1024 * 1024 * 1024, uploads=1)
+    tracker.watch_file('big.zip', 1024 * 1024 * 1024, 'big')
+    meter, = tracker.get_meters('big.zip')
+    with mock.patch('time.time', return_value=1001):
+        tracker.add(5 * 1024 * 1024)
+    for second in range(1, 16):
+        with mock.patch('time.time', return_value=1000 + second):
+            event_loop.run_until_complete(meter.consume(20 * 1024 * 1024))
+    with mock.patch('time.time', return_value=1015):
+        assert tracker.eta() < 60
+        assert not tracker.is_doomed()
+
+
+def test_progress_tracker_no_deadline():
+    tracker = get_tracker(100)
+    assert tracker.time_left() is None
+    assert not tracker.is_doomed()
+
+
+@pytest.mark.parametrize('payload,config,expected', (
+    ({}, {}, None),
+    ({'maxRunTime': 600}, {}, 1480),
+    ({'maxRunTime': 600}, {'deadline_margin': 60, 'max_run_time': 60}, 1540),
+    ({}, {'max_run_time': 300, 'deadline_margin': 0}, 1300),
+))
+def test_get_deadline(payload, config, expected):
+    context = Context()
+    context.config = {'progress': config}
+    context.task = {'payload': payload}
+    context.task_start = 1000
+    assert get_deadline(context) == expected
+
+
+def test_get_progress_tracker():
+    context = Context()
+    context.config = {}
+    context.task = {'payload': {}}
+    remote = RemoteArtifact('https://fake/target.zip', 'target.zip')
+    remote.size = 1000
+    artifacts = {
+        'en-US': {'target.zip': remote, 'fake_artifact.json': 'beetmoverscript/test/fake_artifact.json'},
+        'ro': {'target.zip': RemoteArtifact('https://fake/ro/target.zip', 'target.zip')},
+    }
+    # nothing to report nor deadline to meet
+    assert get_progress_tracker(context, artifacts) is None
+
+    context.config = {'progress': {'interval': 10}}
+    tracker = get_progress_tracker(context, artifacts)
+    assert tracker.total == 1000 + 21
+    assert tracker.deadline is None
+
+
+def get_progress_context(interval=0.01, fail_early=True):
+    context = Context()
+    context.config = {'progress': {'interval': interval, 'fail_early': fail_early}}
+    return context
+
+
+def test_run_with_progress(event_loop):
+    tracker = ProgressTracker(10, deadline=None)
+
+    async def work():
+        await asyncio.sleep(0.05)
+        tracker.add(10)
+        return 'done'
+
+    assert event_loop.run_until_complete(
+        run_with_progress(get_progress_context(), tracker, work())
+    ) == 'done'
+
+
+@pytest.mark.parametrize('fail_early', (True, False))
+def test_run_with_progress_doomed(event_loop, fail_early):
+    tracker = ProgressTracker(10, deadline=0)
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return 'done'
+
+    coro = run_with_progress(get_progress_context(fail_early=fail_early), tracker, work())
+    if fail_early:
+        with pytest.raises(ScriptWorkerRetryException):
+            event_loop.run_until_complete(coro)
+        event_loop.run_until_complete(asyncio.sleep(0))
+        assert cancelled == [True]
+    else:
+        assert event_loop.run_until_complete(coro) == 'done'
+
+
+@pytest.mark.parametrize('transport', (None, 'native'))
+def test_progress_counted_as_sent(event_loop, transport):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.zip')
+        with open(path, 'wb') as fh:
+            fh.write(b'0' * 1000000)
+
+        async def _upload(context):
+            context.progress = ProgressTracker(1000000)
+            context.progress.watch(path, 1000000, uploads=2)
+            context.progress.watch_file(path, 1000000, path)
+            # unthrottled files are sent as is
+            with mock.patch('beetmoverscript.script.ThrottledFileReader') as script_reader, \
+                    mock.patch('beetmoverscript.transport.ThrottledFileReader') as transport_reader:
+                await put_to_s3(context, 'path/target.zip', path, 'application/zip')
+            assert not script_reader.called and not transport_reader.called
+            assert context.progress.done == 500000
+            context.progress.add(1000000, path)
+            assert context.progress.done == 1000000
+
+        run_with_fake_s3(event_loop, None, _upload, transport=transport)
+
+
+def test_move_beets_cancelled(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+    manifest = {'s3_bucket_path': 'pub/', 'mapping': {'en-US': {
+        artifact: {'s3_key': artifact, 'destinations': [artifact]} for artifact in ('a', 'b')
+    }}}
+    cancelled = []
+
+    async def fake_move_beet(context, source, destinations, locale,
+                             update_balrog_manifest, artifact_pretty_name):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(source)
+            raise
+
+    async def run():
+        beets = asyncio.ensure_future(move_beets(context, {'en-US': {'a': 'a', 'b': 'b'}}, manifest))
+        await asyncio.sleep(0.01)
+        beets.cancel()
+        await asyncio.wait([beets])
+        await asyncio.sleep(0)
+
+    with mock.patch('beetmoverscript.script.move_beet', fake_move_beet):
+        event_loop.run_until_complete(run())
+    assert sorted(cancelled) == ['a', 'b']
+
+
+def test_move_beets_balrog_first(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.task = get_fake_valid_task()
+    artifacts_to_beetmove = {
+        'en-US': {'a.txt': 'a.txt', 'target.mar': 'target.mar'},
+        'ro': {'b.txt': 'b.txt', 'target.mar': 'ro/target.mar'},
+    }
+    manifest = {'s3_bucket_path': 'pub/', 'mapping': {
+        locale: {
+            artifact: {'s3_key': artifact, 'destinations': [artifact],
+                       'update_balrog_manifest': artifact.endswith('.mar')}
+            for artifact in artifacts
+        } for locale, artifacts in artifacts_to_beetmove.items()
+    }}
+    started = []
+
+    async def fake_move_beet(context, source, destinations, locale,
+                             update_balrog_manifest, artifact_pretty_name):
+        started.append(source)
+
+    with mock.patch('beetmoverscript.script.move_beet', fake_move_beet):
+        event_loop.run_until_complete(move_beets(context, artifacts_to_beetmove, manifest))
+    assert sorted(started[:2]) == ['ro/target.mar', 'target.mar']
+    assert sorted(started[2:]) == ['a.txt', 'b.txt']
@@ -0,0 +1,101 @@
+import io
+import mock
+import os
+import pytest
+import tempfile
+import time
+
+from scriptworker.context import Context
+from scriptworker.test import event_loop
+
+from beetmoverscript.ratelimit import (TokenBucket, SharedTokenBucket,
+                                       ThrottledFileReader, get_rate_limiters)
+from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task
+
+assert event_loop  # silence flake8
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, burst=100)
+    # the initial burst is free, going in debt has to be waited for
+    assert bucket.take(100) == 0
+    assert bucket.take(50) == pytest.approx(0.5, abs=0.01)
+
+
+def test_shared_token_bucket(event_loop):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        state_file = os.path.join(tmpdirname, 'state.json')
+        release = SharedTokenBucket(state_file, rate=100, burst=100, weight=4)
+        nightly = SharedTokenBucket(state_file, rate=100, burst=100)
+        assert release.sync() == 1
+        # the weights set the share of each process, which add up to the
+        # host rate
+        assert nightly.sync() == pytest.approx(0.2)
+        assert release.sync() == pytest.approx(0.8)
+
+        event_loop.run_until_complete(nightly.consume(10))
+        assert nightly.rate == pytest.approx(20)
+        assert nightly.burst == pytest.approx(20)
+        assert nightly.take(30) == pytest.approx(1, abs=0.01)
+
+        # the state file is only synced once per batch
+        with mock.patch.object(nightly, 'sync') as sync:
+            event_loop.run_until_complete(nightly.consume(1))
+            assert not sync.called
+            nightly.unsynced = nightly.batch_size
+            sync.return_value = 0.5
+            event_loop.run_until_complete(nightly.consume(1))
+            assert sync.called
+        assert nightly.rate == pytest.approx(50)
+
+
+def test_shared_token_bucket_expired_consumers():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        state_file = os.path.join(tmpdirname, 'state.json')
+        first = SharedTokenBucket(state_file, rate=100)
+        second = SharedTokenBucket(state_file, rate=100)
+        first.sync()
+        with mock.patch('time.time', return_value=time.time() + 60):
+            assert second.sync() == 1
+
+
+def test_throttled_file_reader(event_loop):
+    consumed = []
+
+    class FakeBucket(object):
+        async def consume(self, amount):
+            consumed.append(amount)
+
+    data = b'x' * 10
+
+    async def read_all():
+        chunks = []
+        async for chunk in ThrottledFileReader(io.BytesIO(data), [FakeBucket(), FakeBucket()], chunk_size=4):
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    assert event_loop.run_until_complete(read_all()) == data
+    assert consumed == [4, 4, 4, 4, 2, 2]
+
+
+@pytest.mark.parametrize("host_config,task_rate,expected_types,expected_weight", [
+    (None, None, [], None),
+    ({'rate': 100}, None, [TokenBucket], None),
+    ({'rate': 100, 'weights': {'nightly': 2}}, 50, [TokenBucket, TokenBucket], None),
+    ({'rate': 100, 'state_file': 'state.json'}, None, [SharedTokenBucket], 1),
+    ({'rate': 100, 'state_file': 'state.json', 'weights': {'nightly': 2}}, None, [SharedTokenBucket], 2),
+])
+def test_get_rate_limiters(host_config, task_rate, expected_types, expected_weight):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.task = get_fake_valid_task()
+    context.bucket = 'nightly'
+    if host_config:
+        context.config['upload_rate_limit'] = host_config
+    if task_rate:
+        context.task['payload']['upload_rate_limit'] = task_rate
+
+    limiters = get_rate_limiters(context)
+    assert [type(limiter) for limiter in limiters] == expected_types
+    if expected_weight:
+        assert limiters[0].weight == expected_weight
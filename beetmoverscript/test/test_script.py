@@ -1,17 +1,32 @@
+import asyncio
+import concurrent.futures
+import gzip
+import hashlib
 import mimetypes
 import os
 
 import mock
 import pytest
 import sys
+import tempfile
+import threading
+import urllib.parse
 from yarl import URL
 
 from beetmoverscript.script import (setup_mimetypes, setup_config, put,
                                     move_beets, move_beet, async_main,
-                                    main)
+                                    main, verify_beets, get_object_mismatches,
+                                    get_body_mismatches, get_compression,
+                                    upload_to_s3, retry_upload, is_unchanged_object,
+                                    copy, push_to_releases, get_copy_plan,
+                                    list_s3_objects, copy_object, prewarm_connections,
+                                    get_targets, get_prewarm_urls, get_transport,
+                                    get_s3_client, get_checksums, dedup_upload,
+                                    discard_compressed_artifacts)
+from beetmoverscript.ratelimit import TokenBucket, ThrottledFileReader
 from beetmoverscript.task import get_upstream_artifacts
 from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task, get_fake_balrog_props
-from beetmoverscript.utils import generate_beetmover_manifest
+from beetmoverscript.utils import generate_beetmover_manifest, get_hash
 from scriptworker.context import Context
 from scriptworker.exceptions import (ScriptWorkerRetryException,
                                      ScriptWorkerTaskException)
@@ -140,6 +155,9 @@ def test_move_beet(event_loop):
     context.config = get_fake_valid_config()
     context.task = get_fake_valid_task()
     context.checksums = dict()
+    context.destination_checksums = dict()
+    context.file_checksums = dict()
+    context.digest_cache = None
     context.balrog_manifest = list()
     context.release_props = get_fake_balrog_props()["properties"]
     context.release_props['platform'] = context.release_props['stage_platform']
@@ -162,9 +180,11 @@ def test_move_beet(event_loop):
         'url': 'https://archive.mozilla.org/pub/mobile/nightly/2016/09/2016-09-01-16-26-14-mozilla-central-fake/en-US/fake-99.0a1.en-US.target.txt',
     }
     actual_upload_args = []
+    actual_metadata = {}
 
-    async def fake_retry_upload(context, destinations, path):
+    async def fake_retry_upload(context, destinations, path, metadata=None):
         actual_upload_args.extend([destinations, path])
+        actual_metadata.update(metadata)
 
     with mock.patch('beetmoverscript.script.retry_upload', fake_retry_upload):
         event_loop.run_until_complete(
@@ -172,11 +192,658 @@ def test_move_beet(event_loop):
                       update_balrog_manifest=True, artifact_pretty_name=pretty_name)
         )
     assert expected_upload_args == actual_upload_args
+    assert sorted(actual_metadata.keys()) == ['sha256', 'sha512']
+    assert actual_metadata['sha512'] == expected_balrog_manifest['hash']
     for k in expected_balrog_manifest.keys():
         assert (context.balrog_manifest[0]['completeInfo'][0][k] ==
                 expected_balrog_manifest[k])
 
 
+@pytest.mark.parametrize("compression_config,path,expected", [
+    (None, 'beetmoverscript/test/fake_artifact.json', None),
+    ({'files': ['artifact']}, 'beetmoverscript/test/fake_artifact.json', 'content-encoding'),
+    ({'files': ['artifact'], 'mime_types': ['application/json']},
+     'beetmoverscript/test/fake_artifact.json', 'content-encoding'),
+    ({'files': ['artifact'], 'mime_types': ['application/json'], 'mode': 'sidecar'},
+     'beetmoverscript/test/fake_artifact.json', 'sidecar'),
+    ({'files': ['artifact'], 'mime_types': ['application/json'], 'min_size': 1024 * 1024},
+     'beetmoverscript/test/fake_artifact.json', None),
+    ({'files': ['artifact'], 'mime_types': ['text/plain']}, 'beetmoverscript/test/fake_artifact.json', None),
+    # compressing is opt-in per file, whatever their mime type
+    ({'mime_types': ['application/json']}, 'beetmoverscript/test/fake_artifact.json', None),
+    ({'files': [r'\.mozinfo\.json$'], 'mime_types': ['application/json']},
+     'beetmoverscript/test/fake_artifact.json', None),
+])
+def test_get_compression(compression_config, path, expected):
+    context = Context()
+    context.config = get_fake_valid_config()
+    if compression_config:
+        context.config['compression'] = compression_config
+    assert get_compression(context, path) == expected
+
+
+@pytest.mark.parametrize("mode,expected_uploads", [
+    ('content-encoding', [('fake_artifact.json', 'application/json', 'gzip')]),
+    ('sidecar', [('fake_artifact.json', 'application/json', None),
+                 ('fake_artifact.json.gz', 'application/gzip', None)]),
+])
+def test_upload_to_s3_compression(event_loop, mode, expected_uploads):
+    context, _ = get_verification_context(None)
+    context.compressed_artifacts = dict()
+    context.config['compression'] = {'files': ['json$'], 'mode': mode}
+    path = 'beetmoverscript/test/fake_artifact.json'
+    actual_uploads = []
+
+    async def fake_put(context, url, headers, abs_filename, session=None):
+        actual_uploads.append((URL(url).name, headers['Content-Type'],
+                               headers.get('Content-Encoding')))
+        with open(abs_filename, 'rb') as fh:
+            if headers['Content-Type'] == 'application/gzip' or headers.get('Content-Encoding'):
+                assert gzip.decompress(fh.read()) == open(path, 'rb').read()
+
+    with mock.patch('beetmoverscript.script.put', fake_put):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            context.config['work_dir'] = tmpdirname
+            event_loop.run_until_complete(
+                upload_to_s3(context, 'dest/fake_artifact.json', path)
+            )
+            assert len(os.listdir(tmpdirname)) == 1
+            event_loop.run_until_complete(discard_compressed_artifacts(context))
+            assert os.listdir(tmpdirname) == []
+            assert context.compression_executor is None
+    assert actual_uploads == expected_uploads
+
+
+class FakeVerificationResponse(object):
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeVerificationSession(object):
+
+    def __init__(self, headers, body, status=200):
+        self.headers = headers
+        self.body = body
+        self.status = status
+        self.requests = []
+
+    def head(self, url):
+        self.requests.append('HEAD')
+        return FakeVerificationResponse(self.status, self.headers, b'')
+
+    def get(self, url):
+        self.requests.append('GET')
+        return FakeVerificationResponse(self.status, self.headers, self.body)
+
+    def put(self, url, headers, data=None, compress=None):
+        self.requests.append('PUT')
+        self.put_headers = headers
+        self.put_data = data
+        return FakeVerificationResponse(self.status, self.headers, self.body)
+
+
+def get_verification_context(session, full_get_max_size=1024):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.config['bucket_config'] = {
+        'nightly': {
+            'credentials': {'id': 'dummy', 'key': 'dummy'},
+            'buckets': {'fake': 'fake-nightly-bucket'},
+        }
+    }
+    context.config['upload_verification'] = {
+        'max_concurrency': 2,
+        'timeout': 10,
+        'full_get_max_size': full_get_max_size,
+    }
+    context.bucket = 'nightly'
+    context.release_props = get_fake_balrog_props()["properties"]
+    context.session = session
+    context.digest_cache = None
+    body = b'Hello world from beetmoverscript!'
+    context.checksums = {
+        'fake-99.0a1.en-US.target.txt': {
+            'sha512': hashlib.sha512(body).hexdigest(),
+            'sha256': hashlib.sha256(body).hexdigest(),
+            'size': len(body),
+        }
+    }
+    return context, body
+
+
+def get_verification_manifest():
+    artifacts_to_beetmove = {'en-US': {'target.txt': 'beetmoverscript/test/fake_artifact.json'}}
+    manifest = {
+        's3_bucket_path': 'pub/mobile/nightly/',
+        'mapping': {
+            'en-US': {
+                'target.txt': {
+                    's3_key': 'fake-99.0a1.en-US.target.txt',
+                    'destinations': ['dated/fake-99.0a1.en-US.target.txt',
+                                     'latest/fake-99.0a1.en-US.target.txt'],
+                }
+            }
+        }
+    }
+    return artifacts_to_beetmove, manifest
+
+
+def test_get_object_mismatches():
+    expected = {'sha512': 'abc', 'md5': 'd41d', 'size': 3}
+    headers = {'Content-Length': '3', 'ETag': '"d41d"', 'x-amz-meta-sha512': 'abc'}
+    assert get_object_mismatches(headers, expected, ['sha512']) == []
+
+    headers = {'Content-Length': '4', 'ETag': '"beef"', 'x-amz-meta-sha512': 'def'}
+    assert len(get_object_mismatches(headers, expected, ['sha512'])) == 3
+
+    # encoded objects and multipart ETags can't be compared
+    headers = {'Content-Length': '1', 'Content-Encoding': 'gzip', 'ETag': '"beef-2"'}
+    assert get_object_mismatches(headers, expected, ['sha512']) == []
+    headers = {'Content-Length': '1', 'Content-Encoding': 'gzip', 'ETag': '"beef"'}
+    assert get_object_mismatches(headers, expected, ['sha512']) == []
+
+
+def test_get_body_mismatches():
+    body = b'Hello world from beetmoverscript!'
+    expected = {'sha256': hashlib.sha256(body).hexdigest()}
+    assert get_body_mismatches(body, expected, ['sha256']) == []
+    assert len(get_body_mismatches(b'corrupted', expected, ['sha256'])) == 1
+
+
+@pytest.mark.parametrize("full_get_max_size,expected_requests", [
+    (1024, ['HEAD', 'GET', 'HEAD', 'GET']),
+    (1, ['HEAD', 'HEAD']),
+])
+def test_verify_beets(event_loop, full_get_max_size, expected_requests):
+    session = FakeVerificationSession({}, None)
+    context, body = get_verification_context(session, full_get_max_size)
+    session.body = body
+    session.headers = {
+        'Content-Length': str(len(body)),
+        'x-amz-meta-sha512': hashlib.sha512(body).hexdigest(),
+    }
+    artifacts_to_beetmove, manifest = get_verification_manifest()
+
+    event_loop.run_until_complete(
+        verify_beets(context, artifacts_to_beetmove, manifest)
+    )
+    assert session.requests == expected_requests
+
+
+@pytest.mark.parametrize("status,headers,body", [
+    (404, {}, b''),
+    (200, {'Content-Length': '1'}, b''),
+    (200, {}, b'corrupted'),
+])
+def test_verify_beets_failure(event_loop, status, headers, body):
+    session = FakeVerificationSession(headers, body, status=status)
+    context, _ = get_verification_context(session)
+    context.digest_cache = mock.MagicMock()
+    artifacts_to_beetmove, manifest = get_verification_manifest()
+
+    with pytest.raises(ScriptWorkerRetryException):
+        event_loop.run_until_complete(
+            verify_beets(context, artifacts_to_beetmove, manifest)
+        )
+    if status == 200:
+        context.digest_cache.invalidate.assert_called_with('beetmoverscript/test/fake_artifact.json')
+
+
+@pytest.mark.parametrize("headers,compression,expected", [
+    ({'x-amz-meta-sha512': 'abc'}, None, True),
+    ({'x-amz-meta-sha512': 'def'}, None, False),
+    ({}, None, False),
+    ({'x-amz-meta-sha512': 'abc', 'Content-Encoding': 'gzip'}, None, False),
+    ({'x-amz-meta-sha512': 'abc', 'Content-Encoding': 'gzip'}, 'content-encoding', True),
+    ({'x-amz-meta-sha512': 'abc'}, 'content-encoding', False),
+])
+def test_is_unchanged_object(headers, compression, expected):
+    context = Context()
+    context.config = get_fake_valid_config()
+    if compression:
+        context.config['compression'] = {'files': ['json$'], 'mode': compression}
+    path = 'beetmoverscript/test/fake_artifact.json'
+    assert is_unchanged_object(context, headers, path, {'sha512': 'abc'}) is expected
+
+
+@pytest.mark.parametrize("metadata,head_status,expected_uploads,expected_copies", [
+    (None, 200, ['dated/target.txt', 'latest-foo/target.txt'], []),
+    ({'sha512': 'abc'}, 200, ['dated/target.txt'], []),
+    ({'sha512': 'def'}, 200, ['dated/target.txt'], [('dated/target.txt', 'latest-foo/target.txt')]),
+    ({'sha512': 'abc'}, 404, ['dated/target.txt'], [('dated/target.txt', 'latest-foo/target.txt')]),
+])
+def test_retry_upload_delta(event_loop, metadata, head_status, expected_uploads, expected_copies):
+    session = FakeVerificationSession({'x-amz-meta-sha512': 'abc'}, b'', status=head_status)
+    context, _ = get_verification_context(session)
+    context.config['delta_upload_patterns'] = ['latest-']
+    actual_uploads = []
+    actual_copies = []
+
+    async def fake_upload_to_s3(context, s3_key, path, metadata=None):
+        actual_uploads.append(s3_key)
+
+    async def fake_copy_in_s3(context, source_key, s3_key):
+        actual_copies.append((source_key, s3_key))
+
+    with mock.patch('beetmoverscript.script.upload_to_s3', fake_upload_to_s3):
+        with mock.patch('beetmoverscript.script.copy_in_s3', fake_copy_in_s3):
+            event_loop.run_until_complete(
+                retry_upload(context, ['dated/target.txt', 'latest-foo/target.txt'],
+                             'beetmoverscript/test/fake_artifact.json', metadata=metadata)
+            )
+    assert actual_uploads == expected_uploads
+    assert actual_copies == expected_copies
+
+
+@pytest.mark.parametrize("status,body,raises", [
+    (200, b'<CopyObjectResult></CopyObjectResult>', False),
+    (200, b'<Error><Code>InternalError</Code></Error>', True),
+    (500, b'', True),
+])
+def test_copy(event_loop, status, body, raises):
+    session = FakeVerificationSession({}, body, status=status)
+    context, _ = get_verification_context(session)
+    headers = {'x-amz-copy-source': 'fake-nightly-bucket/dated/target.txt'}
+    if raises:
+        with pytest.raises(ScriptWorkerRetryException):
+            event_loop.run_until_complete(copy(context, 'https://fake/url', headers))
+    else:
+        event_loop.run_until_complete(copy(context, 'https://fake/url', headers))
+    assert session.requests == ['PUT']
+
+
+def test_put_rate_limited(event_loop):
+    session = FakeVerificationSession({}, b'', status=200)
+    context, _ = get_verification_context(session)
+    context.rate_limiters = [TokenBucket(rate=1024 * 1024)]
+    path = 'beetmoverscript/test/fake_artifact.json'
+    event_loop.run_until_complete(
+        put(context, url='https://fake/url', headers={}, abs_filename=path)
+    )
+    assert isinstance(session.put_data, ThrottledFileReader)
+    assert session.put_headers['Content-Length'] == str(os.path.getsize(path))
+
+
+class FakeS3Client(object):
+
+    def __init__(self, keys):
+        self.objects = {
+            key: {'Key': key, 'Size': 10, 'ETag': '"{}"'.format(key)} for key in keys
+        }
+        self.copies = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        contents = []
+        common_prefixes = set()
+        for key in sorted(self.objects):
+            if not key.startswith(Prefix):
+                continue
+            remainder = key[len(Prefix):]
+            if Delimiter and Delimiter in remainder:
+                common_prefixes.add(Prefix + remainder.split(Delimiter)[0] + Delimiter)
+            else:
+                contents.append(self.objects[key])
+        # a first page holding no objects to make sure all pages are walked
+        yield {}
+        yield {
+            'Contents': contents,
+            'CommonPrefixes': [{'Prefix': prefix} for prefix in sorted(common_prefixes)],
+        }
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective):
+        self.copies.append((CopySource['Key'], Key))
+        self.objects[Key] = dict(self.objects[CopySource['Key']], Key=Key)
+
+
+def get_release_context():
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.config['bucket_config'] = {
+        'release': {
+            'credentials': {'id': 'dummy', 'key': 'dummy'},
+            'buckets': {'firefox': 'fake-release-bucket'},
+        }
+    }
+    context.bucket = 'release'
+    context.task = get_fake_valid_task()
+    context.task['payload'] = {'product': 'Firefox', 'version': '53.0', 'build_number': 3}
+    return context
+
+
+CANDIDATES_KEYS = [
+    'pub/firefox/candidates/53.0-candidates/build3/KEY',
+    'pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/en-US/firefox-53.0.tar.bz2',
+    'pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/ro/firefox-53.0.tar.bz2',
+    'pub/firefox/candidates/53.0-candidates/build3/logs/release-build.log',
+    'pub/firefox/candidates/53.0-candidates/build3/mac/en-US/Firefox 53.0.dmg',
+    'pub/firefox/candidates/53.0-candidates/build2/mac/en-US/Firefox 53.0.dmg',
+]
+
+
+def test_list_s3_objects(event_loop):
+    s3 = FakeS3Client(CANDIDATES_KEYS)
+    objects = event_loop.run_until_complete(
+        list_s3_objects(s3, 'fake-release-bucket', 'pub/firefox/candidates/53.0-candidates/build3/')
+    )
+    assert sorted(objects.keys()) == sorted(CANDIDATES_KEYS[:5])
+
+
+def test_get_copy_plan():
+    candidates_prefix = 'pub/firefox/candidates/53.0-candidates/build3/'
+    releases_prefix = 'pub/firefox/releases/53.0/'
+    candidates = {
+        candidates_prefix + 'a': {'Size': 1, 'ETag': '"a"'},
+        candidates_prefix + 'b': {'Size': 1, 'ETag': '"b"'},
+        candidates_prefix + 'c': {'Size': 1, 'ETag': '"c-2"'},
+        candidates_prefix + 'd': {'Size': 1, 'ETag': '"d"'},
+        candidates_prefix + 'e.log': {'Size': 1, 'ETag': '"e"'},
+    }
+    releases = {
+        releases_prefix + 'b': {'Size': 1, 'ETag': '"b"'},
+        releases_prefix + 'c': {'Size': 1, 'ETag': '"other-3"'},
+        releases_prefix + 'd': {'Size': 2, 'ETag': '"d"'},
+    }
+    assert get_copy_plan(candidates, releases, candidates_prefix, releases_prefix, [r'\.log$']) == [
+        (candidates_prefix + 'a', releases_prefix + 'a', 1, False),
+        # multipart ETags can't be compared, the digests will be
+        (candidates_prefix + 'c', releases_prefix + 'c', 1, True),
+        (candidates_prefix + 'd', releases_prefix + 'd', 1, False),
+    ]
+
+
+@pytest.mark.parametrize("source_metadata,dest_metadata,expected_copy", [
+    ({'sha512': 'abc'}, {'sha512': 'abc'}, False),
+    ({'sha512': 'abc'}, {'sha512': 'def'}, True),
+    ({'sha512': 'abc'}, {}, True),
+    ({}, {}, True),
+])
+def test_copy_object_compare_digests(source_metadata, dest_metadata, expected_copy):
+    s3 = mock.MagicMock()
+    s3.head_object.side_effect = lambda Bucket, Key: {
+        'ContentType': 'application/x-tar',
+        'Metadata': source_metadata if Key == 'candidates/a' else dest_metadata,
+    }
+    copy_object(s3, 'fake-release-bucket', 'candidates/a', 'releases/a', 10, compare_digests=True)
+    assert s3.copy_object.called is expected_copy
+
+
+@pytest.mark.parametrize("size,expected_method", [
+    (10, 'copy_object'),
+    (6 * 1024 * 1024 * 1024, 'copy'),
+])
+def test_copy_object(size, expected_method):
+    s3 = mock.MagicMock()
+    s3.head_object.return_value = {'ContentType': 'application/x-tar', 'Metadata': {'sha512': 'abc'}}
+    copy_object(s3, 'fake-release-bucket', 'candidates/a', 'releases/a', size)
+    assert getattr(s3, expected_method).called
+    if expected_method == 'copy':
+        assert s3.copy.call_args[1]['ExtraArgs'] == {'ContentType': 'application/x-tar',
+                                                     'Metadata': {'sha512': 'abc'}}
+
+
+def test_push_to_releases(event_loop):
+    context = get_release_context()
+    s3 = FakeS3Client(CANDIDATES_KEYS)
+
+    with mock.patch('beetmoverscript.script.get_s3_client', return_value=s3):
+        event_loop.run_until_complete(push_to_releases(context))
+        assert sorted(s3.copies) == [
+            ('pub/firefox/candidates/53.0-candidates/build3/KEY',
+             'pub/firefox/releases/53.0/KEY'),
+            ('pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/en-US/firefox-53.0.tar.bz2',
+             'pub/firefox/releases/53.0/linux-x86_64/en-US/firefox-53.0.tar.bz2'),
+            ('pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/ro/firefox-53.0.tar.bz2',
+             'pub/firefox/releases/53.0/linux-x86_64/ro/firefox-53.0.tar.bz2'),
+            ('pub/firefox/candidates/53.0-candidates/build3/mac/en-US/Firefox 53.0.dmg',
+             'pub/firefox/releases/53.0/mac/en-US/Firefox 53.0.dmg'),
+        ]
+
+        # a rerun doesn't copy anything again
+        s3.copies = []
+        event_loop.run_until_complete(push_to_releases(context))
+        assert s3.copies == []
+
+
+def test_push_to_releases_concurrency(event_loop):
+    # the copies run in a pool of their own, as many at once as configured,
+    # whatever the size of the default executor
+    context = get_release_context()
+    context.config['copy_max_concurrency'] = 10
+    keys = ['pub/firefox/candidates/53.0-candidates/build3/{}.dmg'.format(i) for i in range(10)]
+    s3 = FakeS3Client(keys)
+    barrier = threading.Barrier(10, timeout=5)
+    copy_object = s3.copy_object
+
+    def concurrent_copy_object(**kwargs):
+        barrier.wait()
+        copy_object(**kwargs)
+
+    s3.copy_object = concurrent_copy_object
+    default_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    event_loop.set_default_executor(default_executor)
+    try:
+        with mock.patch('beetmoverscript.script.get_s3_client', return_value=s3):
+            event_loop.run_until_complete(push_to_releases(context))
+    finally:
+        default_executor.shutdown()
+    assert len(s3.copies) == 10
+
+
+def test_push_to_releases_no_candidates(event_loop):
+    context = get_release_context()
+    s3 = FakeS3Client([])
+
+    with mock.patch('beetmoverscript.script.get_s3_client', return_value=s3):
+        with pytest.raises(ScriptWorkerTaskException):
+            event_loop.run_until_complete(push_to_releases(context))
+
+
+def test_push_to_releases_forbidden_bucket(event_loop):
+    context = get_release_context()
+    context.bucket = 'nightly'
+
+    with pytest.raises(ScriptWorkerTaskException):
+        event_loop.run_until_complete(push_to_releases(context))
+
+
+@pytest.mark.parametrize("connections,expected_requests", [
+    (None, []),
+    (3, ['HEAD', 'HEAD', 'HEAD']),
+])
+def test_prewarm_connections(event_loop, connections, expected_requests):
+    session = FakeVerificationSession({}, b'', status=403)
+    context, _ = get_verification_context(session)
+    # both products share the same bucket, hence the same endpoint
+    context.config['bucket_config']['nightly']['buckets']['firefox'] = 'fake-nightly-bucket'
+    if connections:
+        context.config['aiohttp_prewarm_connections'] = connections
+    context.targets = get_targets(context)
+    event_loop.run_until_complete(prewarm_connections(context))
+    assert session.requests == expected_requests
+
+
+def test_prewarm_connections_replicas(event_loop):
+    session = FakeVerificationSession({}, b'', status=403)
+    context, _ = get_verification_context(session)
+    context.config['aiohttp_prewarm_connections'] = 1
+    context.config['bucket_config']['nightly']['replicas'] = [{
+        'name': 'replica',
+        'endpoint_url': 'https://replica.example.com',
+        'credentials': {'id': 'dummy', 'key': 'dummy'},
+        'buckets': {'fake': 'replica-bucket'},
+    }, {
+        'name': 'mirror',
+        'transport': 'local',
+        'root': '/builds/mirror',
+        'buckets': {'fake': 'mirror-bucket'},
+    }]
+    context.targets = get_targets(context)
+    event_loop.run_until_complete(prewarm_connections(context))
+    assert session.requests == ['HEAD', 'HEAD']
+    # the clients are kept for the uploads
+    assert context.s3_client is not None
+    assert context.targets[1].s3_client is not None
+    assert context.targets[2].s3_client is None
+
+
+@pytest.mark.parametrize("bucket_config", [
+    {},
+    {'region': 'us-west-2'},
+    {'endpoint_url': 'https://s3.example.com'},
+])
+def test_get_prewarm_urls_native(bucket_config):
+    context, _ = get_verification_context(FakeVerificationSession({}, b''))
+    context.config['bucket_config']['nightly'].update(bucket_config, transport='native')
+    context.targets = get_targets(context)
+    # the native transport reuses the prewarmed connections
+    prewarmed = list(get_prewarm_urls(context))
+    assert prewarmed == [urllib.parse.urlsplit(get_transport(context).get_url('foo')).netloc]
+
+
+def test_prewarm_connections_failure(event_loop):
+    session = FakeVerificationSession({}, b'')
+    session.head = mock.Mock(side_effect=ValueError("connection reset"))
+    context, _ = get_verification_context(session)
+    context.config['aiohttp_prewarm_connections'] = 2
+    context.targets = get_targets(context)
+    # failures to prewarm don't bubble up
+    event_loop.run_until_complete(prewarm_connections(context))
+    assert session.head.call_count == 2
+
+
+def test_get_s3_client():
+    context, _ = get_verification_context(None)
+    assert get_s3_client(context) is get_s3_client(context)
+
+
+def test_get_checksums(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.file_checksums = dict()
+    context.digest_cache = None
+    text = b'Hello world from beetmoverscript!'
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.txt')
+        link = os.path.join(tmpdirname, 'target.link.txt')
+        with open(path, 'wb') as fh:
+            fh.write(text)
+        os.link(path, link)
+
+        with mock.patch('beetmoverscript.script.get_hash', wraps=get_hash) as hash_mock:
+            checksums = event_loop.run_until_complete(get_checksums(context, path))
+            assert event_loop.run_until_complete(get_checksums(context, link)) == checksums
+        # the hardlink has been read only once
+        assert hash_mock.call_count == len(context.config['checksums_digests'])
+
+    assert checksums == {
+        'sha512': hashlib.sha512(text).hexdigest(),
+        'sha256': hashlib.sha256(text).hexdigest(),
+        'size': len(text),
+    }
+
+
+def test_dedup_upload(event_loop):
+    context, _ = get_verification_context(None)
+    context.uploaded_contents = dict()
+    context.config['delta_upload_patterns'] = ['latest-']
+    path = 'beetmoverscript/test/fake_artifact.json'
+    actual_uploads = []
+    actual_copies = []
+    actual_delta_updates = []
+
+    async def fake_retry_upload(context, destinations, path, metadata=None):
+        actual_uploads.append(destinations)
+
+    async def fake_copy_destination(context, copy_source, s3_key, path):
+        actual_copies.append((copy_source, s3_key))
+
+    async def fake_update_delta_destination(context, s3_key, path, metadata, copy_source=None):
+        actual_delta_updates.append((copy_source, s3_key))
+
+    async def upload_all():
+        await asyncio.gather(
+            dedup_upload(context, ['en-US/a', 'latest-foo/en-US/a'], path, {'sha512': 'abc'}),
+            dedup_upload(context, ['ro/a', 'latest-foo/ro/a'], path, {'sha512': 'abc'}),
+            dedup_upload(context, ['ro/b'], path, {'sha512': 'def'}),
+        )
+
+    with mock.patch('beetmoverscript.script.retry_upload', fake_retry_upload):
+        with mock.patch('beetmoverscript.script.copy_destination', fake_copy_destination):
+            with mock.patch('beetmoverscript.script.update_delta_destination', fake_update_delta_destination):
+                event_loop.run_until_complete(upload_all())
+
+    assert actual_uploads == [['en-US/a', 'latest-foo/en-US/a'], ['ro/b']]
+    assert actual_copies == [('en-US/a', 'ro/a')]
+    assert actual_delta_updates == [('en-US/a', 'latest-foo/ro/a')]
+
+
+def test_dedup_upload_headers(event_loop):
+    context, _ = get_verification_context(None)
+    context.uploaded_contents = dict()
+    actual_uploads = []
+
+    async def fake_retry_upload(context, destinations, path, metadata=None):
+        actual_uploads.append(destinations)
+
+    async def upload_all():
+        await asyncio.gather(
+            dedup_upload(context, ['en-US/a.json'], 'fake_artifact.json', {'sha512': 'abc'}),
+            dedup_upload(context, ['en-US/a.txt'], 'fake_artifact.txt', {'sha512': 'abc'}),
+        )
+
+    # identical contents uploaded with another Content-Type are not copied
+    with mock.patch('beetmoverscript.script.retry_upload', fake_retry_upload):
+        with mock.patch('beetmoverscript.script.copy_destination') as copy_destination:
+            event_loop.run_until_complete(upload_all())
+    assert not copy_destination.called
+    assert actual_uploads == [['en-US/a.json'], ['en-US/a.txt']]
+
+
+def test_dedup_upload_failure(event_loop):
+    context, _ = get_verification_context(None)
+    context.uploaded_contents = dict()
+    path = 'beetmoverscript/test/fake_artifact.json'
+    actual_uploads = []
+
+    async def fake_retry_upload(context, destinations, path, metadata=None):
+        actual_uploads.append(destinations)
+        if destinations == ['en-US/a']:
+            raise ScriptWorkerRetryException("upload failed")
+
+    async def upload_all():
+        return await asyncio.gather(
+            dedup_upload(context, ['en-US/a'], path, {'sha512': 'abc'}),
+            dedup_upload(context, ['ro/a'], path, {'sha512': 'abc'}),
+            return_exceptions=True,
+        )
+
+    with mock.patch('beetmoverscript.script.retry_upload', fake_retry_upload):
+        results = event_loop.run_until_complete(upload_all())
+
+    # the duplicate gets uploaded on its own when the first upload failed
+    assert isinstance(results[0], ScriptWorkerRetryException)
+    assert actual_uploads == [['en-US/a'], ['ro/a']]
+
+
 def test_async_main(event_loop):
     context = Context()
     context.config = get_fake_valid_config()
@@ -190,6 +857,45 @@ def test_async_main(event_loop):
         )
 
 
+def test_async_main_dry_run(event_loop):
+    context = Context()
+    context.config = get_fake_valid_config()
+    task = get_fake_valid_task()
+    task['payload']['dry_run'] = True
+
+    async def fake_move_beets(context, artifacts_to_beetmove, manifest):
+        assert False, "dry-runs must not upload anything"
+
+    async def fake_prewarm_connections(context):
+        assert False, "dry-runs must not touch S3"
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['artifact_dir'] = tmpdirname
+        os.makedirs(os.path.join(tmpdirname, 'public'))
+        with mock.patch('beetmoverscript.script.move_beets', new=fake_move_beets):
+            with mock.patch('beetmoverscript.script.prewarm_connections', new=fake_prewarm_connections):
+                with mock.patch('beetmoverscript.script.get_task', return_value=task):
+                    event_loop.run_until_complete(async_main(context))
+        assert os.listdir(os.path.join(tmpdirname, 'public')) == ['upload_plan.json']
+
+
+def test_get_targets():
+    context, _ = get_verification_context(None)
+    context.config['bucket_config']['nightly']['replicas'] = [{
+        'name': 'replica',
+        'credentials': {'id': 'dummy', 'key': 'dummy'},
+        'buckets': {'fake': 'replica-bucket'},
+    }]
+    context.uploaded_contents = dict()
+    task_target, replica_target = get_targets(context)
+    assert task_target is context
+    # attributes set on the task context later on are shared
+    context.progress = 'progress'
+    assert replica_target.progress == 'progress'
+    assert replica_target.replica['name'] == 'replica'
+    assert replica_target.uploaded_contents is not context.uploaded_contents
+
+
 def test_main(event_loop, fake_session):
     context = Context()
     context.config = get_fake_valid_config()
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import stat
+import tempfile
+
+import mock
+import pytest
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerTaskException
+from scriptworker.test import event_loop
+
+from beetmoverscript.script import action_map, push_to_nightly, setup_mimetypes
+from beetmoverscript.storage import LocalFilesystemBackend, link_file
+from beetmoverscript.streaming import ChunkQueue
+from beetmoverscript.task import get_upstream_artifacts
+from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task, get_fake_balrog_props
+from beetmoverscript.transport import get_s3_transport
+from beetmoverscript.utils import generate_beetmover_manifest
+
+assert event_loop  # silence flake8
+
+BUCKET = 'fake-staging-bucket'
+
+
+def get_bucket_config(root, **kwargs):
+    return dict({'transport': 'local', 'root': root, 'buckets': {'fake': BUCKET}}, **kwargs)
+
+
+def write_source(directory, contents=b'some contents', mode=0o644):
+    path = os.path.join(directory, 'source.txt')
+    with open(path, 'wb') as fh:
+        fh.write(contents)
+    os.chmod(path, mode)
+    return path
+
+
+def test_link_file_hardlink():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source = write_source(tmpdirname)
+        dest = os.path.join(tmpdirname, 'dest.txt')
+        assert link_file(source, dest) == 'hardlink'
+        assert os.stat(source).st_ino == os.stat(dest).st_ino
+
+
+@pytest.mark.parametrize('methods', (
+    ('hardlink', 'copy'),
+    ('reflink', 'copy_file_range', 'copy'),
+    ('copy', ),
+))
+def test_link_file_fallback(methods):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source = write_source(tmpdirname)
+        dest = os.path.join(tmpdirname, 'dest.txt')
+        with mock.patch('os.link', side_effect=OSError('cross-device link')):
+            method = link_file(source, dest, methods)
+        assert method in methods and method != 'hardlink'
+        with open(dest, 'rb') as fh:
+            assert fh.read() == b'some contents'
+
+
+def test_get_s3_transport_local():
+    assert isinstance(get_s3_transport(None, get_bucket_config('/tmp'), BUCKET), LocalFilesystemBackend)
+
+
+@pytest.mark.parametrize('key', ('../escape', 'pub/../../escape', '/'))
+def test_local_backend_forbidden_key(key):
+    backend = LocalFilesystemBackend(None, get_bucket_config('/tmp'), BUCKET)
+    with pytest.raises(ScriptWorkerTaskException):
+        backend.get_path(key)
+
+
+def test_local_backend(event_loop):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source = write_source(tmpdirname)
+        backend = LocalFilesystemBackend(None, get_bucket_config(os.path.join(tmpdirname, 'mirror')),
+                                         BUCKET)
+        headers = {'Content-Type': 'text/plain', 'x-amz-meta-sha512': 'digest', 'Content-Length': '13'}
+
+        assert event_loop.run_until_complete(backend.head_object('pub/a.txt')).status == 404
+        event_loop.run_until_complete(backend.put_object('pub/a.txt', source, headers))
+        path = os.path.join(tmpdirname, 'mirror', BUCKET, 'pub/a.txt')
+        assert os.stat(path).st_ino == os.stat(source).st_ino
+
+        resp = event_loop.run_until_complete(backend.head_object('pub/a.txt'))
+        assert resp.status == 200
+        assert resp.headers['content-type'] == 'text/plain'
+        assert resp.headers['x-amz-meta-sha512'] == 'digest'
+        assert resp.content_length == 13
+
+        # copies keep the headers of their source, unless told to replace them
+        event_loop.run_until_complete(backend.copy_object('pub/b.txt', 'pub/a.txt'))
+        _, body = event_loop.run_until_complete(backend.get_object('pub/b.txt'))
+        assert body == b'some contents'
+        resp = event_loop.run_until_complete(backend.head_object('pub/b.txt'))
+        assert resp.headers['x-amz-meta-sha512'] == 'digest'
+
+        event_loop.run_until_complete(backend.copy_object('pub/b.txt', 'pub/b.txt', {
+            'x-amz-metadata-directive': 'REPLACE', 'x-amz-meta-sha512': 'other',
+        }))
+        resp = event_loop.run_until_complete(backend.head_object('pub/b.txt'))
+        assert resp.headers['x-amz-meta-sha512'] == 'other'
+        assert 'x-amz-metadata-directive' not in resp.headers
+        resp = event_loop.run_until_complete(backend.head_object('pub/a.txt'))
+        assert resp.headers['x-amz-meta-sha512'] == 'digest'
+
+        with pytest.raises(ScriptWorkerTaskException):
+            event_loop.run_until_complete(backend.copy_object('pub/c.txt', 'pub/missing.txt'))
+        with pytest.raises(ScriptWorkerTaskException):
+            event_loop.run_until_complete(backend.get_object('pub/missing.txt'))
+
+
+def test_local_backend_file_mode(event_loop):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # e.g. a file compressed to a temporary file of the work_dir
+        source = write_source(tmpdirname, mode=0o600)
+        backend = LocalFilesystemBackend(None, get_bucket_config(os.path.join(tmpdirname, 'mirror')),
+                                         BUCKET)
+        event_loop.run_until_complete(backend.put_object('pub/a.txt', source, {}))
+        path = os.path.join(tmpdirname, 'mirror', BUCKET, 'pub/a.txt')
+        assert os.stat(path).st_ino != os.stat(source).st_ino
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+        assert stat.S_IMODE(os.stat(source).st_mode) == 0o600
+
+        # published files are hardlinked between themselves
+        event_loop.run_until_complete(backend.copy_object('pub/b.txt', 'pub/a.txt'))
+        assert os.stat(os.path.join(tmpdirname, 'mirror', BUCKET, 'pub/b.txt')).st_ino == \
+            os.stat(path).st_ino
+
+
+@pytest.mark.parametrize('size,raises', ((6, False), (7, True)))
+def test_local_backend_stream(event_loop, size, raises):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        backend = LocalFilesystemBackend(None, get_bucket_config(tmpdirname), BUCKET)
+
+        async def stream():
+            chunks = ChunkQueue()
+            put = backend.put_object_stream('pub/a.txt', chunks, size, {})
+            for chunk in (b'abc', b'def', None):
+                await chunks.put(chunk)
+            return await put
+
+        if raises:
+            with pytest.raises(ScriptWorkerTaskException):
+                event_loop.run_until_complete(stream())
+            assert os.listdir(os.path.join(tmpdirname, BUCKET, 'pub')) == []
+        else:
+            event_loop.run_until_complete(stream())
+            with open(os.path.join(tmpdirname, BUCKET, 'pub/a.txt'), 'rb') as fh:
+                assert fh.read() == b'abcdef'
+
+
+def test_push_to_staging(event_loop):
+    setup_mimetypes()
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.config['upload_verification'] = {'full_get_max_size': 1024}
+    # staging uploads are laid out like nightly ones
+    context.config['actions']['push-to-staging'] = {
+        key.replace('nightly', 'staging'): template
+        for key, template in context.config['actions']['push-to-nightly'].items()
+    }
+    context.task = get_fake_valid_task()
+    context.bucket = 'staging'
+    context.action = 'push-to-staging'
+    context.digest_cache = None
+    assert action_map[context.action] is push_to_nightly
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        mirror = os.path.join(tmpdirname, 'mirror')
+        context.config['bucket_config'] = {'staging': get_bucket_config(mirror)}
+        context.config['artifact_dir'] = tmpdirname
+        os.makedirs(os.path.join(tmpdirname, 'public'))
+
+        with mock.patch('beetmoverscript.script.get_s3_client', side_effect=AssertionError):
+            event_loop.run_until_complete(push_to_nightly(context))
+
+        release_props = get_fake_balrog_props()['properties']
+        release_props['platform'] = release_props['stage_platform']
+        context.release_props = release_props
+        manifest = generate_beetmover_manifest(context)
+        published = 0
+        for locale, artifacts in get_upstream_artifacts(context).items():
+            for artifact, source in artifacts.items():
+                with open(source, 'rb') as fh:
+                    digest = hashlib.sha512(fh.read()).hexdigest()
+                for dest in manifest['mapping'][locale][artifact]['destinations']:
+                    path = os.path.join(mirror, BUCKET, manifest['s3_bucket_path'], dest)
+                    with open(path, 'rb') as fh:
+                        assert hashlib.sha512(fh.read()).hexdigest() == digest
+                    published += 1
+        assert published == 8
@@ -0,0 +1,334 @@
+import aiohttp
+import asyncio
+import functools
+import gzip
+import hashlib
+import json
+import mock
+import os
+import pytest
+import tempfile
+
+from scriptworker.context import Context
+from scriptworker.exceptions import ScriptWorkerTaskException
+from scriptworker.test import event_loop
+from scriptworker.utils import retry_async
+
+from beetmoverscript.script import move_beets, setup_mimetypes
+from beetmoverscript.streaming import (ChunkQueue, RemoteArtifact, SpillFile, StreamSlots,
+                                       get_remote_artifact, stat_remote_artifacts,
+                                       get_stream_slots, close_download_session)
+from beetmoverscript.task import get_upstream_artifacts
+from beetmoverscript.test import get_fake_valid_config, get_fake_valid_task
+from beetmoverscript.test.fake_s3 import FakeS3, Faults
+from beetmoverscript.utils import get_tcp_connector
+
+assert event_loop  # silence flake8
+
+BUCKET = 'fake-nightly-bucket'
+TASK_ID = 'eSzfNqMZT_mSiQQXu8hyqg'
+ARTIFACT = os.urandom(300 * 1024)
+
+
+def test_get_remote_artifact():
+    context = Context()
+    context.config = get_fake_valid_config()
+    assert get_remote_artifact(context, TASK_ID, 'public/build/target.mar') is None
+
+    context.config['artifact_streaming'] = {
+        'url_template': 'https://queue/v1/task/{taskId}/artifacts/{path}',
+    }
+    artifact = get_remote_artifact(context, TASK_ID, 'public/build/target.mar')
+    assert artifact.url == 'https://queue/v1/task/{}/artifacts/public/build/target.mar'.format(TASK_ID)
+    assert artifact.path == 'public/build/target.mar'
+
+
+def test_get_upstream_artifacts_remote():
+    context = Context()
+    context.config = get_fake_valid_config()
+    context.task = get_fake_valid_task()
+    context.task['payload']['upstreamArtifacts'][0]['paths'].append('public/build/missing.mar')
+    with pytest.raises(ScriptWorkerTaskException):
+        get_upstream_artifacts(context)
+
+    context.config['artifact_streaming'] = {
+        'url_template': 'https://queue/v1/task/{taskId}/artifacts/{path}',
+    }
+    artifacts = get_upstream_artifacts(context)
+    locale = context.task['payload']['upstreamArtifacts'][0]['locale']
+    assert isinstance(artifacts[locale]['missing.mar'], RemoteArtifact)
+    # artifacts found in the work_dir are still read from there
+    assert all([isinstance(source, str) for name, source in artifacts[locale].items()
+                if name != 'missing.mar'])
+
+
+def test_chunk_queue(event_loop):
+    async def _run():
+        queue = ChunkQueue(maxsize=1)
+        await queue.put(b'foo')
+        # closing a full queue unblocks its producer and drops the chunks
+        queue.close()
+        await queue.put(b'bar')
+        assert queue.queue.empty()
+
+        queue = ChunkQueue()
+        for chunk in (b'foo', b'bar', None):
+            await queue.put(chunk)
+        return [chunk async for chunk in queue]
+
+    assert event_loop.run_until_complete(_run()) == [b'foo', b'bar']
+
+
+@pytest.mark.parametrize("max_size,complete", [
+    (10, True),
+    (5, False),
+    (0, False),
+])
+def test_spill_file(event_loop, max_size, complete):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        spill = SpillFile(os.path.join(tmpdirname, 'spill'), max_size)
+
+        async def _run():
+            await spill.reset()
+            for chunk in (b'foo', b'bar'):
+                await spill.write(chunk)
+            await spill.close()
+
+        event_loop.run_until_complete(_run())
+        assert spill.complete is complete
+        assert os.path.exists(spill.path) is complete
+        if complete:
+            with open(spill.path, 'rb') as fh:
+                assert fh.read() == b'foobar'
+
+
+def write_chain_of_trust(work_dir, artifacts, trusted=None):
+    """Write the chain of trust of the upstream task as scriptworker would,
+    listing the digests of the artifacts as they were created, or the given
+    `trusted` ones"""
+    listed = {}
+    for path, (body, headers) in artifacts.items():
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        listed['public/build/{}'.format(path)] = {'sha256': hashlib.sha256(body).hexdigest()}
+    for path, sha256 in (trusted or {}).items():
+        listed['public/build/{}'.format(path)] = {'sha256': sha256}
+    cot_dir = os.path.join(work_dir, 'cot', TASK_ID, 'public')
+    os.makedirs(cot_dir)
+    with open(os.path.join(cot_dir, 'chain-of-trust.json'), 'w') as fh:
+        json.dump({'taskId': TASK_ID, 'artifacts': listed}, fh)
+
+
+def run_streaming(event_loop, func, s3_faults=None, spill_max_size=None, artifacts=None,
+                  max_connections=None, trusted=None):
+    """Serve ARTIFACT, or the given artifacts, from a local artifact store,
+    and stream them to a local S3 through `func`"""
+    artifacts = artifacts or {'target.mar': (ARTIFACT, {})}
+
+    async def _run(work_dir):
+        write_chain_of_trust(work_dir, artifacts, trusted)
+        store = FakeS3()
+        for path, (body, headers) in artifacts.items():
+            store.objects[('artifacts', '{}/public/build/{}'.format(TASK_ID, path))] = {
+                'body': body, 'etag': '"etag"', 'headers': headers,
+            }
+        s3 = FakeS3(s3_faults)
+        store_url = await store.start()
+        s3_url = await s3.start()
+
+        context = Context()
+        context.config = get_fake_valid_config()
+        context.config['work_dir'] = work_dir
+        context.config['artifact_streaming'] = {
+            'url_template': store_url + '/artifacts/{taskId}/{path}',
+        }
+        if spill_max_size is not None:
+            context.config['artifact_streaming']['spill_max_size'] = spill_max_size
+        context.config['bucket_config'] = {
+            'nightly': {
+                'endpoint_url': s3_url,
+                'credentials': {'id': 'dummy', 'key': 'dummy'},
+                'buckets': {'firefox': BUCKET},
+            }
+        }
+        context.bucket = 'nightly'
+        context.release_props = {'appName': 'Firefox'}
+        context.checksums = dict()
+        context.destination_checksums = dict()
+        context.balrog_manifest = list()
+        context.file_checksums = dict()
+        context.compressed_artifacts = dict()
+        context.digest_cache = None
+        if max_connections is not None:
+            context.config['aiohttp_max_connections'] = max_connections
+            context.stream_slots = get_stream_slots(context)
+        try:
+            async with aiohttp.ClientSession(connector=get_tcp_connector(context.config)) as session:
+                context.session = session
+                await func(context)
+        finally:
+            await close_download_session(context)
+            await store.stop()
+            await s3.stop()
+        return context, store, s3
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        result = event_loop.run_until_complete(_run(tmpdirname))
+        # the spill file is always cleaned up
+        assert os.listdir(tmpdirname) == ['cot']
+    return result
+
+
+async def stream_target(context):
+    source = get_remote_artifact(context, TASK_ID, 'public/build/target.mar')
+    artifacts = {'en-US': {'target.mar': source}}
+    await stat_remote_artifacts(context, artifacts)
+    assert source.size == len(ARTIFACT)
+    manifest = {
+        's3_bucket_path': 'pub/firefox/nightly/',
+        'mapping': {'en-US': {'target.mar': {
+            's3_key': 'firefox.mar',
+            'destinations': ['dated/firefox.mar', 'latest/firefox.mar'],
+        }}},
+    }
+    await move_beets(context, artifacts, manifest)
+
+
+@pytest.mark.parametrize("s3_faults,spill_max_size,expected_downloads", [
+    # streamed to both destinations at once
+    (None, None, 1),
+    # the failed upload is retried from the local copy
+    (Faults(slowdown_count=1), None, 1),
+    # the artifact is too big to be kept on disk, it is downloaded again
+    (Faults(slowdown_count=1), 100 * 1024, 2),
+])
+def test_stream_beet(event_loop, s3_faults, spill_max_size, expected_downloads):
+    setup_mimetypes()
+    fast_retry_async = functools.partial(retry_async, sleeptime_callback=lambda *args, **kwargs: 0)
+    with mock.patch('beetmoverscript.script.retry_async', fast_retry_async):
+        context, store, s3 = run_streaming(event_loop, stream_target, s3_faults, spill_max_size)
+
+    expected = {
+        'sha512': hashlib.sha512(ARTIFACT).hexdigest(),
+        'sha256': hashlib.sha256(ARTIFACT).hexdigest(),
+        'size': len(ARTIFACT),
+    }
+    assert context.checksums['firefox.mar'] == expected
+    for dest in ('dated/firefox.mar', 'latest/firefox.mar'):
+        obj = s3.objects[(BUCKET, 'pub/firefox/nightly/{}'.format(dest))]
+        assert obj['body'] == ARTIFACT
+        assert obj['headers']['x-amz-meta-sha512'] == expected['sha512']
+        assert obj['headers']['x-amz-meta-sha256'] == expected['sha256']
+    assert store.requests.count(('GET', 200)) == expected_downloads
+
+
+@pytest.mark.parametrize("name,trusted", [
+    # listed in the chain of trust but missing from the artifact store
+    ('missing.mar', {'missing.mar': '0' * 64}),
+    # not listed in the chain of trust
+    ('untrusted.mar', None),
+])
+def test_stat_remote_artifacts_missing(event_loop, name, trusted):
+    async def _stat(context):
+        source = get_remote_artifact(context, TASK_ID, 'public/build/{}'.format(name))
+        with pytest.raises(ScriptWorkerTaskException):
+            await stat_remote_artifacts(context, {'en-US': {name: source}})
+
+    context, store, s3 = run_streaming(event_loop, _stat, trusted=trusted)
+    assert (('HEAD', 404) in store.requests) is (trusted is not None)
+
+
+@pytest.mark.parametrize("destinations", [
+    # streamed
+    2,
+    # downloaded to the work_dir first
+    3,
+])
+def test_stream_beet_untrusted(event_loop, destinations):
+    # the artifact store doesn't serve the artifact its task created
+    async def _stream(context):
+        with pytest.raises(ScriptWorkerTaskException):
+            await stream_targets(context, ['target.mar'], destinations)
+
+    fast_retry_async = functools.partial(retry_async, sleeptime_callback=lambda *args, **kwargs: 0)
+    with mock.patch('beetmoverscript.script.retry_async', fast_retry_async):
+        context, store, s3 = run_streaming(event_loop, _stream, max_connections=2,
+                                           trusted={'target.mar': '0' * 64})
+    assert s3.objects == {}
+    assert context.balrog_manifest == []
+
+
+async def stream_targets(context, names, destinations=2):
+    setup_mimetypes()
+    artifacts = {'en-US': {
+        name: get_remote_artifact(context, TASK_ID, 'public/build/{}'.format(name)) for name in names
+    }}
+    await stat_remote_artifacts(context, artifacts)
+    manifest = {
+        's3_bucket_path': 'pub/firefox/nightly/',
+        'mapping': {'en-US': {
+            name: {
+                's3_key': name,
+                'destinations': ['{}/{}'.format(i, name) for i in range(destinations)],
+            } for name in names
+        }},
+    }
+    await asyncio.wait_for(move_beets(context, artifacts, manifest), timeout=30)
+
+
+def test_stream_beets_connection_limit(event_loop):
+    # each stream needs both of its uploads going at once, the streams
+    # don't all fit in the pool of the task session
+    names = ['target{}.mar'.format(i) for i in range(4)]
+    bodies = {name: os.urandom(3 * 1024 * 1024) for name in names}
+    context, store, s3 = run_streaming(
+        event_loop, functools.partial(stream_targets, names=names),
+        artifacts={name: (body, {}) for name, body in bodies.items()}, max_connections=4,
+    )
+    for name, body in bodies.items():
+        for i in range(2):
+            assert s3.objects[(BUCKET, 'pub/firefox/nightly/{}/{}'.format(i, name))]['body'] == body
+    assert store.requests.count(('GET', 200)) == len(names)
+
+
+def test_stream_beets_too_many_uploads(event_loop):
+    # artifacts needing more uploads at once than there are connections are
+    # downloaded to the work_dir first
+    context, store, s3 = run_streaming(
+        event_loop, functools.partial(stream_targets, names=['target.mar'], destinations=3),
+        max_connections=2,
+    )
+    for i in range(3):
+        assert s3.objects[(BUCKET, 'pub/firefox/nightly/{}/target.mar'.format(i))]['body'] == ARTIFACT
+    assert context.checksums['target.mar']['size'] == len(ARTIFACT)
+    assert store.requests.count(('GET', 200)) == 1
+
+
+def test_stream_beet_encoded(event_loop):
+    body = b'{"Hello": "world from beetmoverscript"}' * 100
+    context, store, s3 = run_streaming(
+        event_loop, functools.partial(stream_targets, names=['target.json']),
+        artifacts={'target.json': (gzip.compress(body), {'Content-Encoding': 'gzip'})},
+    )
+    # the artifact is uploaded decoded, as it was created
+    for i in range(2):
+        obj = s3.objects[(BUCKET, 'pub/firefox/nightly/{}/target.json'.format(i))]
+        assert obj['body'] == body
+        assert obj['headers']['x-amz-meta-sha512'] == hashlib.sha512(body).hexdigest()
+    assert context.checksums['target.json']['size'] == len(body)
+
+
+def test_stream_slots(event_loop):
+    slots = StreamSlots(3)
+    acquired = []
+
+    async def stream(name, count):
+        await slots.acquire(count)
+        acquired.append(name)
+        await asyncio.sleep(0.01)
+        slots.release(count)
+
+    event_loop.run_until_complete(asyncio.gather(stream('a', 2), stream('b', 2), stream('c', 1)))
+    # streams get all the connections they need in turn, the second one
+    # doesn't hold any while it waits for the first one
+    assert acquired == ['a', 'b', 'c']
@@ -5,10 +5,17 @@ import tempfile
 from beetmoverscript.test import (get_fake_valid_task, get_fake_valid_config,
                                   get_fake_balrog_props, get_fake_checksums_manifest)
 from beetmoverscript.task import (validate_task_schema, add_balrog_manifest_to_artifacts,
+                                  add_checksums_to_artifacts, generate_upload_plan,
+                                  add_destinations_checksums_to_artifacts,
+                                  add_upload_plan_to_artifacts,
                                   get_upstream_artifacts,
                                   generate_checksums_manifest, get_initial_release_props_file)
+from beetmoverscript.utils import generate_beetmover_manifest
 from scriptworker.context import Context
 from scriptworker.exceptions import ScriptWorkerTaskException
+from scriptworker.test import event_loop
+
+assert event_loop  # silence flake8
 
 
 def test_get_upstream_artifacts():
@@ -30,7 +37,18 @@ def test_validate_task():
     validate_task_schema(context)
 
 
-def test_balrog_manifest_to_artifacts():
+def test_validate_release_task():
+    context = Context()
+    context.task = get_fake_valid_task()
+    context.config = get_fake_valid_config()
+    with pytest.raises(ScriptWorkerTaskException):
+        validate_task_schema(context, schema_key='release_schema_file')
+
+    context.task['payload'] = {'product': 'firefox', 'version': '53.0', 'build_number': 3}
+    validate_task_schema(context, schema_key='release_schema_file')
+
+
+def test_balrog_manifest_to_artifacts(event_loop):
     context = Context()
     context.task = get_fake_valid_task()
     context.config = get_fake_valid_config()
@@ -49,7 +67,7 @@ def test_balrog_manifest_to_artifacts():
         if not os.path.exists(public_tmpdirname):
             os.makedirs(public_tmpdirname)
 
-        add_balrog_manifest_to_artifacts(context)
+        event_loop.run_until_complete(add_balrog_manifest_to_artifacts(context))
 
         with open(file_path, "r") as fread:
             retrieved_data = json.load(fread)
@@ -57,6 +75,106 @@ def test_balrog_manifest_to_artifacts():
         assert fake_balrog_manifest == retrieved_data
 
 
+def test_checksums_to_artifacts(event_loop):
+    context = Context()
+    context.task = get_fake_valid_task()
+    context.config = get_fake_valid_config()
+    context.checksums = {
+        "firefox-53.0a1.en-US.linux-i686.complete.mar": {
+            "sha512": "14f2d1cb999a8b42a3b6b671f7376c3e246daa65d108e2b8fe880f069601dc2b26afa155b52001235db059",
+            "size": 618149,
+            "sha256": "293975734953874539475"
+        }
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['artifact_dir'] = tmpdirname
+        os.makedirs(os.path.join(tmpdirname, 'public'))
+
+        event_loop.run_until_complete(add_checksums_to_artifacts(context))
+
+        with open(os.path.join(tmpdirname, 'public/target.checksums'), "r") as fread:
+            assert fread.read() == get_fake_checksums_manifest()
+
+
+def test_destinations_checksums_to_artifacts(event_loop):
+    context = Context()
+    context.task = get_fake_valid_task()
+    context.config = get_fake_valid_config()
+    checksums = {"sha512": "512", "sha256": "256", "size": 3}
+    context.destination_checksums = {
+        "pub/nightly/latest/firefox.mar": checksums,
+        "pub/nightly/2016/firefox.mar": checksums,
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['artifact_dir'] = tmpdirname
+        os.makedirs(os.path.join(tmpdirname, 'public'))
+
+        event_loop.run_until_complete(
+            add_destinations_checksums_to_artifacts(context, {'s3_bucket_path': 'pub/nightly/'})
+        )
+
+        with open(os.path.join(tmpdirname, 'public/destinations.checksums'), "r") as fread:
+            assert fread.read().splitlines() == [
+                "512 sha512 3 2016/firefox.mar",
+                "256 sha256 3 2016/firefox.mar",
+                "512 sha512 3 latest/firefox.mar",
+                "256 sha256 3 latest/firefox.mar",
+            ]
+
+
+def get_upload_plan_context():
+    context = Context()
+    context.task = get_fake_valid_task()
+    context.config = get_fake_valid_config()
+    context.config['upload_plan'] = {'connection_throughput': 1, 'link_throughput': 5}
+    context.release_props = get_fake_balrog_props()["properties"]
+    context.release_props['platform'] = context.release_props['stage_platform']
+    context.bucket = 'nightly'
+    context.action = 'push-to-nightly'
+    context.artifacts_to_beetmove = get_upstream_artifacts(context)
+    return context
+
+
+def test_generate_upload_plan():
+    context = get_upload_plan_context()
+    manifest = generate_beetmover_manifest(context)
+    # make two artifacts collide onto the same destination
+    mapping = manifest['mapping']['en-US']
+    mapping['target.txt']['destinations'] = mapping['target_info.txt']['destinations']
+
+    plan = generate_upload_plan(context, context.artifacts_to_beetmove, manifest)
+
+    sizes = [os.path.getsize(source) for source in context.artifacts_to_beetmove['en-US'].values()]
+    assert len(plan['beets']) == 4
+    assert plan['object_count'] == 8
+    assert plan['unique_sources'] == 4
+    assert plan['total_bytes'] == 2 * sum(sizes)
+    assert plan['duplicate_destinations'] == sorted([
+        os.path.join(manifest['s3_bucket_path'], dest) for dest in mapping['target_info.txt']['destinations']
+    ])
+    assert plan['heaviest_sources'][0]['bytes'] == 2 * max(sizes)
+    # throughput is capped by the link, not by the connections
+    assert plan['estimated_wall_time'] == plan['total_bytes'] / 5
+
+
+def test_add_upload_plan_to_artifacts(event_loop):
+    context = get_upload_plan_context()
+    manifest = generate_beetmover_manifest(context)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        context.config['artifact_dir'] = tmpdirname
+        os.makedirs(os.path.join(tmpdirname, 'public'))
+        event_loop.run_until_complete(
+            add_upload_plan_to_artifacts(context, context.artifacts_to_beetmove, manifest)
+        )
+        with open(os.path.join(tmpdirname, 'public/upload_plan.json'), "r") as fread:
+            plan = json.load(fread)
+
+    assert plan == generate_upload_plan(context, context.artifacts_to_beetmove, manifest)
+
+
 def test_checksums_manifest_generation():
     checksums = {
         "firefox-53.0a1.en-US.linux-i686.complete.mar": {
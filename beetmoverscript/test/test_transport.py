@@ -0,0 +1,152 @@
+import aiohttp
+import os
+import pytest
+import tempfile
+
+from scriptworker.exceptions import ScriptWorkerRetryException, ScriptWorkerTaskException
+from scriptworker.test import event_loop
+
+from beetmoverscript.test.fake_s3 import FakeS3, Faults
+from beetmoverscript.transport import (NativeS3Transport, check_response, find_xml_text,
+                                       get_s3_transport)
+
+assert event_loop  # silence flake8
+
+BUCKET = 'fake-bucket'
+
+
+def get_bucket_config(endpoint_url=None):
+    bucket_config = {
+        'credentials': {'id': 'dummy', 'key': 'dummy'},
+        'buckets': {'firefox': BUCKET},
+        'transport': 'native',
+    }
+    if endpoint_url:
+        bucket_config['endpoint_url'] = endpoint_url
+    return bucket_config
+
+
+def run_with_transport(event_loop, func, faults=None, multipart_config=None):
+    async def _run():
+        fake_s3 = FakeS3(faults)
+        endpoint_url = await fake_s3.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                transport = NativeS3Transport(session, get_bucket_config(endpoint_url), BUCKET,
+                                              multipart_config=multipart_config)
+                result = await func(transport)
+        finally:
+            await fake_s3.stop()
+        return fake_s3, result
+
+    return event_loop.run_until_complete(_run())
+
+
+def test_get_url():
+    transport = NativeS3Transport(None, get_bucket_config(), BUCKET)
+    assert transport.get_url('pub/firefox/a b.txt') == \
+        'https://fake-bucket.s3.amazonaws.com/pub/firefox/a%20b.txt'
+    transport = NativeS3Transport(None, get_bucket_config('http://localhost:8080/'), BUCKET)
+    assert transport.get_url('foo', 'uploads') == 'http://localhost:8080/fake-bucket/foo?uploads'
+
+
+def test_sign():
+    transport = NativeS3Transport(None, get_bucket_config(), BUCKET)
+    headers = transport.sign('PUT', transport.get_url('foo'), {'Content-Type': 'text/plain'})
+    assert headers['Authorization'].startswith('AWS4-HMAC-SHA256 Credential=dummy/')
+    assert headers['X-Amz-Content-SHA256'] == 'UNSIGNED-PAYLOAD'
+    assert 'X-Amz-Date' in headers
+
+
+def test_get_s3_transport():
+    assert get_s3_transport(None, {}, BUCKET) is None
+    assert isinstance(get_s3_transport(None, get_bucket_config(), BUCKET), NativeS3Transport)
+    with pytest.raises(ScriptWorkerTaskException):
+        get_s3_transport(None, {'transport': 'carrier-pigeon'}, BUCKET)
+
+
+@pytest.mark.parametrize("contents,expected_etag_suffix", [
+    (b'foobar', ''),
+    # bigger than the multipart threshold
+    (b'x' * 12, '-3'),
+])
+def test_put_object(event_loop, contents, expected_etag_suffix):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, 'target.txt')
+        with open(path, 'wb') as fh:
+            fh.write(contents)
+
+        async def _put(transport):
+            await transport.put_object('foo', path, {'Content-Type': 'text/plain',
+                                                     'x-amz-meta-sha512': 'deadbeef'})
+            await transport.copy_object('bar', 'foo')
+            head = await transport.head_object('bar')
+            missing = await transport.head_object('missing')
+            _, body = await transport.get_object('bar')
+            return head, missing, body
+
+        fake_s3, (head, missing, body) = run_with_transport(
+            event_loop, _put, multipart_config={'threshold': 10, 'part_size': 5}
+        )
+
+    assert body == contents
+    assert head.status == 200
+    assert head.headers['x-amz-meta-sha512'] == 'deadbeef'
+    assert head.headers['ETag'].strip('"').endswith(expected_etag_suffix)
+    assert missing.status == 404
+    assert fake_s3.multipart_uploads == {}
+
+
+@pytest.mark.parametrize("faults,exception", [
+    (Faults(slowdown_count=1), ScriptWorkerRetryException),
+    (Faults(expire_urls=True), ScriptWorkerTaskException),
+])
+def test_request_errors(event_loop, faults, exception):
+    async def _get(transport):
+        with pytest.raises(exception):
+            await transport.get_object('foo')
+
+    run_with_transport(event_loop, _get, faults=faults)
+
+
+class FakeResponse(object):
+    def __init__(self, status):
+        self.status = status
+
+
+@pytest.mark.parametrize("status,body,error_in_body,exception", [
+    (200, b'', True, None),
+    (200, b'<Error><Code>InternalError</Code></Error>', True, ScriptWorkerRetryException),
+    # e.g. an artifact downloaded back for verification
+    (200, b'<Error><Code>InternalError</Code></Error>', False, None),
+    (503, b'<Error><Code>SlowDown</Code></Error>', False, ScriptWorkerRetryException),
+    (400, b'<Error><Code>RequestTimeout</Code></Error>', False, ScriptWorkerRetryException),
+    (403, b'<Error><Code>AccessDenied</Code></Error>', False, ScriptWorkerTaskException),
+    (404, b'', False, ScriptWorkerTaskException),
+])
+def test_check_response(status, body, error_in_body, exception):
+    if exception is None:
+        check_response('GET', 'foo', FakeResponse(status), body, error_in_body=error_in_body)
+    else:
+        with pytest.raises(exception):
+            check_response('GET', 'foo', FakeResponse(status), body, error_in_body=error_in_body)
+
+
+def test_get_object_error_like_body(event_loop):
+    body = b'<Error><Code>InternalError</Code></Error> is part of the artifact'
+
+    async def _run(transport):
+        await transport.request('PUT', 'foo.txt', body=body)
+        _, actual = await transport.get_object('foo.txt')
+        return actual
+
+    _, actual = run_with_transport(event_loop, _run)
+    assert actual == body
+
+
+def test_find_xml_text():
+    body = (b'<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            b'<UploadId>abc</UploadId></InitiateMultipartUploadResult>')
+    assert find_xml_text(body, 'UploadId') == 'abc'
+    assert find_xml_text(body, 'Code') is None
+    assert find_xml_text(b'not xml', 'Code') is None
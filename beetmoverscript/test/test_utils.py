@@ -1,14 +1,21 @@
+import gzip
+import hashlib
 import json
 import pytest
 import tempfile
 
 from scriptworker.context import Context
+from scriptworker.test import event_loop
 from beetmoverscript.test import (get_fake_valid_task, get_fake_valid_config,
                                   get_fake_balrog_props, get_fake_checksums_manifest)
 from beetmoverscript.utils import (generate_beetmover_manifest, get_hash,
                                    write_json, generate_beetmover_template_args,
-                                   write_file, is_action_a_release_shipping)
-from beetmoverscript.constants import HASH_BLOCK_SIZE
+                                   write_file, is_action_a_release_shipping,
+                                   gzip_file, run_in_executor, get_candidates_prefix,
+                                   get_releases_prefix, matches_exclude)
+from beetmoverscript.constants import HASH_BLOCK_SIZE, RELEASE_EXCLUDE
+
+assert event_loop  # silence flake8
 
 
 def test_get_hash():
@@ -26,6 +33,32 @@ def test_get_hash():
     assert correct_sha1 == sha1digest
 
 
+def test_gzip_file():
+    text = b'Hello world from beetmoverscript!' * 1024
+
+    with tempfile.NamedTemporaryFile(delete=True) as fp, \
+            tempfile.NamedTemporaryFile(delete=True) as compressed_fp:
+        fp.write(text)
+        fp.flush()
+        gzip_file(fp.name, compressed_fp.name)
+
+        with gzip.open(compressed_fp.name, "rb") as fread:
+            assert fread.read() == text
+
+
+def test_run_in_executor(event_loop):
+    text = b'Hello world from beetmoverscript!'
+
+    with tempfile.NamedTemporaryFile(delete=True) as fp:
+        fp.write(text)
+        fp.flush()
+        sha1digest = event_loop.run_until_complete(
+            run_in_executor(get_hash, fp.name, hash_type="sha1")
+        )
+
+    assert sha1digest == hashlib.sha1(text).hexdigest()
+
+
 def test_write_json():
     sample_data = get_fake_balrog_props()
 
@@ -119,3 +152,23 @@ def test_beetmover_template_args_generation():
 def test_if_action_is_a_release_shipping(non_release, release):
     assert is_action_a_release_shipping(non_release) is False
     assert is_action_a_release_shipping(release) is True
+
+
+def test_get_candidates_prefix():
+    assert get_candidates_prefix('firefox', '53.0', 3) == 'pub/firefox/candidates/53.0-candidates/build3/'
+    assert get_candidates_prefix('fennec', '53.0', 1) == 'pub/mobile/candidates/53.0-candidates/build1/'
+
+
+def test_get_releases_prefix():
+    assert get_releases_prefix('firefox', '53.0') == 'pub/firefox/releases/53.0/'
+
+
+@pytest.mark.parametrize("keyname,expected", [
+    ('pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/en-US/firefox-53.0.tar.bz2', False),
+    ('pub/firefox/candidates/53.0-candidates/build3/win64/en-US/firefox-53.0.zip', True),
+    ('pub/mobile/candidates/53.0-candidates/build3/android-api-15/en-US/fennec-53.0.en-US.android-arm.apk', False),
+    ('pub/firefox/candidates/53.0-candidates/build3/logs/release-build.log', True),
+    ('pub/firefox/candidates/53.0-candidates/build3/linux-x86_64/en-US/firefox-53.0.checksums.asc', True),
+])
+def test_matches_exclude(keyname, expected):
+    assert matches_exclude(keyname, RELEASE_EXCLUDE) is expected
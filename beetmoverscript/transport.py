@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+import aiohttp
+import botocore.auth
+import botocore.awsrequest
+import botocore.config
+import botocore.credentials
+from scriptworker.exceptions import ScriptWorkerRetryException, ScriptWorkerTaskException
+from scriptworker.utils import retry_async, raise_future_exceptions
+from yarl import URL
+
+from beetmoverscript.constants import (MULTIPART_THRESHOLD, MULTIPART_PART_SIZE,
+                                       MULTIPART_MAX_CONCURRENCY, S3_DEFAULT_REGION)
+from beetmoverscript.ratelimit import ThrottledFileReader
+from beetmoverscript.storage import StorageBackend, LocalFilesystemBackend
+from beetmoverscript.utils import run_in_executor, get_size
+
+log = logging.getLogger(__name__)
+
+# S3 error codes worth retrying, on top of any 5xx
+RETRYABLE_ERROR_CODES = (
+    'SlowDown', 'RequestTimeout', 'RequestTimeTooSkewed', 'ExpiredToken', 'InternalError',
+)
+# errors worth retrying the requests of a transport on, others such as an
+# access denied are not
+RETRY_EXCEPTIONS = (ScriptWorkerRetryException, aiohttp.ClientError, asyncio.TimeoutError)
+# bodies are not hashed before being sent, they may be big or streamed
+SIGNING_CONFIG = botocore.config.Config(s3={'payload_signing_enabled': False})
+
+
+class NativeS3Transport(StorageBackend):
+    """Async S3 client signing its requests with SigV4 and sending them
+    through the task aiohttp session, hence its connection pool. Big files
+    are uploaded by parts, concurrently, and S3 errors are parsed to tell
+    the ones worth retrying from the others. Uploads and parts that are too
+    slow are hedged if given a hedger. Their bytes are counted as each of
+    them is sent if given a progress tracker, or as they are read when
+    throttled."""
+
+    def __init__(self, session, bucket_config, bucket_name, multipart_config=None,
+                 rate_limiters=None, hedger=None, progress=None):
+        multipart_config = multipart_config or {}
+        self.session = session
+        self.bucket_name = bucket_name
+        self.region = bucket_config.get('region', S3_DEFAULT_REGION)
+        self.endpoint_url = bucket_config.get('endpoint_url')
+        self.credentials = botocore.credentials.Credentials(
+            bucket_config['credentials']['id'], bucket_config['credentials']['key']
+        )
+        self.multipart_threshold = multipart_config.get('threshold', MULTIPART_THRESHOLD)
+        self.part_size = multipart_config.get('part_size', MULTIPART_PART_SIZE)
+        self.part_semaphore = asyncio.Semaphore(
+            multipart_config.get('max_concurrency', MULTIPART_MAX_CONCURRENCY)
+        )
+        self.rate_limiters = rate_limiters or []
+        self.hedger = hedger
+        self.progress = progress
+
+    def get_url(self, key, query=''):
+        quoted_key = urllib.parse.quote(key, safe='/~')
+        # S3-compatible endpoints other than AWS are addressed by path
+        if self.endpoint_url:
+            url = '{}/{}/{}'.format(self.endpoint_url.rstrip('/'), self.bucket_name, quoted_key)
+        else:
+            # the host boto3 presigns URLs for, whatever the region, so that
+            # the connections opened by the prewarming are reused
+            url = 'https://{}.s3.amazonaws.com/{}'.format(self.bucket_name, quoted_key)
+        return '{}?{}'.format(url, query) if query else url
+
+    def sign(self, method, url, headers, body=None):
+        request = botocore.awsrequest.AWSRequest(method=method, url=url, headers=headers,
+                                                 data=body)
+        request.context['client_config'] = SIGNING_CONFIG
+        botocore.auth.S3SigV4Auth(self.credentials, 's3', self.region).add_auth(request)
+        return dict(request.headers.items())
+
+    async def request(self, method, key, query='', headers=None, data=None, body=None,
+                      session=None):
+        """Send a signed request and return the response along with its
+        body. `data` is sent unsigned, e.g. an open file or an async
+        iterator, whereas `body` bytes are part of the signature."""
+        session = session or self.session
+        url = self.get_url(key, query)
+        headers = dict(headers or {})
+        # copies and multipart completions may fail after their 200 status
+        # was sent, the error is then in their body
+        error_in_body = any(name.lower() == 'x-amz-copy-source' for name in headers) or \
+            (method == 'POST' and query.startswith('uploadId='))
+        headers = self.sign(method, url, headers, body=body)
+        async with session.request(method, URL(url, encoded=True), headers=headers,
+                                   data=body if data is None else data,
+                                   compress=False) as resp:
+            response_body = await resp.read()
+        if method != 'HEAD':
+            check_response(method, key, resp, response_body, error_in_body=error_in_body)
+        return resp, response_body
+
+    async def put_object(self, key, path, headers):
+        size = await run_in_executor(get_size, path)
+        if size > self.multipart_threshold:
+            return await self.put_object_by_parts(key, path, size, headers)
+        return await self.hedge(size, self.put_file, key, path, size, headers)
+
+    async def put_file(self, key, path, size, headers, session=None):
+        meters = self.get_meters(path)
+        with await run_in_executor(open, path, 'rb') as fh:
+            data = fh
+            if self.rate_limiters:
+                data = ThrottledFileReader(fh, self.rate_limiters + meters)
+            result = await self.request('PUT', key, headers=dict(headers, **{'Content-Length': str(size)}),
+                                        data=data, session=session)
+        # unthrottled files are sent as is and only counted once sent
+        if not self.rate_limiters:
+            for meter in meters:
+                await meter.consume(size)
+        return result
+
+    def get_meters(self, path):
+        return [] if self.progress is None else self.progress.get_meters(path)
+
+    async def hedge(self, size, func, *args):
+        if self.hedger is None:
+            return await func(*args)
+        return await self.hedger.run(size, func, *args, session=self.session)
+
+    async def put_object_stream(self, key, chunks, size, headers):
+        return await self.request('PUT', key, headers=dict(headers, **{'Content-Length': str(size)}),
+                                  data=chunks)
+
+    async def put_object_by_parts(self, key, path, size, headers):
+        _, body = await self.request('POST', key, query='uploads', headers=headers)
+        upload_id = find_xml_text(body, 'UploadId')
+        log.info("multipart upload of %s to %s in %d parts", path, key, -(-size // self.part_size),
+                 extra={'s3_key': key, 'size': size})
+
+        parts = []
+        for number, offset in enumerate(range(0, size, self.part_size), start=1):
+            parts.append(
+                asyncio.ensure_future(
+                    retry_async(self.upload_part, args=(key, upload_id, number, path, offset),
+                                retry_exceptions=(ScriptWorkerRetryException, ))
+                )
+            )
+        try:
+            await raise_future_exceptions(parts)
+            complete = ''.join([
+                '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, part.result())
+                for number, part in enumerate(parts, start=1)
+            ])
+            return await self.request(
+                'POST', key, query='uploadId={}'.format(urllib.parse.quote(upload_id)),
+                body='<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(complete).encode('utf-8')
+            )
+        except BaseException:
+            for part in parts:
+                part.cancel()
+            # parts left behind are billed until the upload is aborted
+            try:
+                await self.request('DELETE', key,
+                                   query='uploadId={}'.format(urllib.parse.quote(upload_id)))
+            except Exception as exc:
+                log.warning("Failed to abort the multipart upload of {}: {}".format(key, exc))
+            raise
+
+    async def upload_part(self, key, upload_id, number, path, offset):
+        async with self.part_semaphore:
+            part = await run_in_executor(read_range, path, offset, self.part_size)
+            # the duplicate of a slow part takes the slot of the original
+            resp, _ = await self.hedge(len(part), self.put_part, key, upload_id, number, part)
+        for meter in self.get_meters(path):
+            await meter.consume(len(part))
+        return resp.headers['ETag']
+
+    async def put_part(self, key, upload_id, number, part, session=None):
+        for bucket in self.rate_limiters:
+            await bucket.consume(len(part))
+        return await self.request(
+            'PUT', key,
+            query='partNumber={}&uploadId={}'.format(number, urllib.parse.quote(upload_id)),
+            headers={'Content-Length': str(len(part))}, data=part, session=session
+        )
+
+    async def copy_object(self, key, source_key, headers=None):
+        headers = dict(headers or {})
+        headers['x-amz-copy-source'] = '{}/{}'.format(self.bucket_name,
+                                                      urllib.parse.quote(source_key))
+        return await self.request('PUT', key, headers=headers)
+
+    async def head_object(self, key):
+        resp, _ = await self.request('HEAD', key)
+        return resp
+
+    async def get_object(self, key):
+        return await self.request('GET', key)
+
+
+def read_range(path, offset, size):
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(size)
+
+
+def find_xml_text(body, tag):
+    """Return the text of the first `tag` element of an S3 XML document,
+    whatever its namespace"""
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return None
+    for element in root.iter():
+        if element.tag == tag or element.tag.endswith('}' + tag):
+            return element.text
+    return None
+
+
+def check_response(method, key, resp, body, error_in_body=False):
+    """Raise on S3 errors, including the ones returned with a 200 status by
+    copies and multipart completions if `error_in_body` is set. The bodies
+    of other requests, e.g. the objects downloaded, are left alone.
+    Throttling and server side errors are worth retrying, others are not."""
+    if resp.status < 300 and not (error_in_body and resp.status == 200 and
+                                  b'<Error>' in body):
+        return
+    code = find_xml_text(body, 'Code') or str(resp.status)
+    message = "{} {} failed: {} {}".format(method, key, code, find_xml_text(body, 'Message') or '')
+    if resp.status >= 500 or resp.status < 300 or code in RETRYABLE_ERROR_CODES:
+        raise ScriptWorkerRetryException(message)
+    raise ScriptWorkerTaskException(message)
+
+
+TRANSPORTS = {
+    'native': NativeS3Transport,
+    'local': LocalFilesystemBackend,
+}
+
+
+def get_s3_transport(session, bucket_config, bucket_name, multipart_config=None,
+                     rate_limiters=None, hedger=None, progress=None):
+    """Return the transport the bucket config asks for, or None if objects
+    are to be sent through presigned URLs. Local mirrors are published to
+    by the `local` one."""
+    name = bucket_config.get('transport')
+    if not name:
+        return None
+    if name not in TRANSPORTS:
+        raise ScriptWorkerTaskException("Unknown S3 transport {}".format(name))
+    return TRANSPORTS[name](session, bucket_config, bucket_name, multipart_config=multipart_config,
+                            rate_limiters=rate_limiters, hedger=hedger, progress=progress)
@@ -1,23 +1,73 @@
+import asyncio
+import contextlib
+import functools
+import gzip
 import hashlib
 from copy import deepcopy
 import json
 import logging
 import os
 import pprint
+import re
 
+import aiohttp
 import arrow
 import jinja2
 import yaml
 
 from beetmoverscript.constants import (HASH_BLOCK_SIZE, STAGE_PLATFORM_MAP,
-                                       TEMPLATE_KEY_PLATFORMS, RELEASE_ACTIONS)
+                                       TEMPLATE_KEY_PLATFORMS, RELEASE_ACTIONS,
+                                       PRODUCT_TO_PATH, DNS_CACHE_TTL, KEEPALIVE_TIMEOUT)
 
 log = logging.getLogger(__name__)
 
 
-def get_hash(filepath, hash_type="sha512"):
+async def run_in_executor(func, *args, **kwargs):
+    """Run a blocking function, e.g. disk I/O, in the default executor so
+    that slow volumes don't stall the uploads in flight on the event loop"""
+    return await run_in_pool(None, func, *args, **kwargs)
+
+
+async def run_in_pool(executor, func, *args, **kwargs):
+    """Same as `run_in_executor`, in the given executor, e.g. one sized for
+    many concurrent S3 calls rather than for disk I/O"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+@contextlib.contextmanager
+def cancelling(futures):
+    """Cancel the futures if the block they are awaited in is left early,
+    e.g. because the caller was itself cancelled, rather than leaving them
+    running unattended"""
+    try:
+        yield futures
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def get_tcp_connector(config):
+    """Connection pool of an aiohttp session of the task, capped to
+    `aiohttp_max_connections`, with its DNS lookups cached and connections
+    kept alive between requests"""
+    return aiohttp.TCPConnector(
+        limit=config['aiohttp_max_connections'],
+        ttl_dns_cache=config.get('aiohttp_dns_cache_ttl', DNS_CACHE_TTL),
+        keepalive_timeout=config.get('aiohttp_keepalive_timeout', KEEPALIVE_TIMEOUT),
+    )
+
+
+def get_hash(filepath, hash_type="sha512", cache=None):
     """Function to return the digest hash of a file based on filename and
-    algorithm"""
+    algorithm. If a digest cache is given, it's looked up before reading the
+    file."""
+    if cache is not None:
+        cached_digest = cache.get(filepath, hash_type)
+        if cached_digest is not None:
+            return cached_digest
+
     digest = hashlib.new(hash_type)
     with open(filepath, "rb") as fobj:
         while True:
@@ -25,9 +75,22 @@ def get_hash(filepath, hash_type="sha512"):
             if not chunk:
                 break
             digest.update(chunk)
+
+    if cache is not None:
+        cache.set(filepath, hash_type, digest.hexdigest())
     return digest.hexdigest()
 
 
+def gzip_file(filepath, compressed_filepath):
+    """Function to gzip a file chunk by chunk into another file"""
+    with open(filepath, "rb") as fsrc, gzip.open(compressed_filepath, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(HASH_BLOCK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+
+
 def get_size(filepath):
     """Function to return the size of a file based on filename"""
     return os.path.getsize(filepath)
@@ -111,7 +174,9 @@ def generate_beetmover_manifest(context):
     manifest = yaml.safe_load(tmpl.render(**tmpl_args))
 
     log.info("manifest generated:")
-    log.info(pprint.pformat(manifest))
+    # the whole manifest is only worth formatting when debugging
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(pprint.pformat(manifest))
 
     return manifest
 
@@ -164,3 +229,20 @@ def alter_unpretty_contents(context, blobs, mappings):
 
             if pretty_contents != contents:
                 write_json(source, pretty_contents)
+
+
+def get_candidates_prefix(product, version, build_number):
+    """Function to return the S3 prefix of a release candidates directory"""
+    return "{}candidates/{}-candidates/build{}/".format(
+        PRODUCT_TO_PATH[product], version, build_number
+    )
+
+
+def get_releases_prefix(product, version):
+    """Function to return the S3 prefix of a release releases directory"""
+    return "{}releases/{}/".format(PRODUCT_TO_PATH[product], version)
+
+
+def matches_exclude(keyname, excludes):
+    """Function to return boolean if the S3 key matches any of the regexes"""
+    return any(re.search(exclude, keyname) for exclude in excludes)
@@ -23,6 +23,7 @@ setup(
     entry_points={
         "console_scripts": [
             "beetmoverscript = beetmoverscript.script:main",
+            "beetmover-merge-checksums = beetmoverscript.checksums:main",
         ],
     },
     license="MPL2",